@@ -1,16 +1,33 @@
 
+import os
+import os.path as op
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import nibabel as nb
-import numpy as np
 import matplotlib.pyplot as plt
 from nipype.interfaces import fsl
 from nipype.interfaces.utility import Merge
-from arcana import (Analysis, AnalysisMetaClass, ParamSpec, InputFilesetSpec,
-                    FilesetSpec, FieldSpec, Dataset, OutputFieldSpec,
-                    OutputFilesetSpec)
-from banana.file_format import text_format, nifti_gz_format
+from arcana import (Analysis, AnalysisMetaClass, ParamSpec, SwitchSpec,
+                    InputFilesetSpec, FilesetSpec, FieldSpec, Dataset,
+                    OutputFieldSpec, OutputFilesetSpec)
+from banana.file_format import (
+    text_format, json_format, nifti_format, nifti_gz_format)
 from banana.citation import fsl_cite
 from banana.requirement import fsl_req
-from example.interfaces import Grep, Awk, ConcatFloats, ExtractMetrics
+from arcana.data.file_format import FileFormat
+from example.interfaces import (
+    GrepField, LookupMetric, ConcatFloats, ExtractMetrics,
+    SmoothMask, SmoothMaskSweep, BET, Gzip, CompressMask)
+from example.thumbnails import cached_slice, render_comparison
+
+
+# Bounding box and bit-packed values of a mask (see
+# example.compact_mask.CompactMask)
+compact_mask_format = FileFormat(name='compact_mask', extension='.npz')
+
+# Directory with a 'fwhm-<fwhm>' sub-directory of smoothed images for each
+# kernel of a smoothing sweep (see example.interfaces.SmoothMaskSweep)
+smoothing_sweep_format = FileFormat(name='smoothing_sweep', directory=True)
 
 
 class ToyAnalysis(Analysis, metaclass=AnalysisMetaClass):
@@ -26,6 +43,12 @@ class ToyAnalysis(Analysis, metaclass=AnalysisMetaClass):
         FilesetSpec('selected_metric', text_format,
                     'extract_metrics_pipeline',
                     desc="The line containing the metric of interest"),
+        FilesetSpec('subject_statistics', json_format,
+                    'subject_statistics_pipeline',
+                    frequency='per_subject',
+                    desc=("Partial statistics of the selected metric across "
+                          "the visits of each subject, which are merged to "
+                          "give the statistics across all subjects")),
         OutputFieldSpec('average', float, 'statistics_pipeline',
                         frequency='per_dataset',
                         desc=("The average of the selected metric across all "
@@ -37,7 +60,14 @@ class ToyAnalysis(Analysis, metaclass=AnalysisMetaClass):
 
     add_param_specs = [
         ParamSpec('metric_of_interest', 'height',
-                  "The metric of interest to extract from the files")]
+                  "The metric of interest to extract from the files"),
+        SwitchSpec('use_metrics_index', False,
+                   desc=("Whether to look up the metric of interest from a "
+                         "persistent index of all metrics in the body-metrics "
+                         "files instead of searching each file for it. Only "
+                         "the names of the metrics are searched in the index, "
+                         "whereas the whole of each line is searched "
+                         "otherwise (see example.metrics_index)"))]
 
     def extract_metrics_pipeline(self, **name_maps):
         pipeline = self.new_pipeline(
@@ -45,29 +75,25 @@ class ToyAnalysis(Analysis, metaclass=AnalysisMetaClass):
             name_maps=name_maps,
             desc="Extract metrics from file")
 
-        grep = pipeline.add(
-            'grep',
-            Grep(
-                match_str=self.parameter('metric_of_interest')),
-            inputs={
-                'in_file': ('body_metrics', text_format)})
-
+        # Searches for the metric and selects its value in a single
+        # in-process node, so no intermediate files are written
         pipeline.add(
-            'awk',
-            Awk(
-                format_str='{print $2}'),
+            'grep_field',
+            GrepField(
+                match_str=self.parameter('metric_of_interest'),
+                field=2),
             inputs={
-                'in_file': (grep, 'out_file')},
+                'in_files': ('body_metrics', text_format)},
             outputs={
                 'selected_metric': ('out_file', text_format)})
 
         return pipeline
 
-    def statistics_pipeline(self, **name_maps):
+    def subject_statistics_pipeline(self, **name_maps):
         pipeline = self.new_pipeline(
-            name='statistics',
+            name='subject_statistics',
             name_maps=name_maps,
-            desc="Calculate statistics")
+            desc="Calculate partial statistics for each subject")
 
         merge_visits = pipeline.add(
             'merge_visits',
@@ -78,30 +104,95 @@ class ToyAnalysis(Analysis, metaclass=AnalysisMetaClass):
             joinsource=self.VISIT_ID,
             joinfield=['in1'])
 
-        merge_subjects = pipeline.add(
-            'merge_subjects',
-            Merge(
-                numinputs=1,
-                ravel_inputs=True),
-            inputs={
-                'in1': (merge_visits, 'out')},
-            joinsource=self.SUBJECT_ID,
-            joinfield=['in1'])
-
         concat = pipeline.add(
             'concat',
-            ConcatFloats(),
+            ConcatFloats(
+                return_array=False),
             inputs={
-                'in_files': (merge_subjects, 'out')})
+                'in_files': (merge_visits, 'out')})
 
+        # The values are passed as a memory-mapped .npy file rather than
+        # pickled as an array
         pipeline.add(
             'extract_metrics',
             ExtractMetrics(),
             inputs={
-                'in_list': (concat, 'out_list')},
+                'in_file': (concat, 'out_file')},
             outputs={
-                'average': ('avg', float),
-                'std_dev': ('std', float)})
+                'subject_statistics': ('out_partial', json_format)})
+
+        return pipeline
+
+    def statistics_pipeline(self, **name_maps):
+        pipeline = self.new_pipeline(
+            name='statistics',
+            name_maps=name_maps,
+            desc="Calculate statistics")
+
+        if self.branch('use_metrics_index'):
+            # Look up the metric from a columnar index of all the metrics in
+            # the body-metrics files. Only new or modified files are parsed,
+            # so switching the metric of interest doesn't search all the
+            # files again
+            merge_visits = pipeline.add(
+                'merge_visits',
+                Merge(
+                    numinputs=1),
+                inputs={
+                    'in1': ('body_metrics', text_format)},
+                joinsource=self.VISIT_ID,
+                joinfield=['in1'])
+
+            merge_subjects = pipeline.add(
+                'merge_subjects',
+                Merge(
+                    numinputs=1,
+                    ravel_inputs=True),
+                inputs={
+                    'in1': (merge_visits, 'out')},
+                joinsource=self.SUBJECT_ID,
+                joinfield=['in1'])
+
+            lookup = pipeline.add(
+                'lookup_metric',
+                LookupMetric(
+                    metric=self.parameter('metric_of_interest'),
+                    index_dir=op.join(self.processor.work_dir,
+                                      'metrics_index'),
+                    return_array=False),
+                inputs={
+                    'in_files': (merge_subjects, 'out')})
+
+            pipeline.add(
+                'extract_metrics',
+                ExtractMetrics(),
+                inputs={
+                    'in_file': (lookup, 'out_file')},
+                outputs={
+                    'average': ('avg', float),
+                    'std_dev': ('std', float)})
+        else:
+            merge_subjects = pipeline.add(
+                'merge_subjects',
+                Merge(
+                    numinputs=1),
+                inputs={
+                    'in1': ('subject_statistics', json_format)},
+                joinsource=self.SUBJECT_ID,
+                joinfield=['in1'])
+
+            # The partial statistics of each subject are merged exactly (see
+            # example.stats.RunningStats.merge), so only the subjects whose
+            # partials are new or have changed need to be reprocessed when
+            # the dataset grows
+            pipeline.add(
+                'merge_statistics',
+                ExtractMetrics(),
+                inputs={
+                    'in_partials': (merge_subjects, 'out')},
+                outputs={
+                    'average': ('avg', float),
+                    'std_dev': ('std', float)})
 
         return pipeline
 
@@ -117,19 +208,51 @@ class BasicBrainAnalysis(Analysis, metaclass=AnalysisMetaClass):
         OutputFilesetSpec('brain', nifti_gz_format,
                           'brain_extraction_pipeline',
                           desc="Skull-stripped magnitude image"),
-        FilesetSpec('brain_mask', nifti_gz_format,
+        # Intermediate derivatives that aren't outputs of the analysis are
+        # stored uncompressed, so they don't need to be gzipped when they are
+        # written or decompressed when they are read by other pipelines
+        FilesetSpec('brain_mask', nifti_format,
                     'brain_extraction_pipeline',
                     desc="Brain mask used for skull-stripping"),
+        FilesetSpec('brain_mask_compact', compact_mask_format,
+                    'compact_mask_pipeline',
+                    desc=("Brain mask stored as the bit-packed values within "
+                          "its bounding box")),
         OutputFilesetSpec('smooth', nifti_gz_format, 'smooth_mask_pipeline',
                           desc="Smoothed magnitude image"),
         OutputFilesetSpec('smooth_masked', nifti_gz_format,
                           'smooth_mask_pipeline',
-                          desc="Smoothed and masked magnitude image")]
+                          desc="Smoothed and masked magnitude image"),
+        OutputFilesetSpec('smoothing_sweep', smoothing_sweep_format,
+                          'smoothing_sweep_pipeline',
+                          desc=("Smoothed, and smoothed and masked, magnitude "
+                                "images for each of the kernels in the "
+                                "smoothing sweep. They are always smoothed "
+                                "in-process with NumPy/SciPy (i.e. as by the "
+                                "'numpy' smoothing tool), so with the default "
+                                "'fsl' tool they differ slightly from the "
+                                "'smooth' and 'smooth_masked' images of the "
+                                "same kernel (see "
+                                "scripts/test_smoothing.py)"))]
 
     add_param_specs = [
         ParamSpec('smoothing_fwhm', 4.0,
                   desc=("The full-width-half-maxium radius of the smoothing "
-                        "kernel"))]
+                        "kernel")),
+        SwitchSpec('smoothing_tool', 'fsl', ('fsl', 'numpy'),
+                   desc=("The tool used to smooth and mask the magnitude "
+                         "image, either with separate fslmaths calls or in a "
+                         "single in-process node with NumPy/SciPy (see "
+                         "scripts/test_smoothing.py for its comparison with "
+                         "fslmaths)")),
+        ParamSpec('smoothing_fwhm_sweep', [2.0, 4.0, 6.0],
+                  desc=("The full-width-half-maximums of the smoothing "
+                        "kernels in the smoothing sweep")),
+        SwitchSpec('use_compact_mask', False,
+                   desc=("Whether to mask the smoothed image with the compact "
+                         "brain mask, which only reads the voxels within the "
+                         "bounding box of the mask (only used by the 'numpy' "
+                         "smoothing tool)"))]
 
     def brain_extraction_pipeline(self, **name_maps):
 
@@ -139,22 +262,82 @@ class BasicBrainAnalysis(Analysis, metaclass=AnalysisMetaClass):
             name_maps=name_maps,
             citations=[fsl_cite])
 
-        pipeline.add(
+        # BET writes uncompressed images, and only the images that are
+        # outputs of the analysis are then compressed. Its outputs are reused
+        # from the derivative cache, if enabled, when the same image has been
+        # skull-stripped by another analysis (see example.derivative_cache)
+        bet = pipeline.add(
             'bet',
-            fsl.BET(
-                mask=True),
+            BET(
+                mask=True,
+                output_type='NIFTI'),
             inputs={
                 'in_file': ('magnitude', nifti_gz_format)},
             outputs={
-                'brain': ('out_file', nifti_gz_format),
-                'brain_mask': ('mask_file', nifti_gz_format)},
+                'brain_mask': ('mask_file', nifti_format)},
             requirements=[
                 fsl_req.v('5.0.10')])
 
+        pipeline.add(
+            'compress_brain',
+            Gzip(
+                num_threads=self.compression_threads()),
+            inputs={
+                'in_file': (bet, 'out_file')},
+            outputs={
+                'brain': ('out_file', nifti_gz_format)})
+
+        return pipeline
+
+    def compact_mask_pipeline(self, **name_maps):
+
+        pipeline = self.new_pipeline(
+            'compact_mask',
+            desc="Converts the brain mask into a compact mask",
+            name_maps=name_maps)
+
+        pipeline.add(
+            'compress_mask',
+            CompressMask(),
+            inputs={
+                'in_file': ('brain_mask', nifti_format)},
+            outputs={
+                'brain_mask_compact': ('out_file', compact_mask_format)})
+
         return pipeline
 
     def smooth_mask_pipeline(self, **name_maps):
 
+        if self.branch('smoothing_tool', 'numpy'):
+            if self.branch('use_compact_mask'):
+                mask = ('brain_mask_compact', compact_mask_format)
+            else:
+                mask = ('brain_mask', nifti_format)
+
+            pipeline = self.new_pipeline(
+                'smooth_mask',
+                desc="Smooths and masks a brain image",
+                name_maps=name_maps)
+
+            # Smoothing and masking in a single in-process node, so the
+            # magnitude image is only decompressed once and the smoothed image
+            # isn't read back from disk before it is masked. The node is
+            # named 'smooth' so its inputs can be modified in sub-classes in
+            # the same way as the FSL version
+            pipeline.add(
+                'smooth',
+                SmoothMask(
+                    fwhm=self.parameter('smoothing_fwhm'),
+                    num_threads=self.compression_threads()),
+                inputs={
+                    'in_file': ('magnitude', nifti_gz_format),
+                    'mask_file': mask},
+                outputs={
+                    'smooth': ('out_file', nifti_gz_format),
+                    'smooth_masked': ('masked_file', nifti_gz_format)})
+
+            return pipeline
+
         pipeline = self.new_pipeline(
             'smooth_mask',
             desc="Smooths and masks a brain image",
@@ -178,7 +361,7 @@ class BasicBrainAnalysis(Analysis, metaclass=AnalysisMetaClass):
             fsl.ApplyMask(),
             inputs={
                 'in_file': (smooth, 'out_file'),
-                'mask_file': ('brain_mask', nifti_gz_format)},
+                'mask_file': ('brain_mask', nifti_format)},
             outputs={
                 'smooth_masked': ('out_file', nifti_gz_format)},
             requirements=[
@@ -186,30 +369,112 @@ class BasicBrainAnalysis(Analysis, metaclass=AnalysisMetaClass):
 
         return pipeline
 
-    def plot_comparision(self, figsize=(12, 4)):
-
-        for subj_i in self.subject_ids:
-            for visit_i in self.visit_ids:
-                f = plt.figure(figsize=figsize)
-                f.suptitle('Subject "{}" - Visit "{}"'.format(subj_i, visit_i))
-                for i, spec_name in enumerate(['magnitude', 'smooth',
-                                               'brain_mask', 'smooth_masked']):
-                    f.add_subplot(1, 4, i + 1)
-                    self._plot_slice(spec_name, subj_i, visit_i)
-                    plt.title(spec_name)
-        plt.show()
+    def smoothing_sweep_pipeline(self, **name_maps):
 
-    def _plot_slice(self, spec_name, subject_id=None, visit_id=None):
-        # Load the image
-        data = self.data(spec_name, derive=True).item(
-            subject_id=subject_id, visit_id=visit_id).get_array()
+        if self.branch('use_compact_mask'):
+            mask = ('brain_mask_compact', compact_mask_format)
+        else:
+            mask = ('brain_mask', nifti_format)
 
-        # Cut in the middle of the brain
-        cut = int(data.shape[-1] / 2) + 10
+        pipeline = self.new_pipeline(
+            'smoothing_sweep',
+            desc=("Smooths and masks a brain image with each of a range of "
+                  "smoothing kernels"),
+            name_maps=name_maps)
+
+        # All the kernels are applied in a single node, so the magnitude
+        # image and mask are only decompressed once instead of once per
+        # analysis run with a different 'smoothing_fwhm'. The sweep always
+        # uses the in-process smoother, whatever the 'smoothing_tool'
+        pipeline.add(
+            'sweep',
+            SmoothMaskSweep(
+                fwhms=self.parameter('smoothing_fwhm_sweep'),
+                num_threads=self.compression_threads()),
+            inputs={
+                'in_file': ('magnitude', nifti_gz_format),
+                'mask_file': mask},
+            outputs={
+                'smoothing_sweep': ('out_dir', smoothing_sweep_format)})
 
-        # Plot the data
-        plt.imshow(np.rot90(data[..., cut]), cmap="gray")
-        plt.gca().set_axis_off()
+        return pipeline
+
+    def compression_threads(self):
+        """
+        The number of threads used to compress the output images, i.e. the
+        number of processors available to the process, capped at the number
+        of processes of the processor (for MultiProc). As 'num_threads' also
+        sets the 'n_procs' of the nodes, MultiProc reserves the threads for
+        them (and PackingMultiProc shares the free processors between them
+        when several are ready, see example.scheduler)
+        """
+        try:
+            num_cpus = len(os.sched_getaffinity(0))
+        except AttributeError:  # Not available on macOS
+            num_cpus = os.cpu_count() or 1
+        num_processes = getattr(self.processor, 'num_processes', None)
+        if num_processes:
+            num_cpus = min(num_cpus, num_processes)
+        return max(num_cpus, 1)
+
+    def plot_comparision(self, figsize=(12, 4), num_workers=4,
+                         cache_dir=None, out_dir=None):
+        """
+        Plots a slice of the magnitude, smoothed, brain mask and smoothed and
+        masked images of each session side by side.
+
+        Only the plotted slice of each image is read, in parallel threads, and
+        the slices are cached by the digest of the image files so they are
+        only decoded once.
+
+        Parameters
+        ----------
+        figsize : tuple[float]
+            The size of the figure for each session
+        num_workers : int
+            The number of threads to load the slices with (and processes to
+            render the figures with if `out_dir` is provided)
+        cache_dir : str | None
+            The directory to cache the slices in. Defaults to a 'thumbnails'
+            sub-directory of the processor's work directory
+        out_dir : str | None
+            If provided, the figures are rendered to PNG files in this
+            directory in parallel processes instead of being shown
+        """
+        spec_names = ['magnitude', 'smooth', 'brain_mask', 'smooth_masked']
+        if cache_dir is None:
+            cache_dir = op.join(self.processor.work_dir, 'thumbnails')
+        # Derive all the images up front instead of each time one is plotted
+        collections = [self.data(n, derive=True) for n in spec_names]
+        sessions = [(s, v) for s in self.subject_ids for v in self.visit_ids]
+        paths = [collection.item(subject_id=s, visit_id=v).path
+                 for s, v in sessions for collection in collections]
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            slices = list(executor.map(
+                partial(cached_slice, cache_dir=cache_dir), paths))
+        num_specs = len(spec_names)
+        session_slices = [slices[i:i + num_specs]
+                          for i in range(0, len(slices), num_specs)]
+        titles = ['Subject "{}" - Visit "{}"'.format(s, v)
+                  for s, v in sessions]
+        if out_dir is not None:
+            os.makedirs(out_dir, exist_ok=True)
+            out_paths = [op.join(out_dir, 'sub-{}_ses-{}.png'.format(s, v))
+                         for s, v in sessions]
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                return list(executor.map(
+                    partial(render_comparison, titles=spec_names,
+                            figsize=figsize),
+                    session_slices, titles, out_paths))
+        for title, slices in zip(titles, session_slices):
+            f = plt.figure(figsize=figsize)
+            f.suptitle(title)
+            for i, (spec_name, data) in enumerate(zip(spec_names, slices)):
+                f.add_subplot(1, num_specs, i + 1)
+                plt.imshow(data, cmap="gray")
+                plt.gca().set_axis_off()
+                plt.title(spec_name)
+        plt.show()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,38 @@
+import os
+import numpy
+from nipype.interfaces.base import File
+
+
+class ArrayFile(File):
+    """
+    A NumPy array saved in .npy format, which is used to pass arrays between
+    nodes instead of array-valued traits. Only the path is stored in the
+    node's result file and the array is memory-mapped by the receiving node
+    (see `load_array`), so it isn't pickled, unpickled or copied. The path is
+    also hashed like any other file (i.e. by timestamp or content depending on
+    the 'hash_method' execution setting) rather than by the repr of the
+    array, which NumPy truncates for large arrays.
+    """
+
+    def __init__(self, exists=True, **metadata):
+        super().__init__(exists=exists, extensions=['.npy'], **metadata)
+
+
+def save_array(array, path):
+    """
+    Saves an array in .npy format, writing it to a temporary file first so
+    that nodes memory-mapping the path never see a partially written array
+    """
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        numpy.save(f, numpy.asarray(array))
+    os.replace(tmp_path, path)
+    return path
+
+
+def load_array(path):
+    """
+    Memory-maps a saved array, so its data is only read from the page cache
+    as it is accessed
+    """
+    return numpy.load(path, mmap_mode='r')
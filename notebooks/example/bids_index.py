@@ -0,0 +1,240 @@
+import os
+import os.path as op
+import re
+import json
+import hashlib
+from fnmatch import fnmatchcase
+from glob import has_magic
+
+
+DEFAULT_INDEX_CACHE_DIR = op.join(op.expanduser('~'), '.cache', 'example',
+                                  'bids_index')
+
+BIDS_ENTITY_RE = re.compile(r'([a-zA-Z0-9]+)-([a-zA-Z0-9]+)')
+
+
+class BIDSIndex(object):
+    """
+    A persisted index of the files in a dataset directory tree (e.g. a BIDS
+    dataset), which is used to find files instead of listing the directories
+    of the tree each time, which can take minutes for large trees on network
+    file systems.
+
+    The index stores the listing of each directory along with its
+    modification time, and is validated against the modification times of the
+    directories (only) when it is used, so only the directories that have
+    changed are listed again. Lookups can be restricted to a sub-tree (e.g.
+    the directory of a subject) so only that sub-tree is validated.
+
+    The files are also indexed by their BIDS entities (e.g. 'sub', 'ses' and
+    'suffix'), so the files of a subject can be looked up directly.
+
+    Parameters
+    ----------
+    root : str
+        The root directory of the dataset
+    index_dir : str | None
+        The directory the index is stored in. Defaults to a sub-directory of
+        ~/.cache/example/bids_index named after the digest of the path to the
+        root
+    """
+
+    INDEX_FNAME = 'index.json'
+
+    def __init__(self, root, index_dir=None):
+        self.root = op.abspath(root)
+        if index_dir is None:
+            index_dir = op.join(DEFAULT_INDEX_CACHE_DIR, hashlib.sha1(
+                self.root.encode()).hexdigest())
+        self.index_dir = index_dir
+        try:
+            with open(op.join(index_dir, self.INDEX_FNAME)) as f:
+                index = json.load(f)
+        except (IOError, ValueError):
+            index = {}
+        self._dirs = index.get('dirs', {}) if index.get(
+            'root') == self.root else {}
+        self._paths = None
+        self._entities = None
+
+    def update(self, rel_dir=''):
+        """
+        Updates the index of a sub-tree of the dataset (the whole dataset by
+        default), only listing the directories that have been modified since
+        they were indexed, and saves the index if it has changed
+
+        Parameters
+        ----------
+        rel_dir : str
+            The sub-tree to update, relative to the root
+
+        Returns
+        -------
+        num_listed : int
+            The number of directories that were (re)listed
+        """
+        num_listed = 0
+        stack = [rel_dir.strip(os.sep)]
+        while stack:
+            dir_path = stack.pop()
+            try:
+                mtime = os.stat(op.join(self.root, dir_path)).st_mtime_ns
+            except OSError:
+                num_listed += self._remove(dir_path)
+                continue
+            entry = self._dirs.get(dir_path)
+            if entry is None or entry['mtime'] != mtime:
+                files, subdirs = [], []
+                for dir_entry in os.scandir(op.join(self.root, dir_path)):
+                    (subdirs if dir_entry.is_dir() else files).append(
+                        dir_entry.name)
+                if entry is not None:
+                    # Remove sub-directories that no longer exist
+                    for subdir in set(entry['dirs']) - set(subdirs):
+                        self._remove(op.join(dir_path, subdir))
+                entry = self._dirs[dir_path] = {
+                    'mtime': mtime, 'files': sorted(files),
+                    'dirs': sorted(subdirs)}
+                num_listed += 1
+            stack.extend(op.join(dir_path, d) for d in entry['dirs'])
+        if num_listed:
+            self._paths = self._entities = None
+            self.save()
+        return num_listed
+
+    def save(self):
+        os.makedirs(self.index_dir, exist_ok=True)
+        index_path = op.join(self.index_dir, self.INDEX_FNAME)
+        # Write to a temporary file first so that concurrent nodes loading the
+        # index never see a partially written one
+        tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump({'root': self.root, 'dirs': self._dirs}, f)
+        os.replace(tmp_path, index_path)
+
+    @property
+    def paths(self):
+        """The set of paths of the files in the index relative to the root"""
+        if self._paths is None:
+            self._paths = {op.join(d, f) for d, e in self._dirs.items()
+                           for f in e['files']}
+        return self._paths
+
+    def glob(self, pattern, validate=True):
+        """
+        Finds the files and directories (or only the directories, if the
+        pattern ends in a separator) matching a glob pattern, in the same way
+        as `glob.glob`
+
+        Parameters
+        ----------
+        pattern : str
+            The pattern, either absolute (within the root) or relative to the
+            root
+        validate : bool
+            Whether to update the index of the sub-tree that could match the
+            pattern first (see `update`)
+
+        Returns
+        -------
+        paths : list[str]
+            The absolute paths of the matching files and directories
+        """
+        find_dirs = pattern.endswith(os.sep)
+        rel_pattern = op.relpath(op.join(self.root, pattern), self.root)
+        if rel_pattern.startswith(os.pardir):
+            raise ValueError("{} is outside of the indexed dataset {}"
+                             .format(pattern, self.root))
+        parts = rel_pattern.split(os.sep)
+        # The deepest directory before the first component with wildcards
+        num_literal = next((i for i, p in enumerate(parts) if has_magic(p)),
+                           len(parts))
+        prefix = op.join('', *parts[:min(num_literal, len(parts) - 1)])
+        if validate:
+            self.update(prefix)
+        if num_literal == len(parts):
+            # No wildcards, so the path can be looked up directly
+            candidates = [rel_pattern] if (
+                rel_pattern in self._dirs
+                or (not find_dirs and rel_pattern in self.paths)) else []
+        else:
+            # Like glob, match directories as well as files unless the
+            # pattern ends in a separator
+            candidates = (p for d, e in self._dirs.items()
+                          if not prefix or d == prefix
+                          or d.startswith(prefix + os.sep)
+                          for p in ([d] if d else []) + (
+                              [] if find_dirs else
+                              [op.join(d, f) for f in e['files']]))
+        return [op.join(self.root, p) + (os.sep if find_dirs else '')
+                for p in candidates if _match_parts(p.split(os.sep), parts)]
+
+    def query(self, **entities):
+        """
+        Finds the files with the given BIDS entities, e.g.
+        `index.query(sub='01', suffix='T1w')`, without validating the index
+
+        Returns
+        -------
+        paths : list[str]
+            The absolute paths of the matching files
+        """
+        if self._entities is None:
+            self._entities = {}
+            for path in self.paths:
+                for item in parse_entities(path).items():
+                    self._entities.setdefault(item, set()).add(path)
+        matches = sorted((self._entities.get(i, set())
+                          for i in entities.items()), key=len)
+        if not matches:
+            return sorted(op.join(self.root, p) for p in self.paths)
+        return sorted(op.join(self.root, p)
+                      for p in matches[0].intersection(*matches[1:]))
+
+    def filter(self, regex, **entities):
+        """
+        Finds the files with names (without extensions) that match a regular
+        expression, as for Arcana's FilesetFilter, e.g.
+        `index.filter('.*T1w$', sub='01')`, optionally restricting the files
+        to those with the given BIDS entities (see `query`)
+        """
+        regex = re.compile(regex)
+        return [p for p in self.query(**entities)
+                if regex.match(op.basename(p).split('.', 1)[0])]
+
+    def _remove(self, dir_path):
+        removed = [d for d in self._dirs
+                   if d == dir_path or d.startswith(dir_path + os.sep)]
+        for d in removed:
+            del self._dirs[d]
+        return len(removed)
+
+
+def parse_entities(path):
+    """
+    Parses the BIDS entities from the name of a file, e.g.
+    'sub-01/ses-test/anat/sub-01_ses-test_T1w.nii.gz' ->
+    {'sub': '01', 'ses': 'test', 'datatype': 'anat', 'suffix': 'T1w',
+     'extension': '.nii.gz'}
+    """
+    dir_path, fname = op.split(path)
+    name, dot, ext = fname.partition('.')
+    parts = name.split('_')
+    entities = dict(m.groups() for m in map(BIDS_ENTITY_RE.fullmatch, parts)
+                    if m)
+    if len(parts) > 1 and not BIDS_ENTITY_RE.fullmatch(parts[-1]):
+        entities['suffix'] = parts[-1]
+    if dir_path:
+        entities['datatype'] = op.basename(dir_path)
+    entities['extension'] = dot + ext
+    return entities
+
+
+def _match_parts(path_parts, pattern_parts):
+    # Match each component separately, as wildcards don't match separators in
+    # glob, and don't match hidden files unless the pattern starts with a dot
+    if len(path_parts) != len(pattern_parts):
+        return False
+    return all(fnmatchcase(p, pat) and (pat.startswith('.')
+                                        or not p.startswith('.'))
+               for p, pat in zip(path_parts, pattern_parts))
@@ -0,0 +1,125 @@
+import numpy
+import nibabel as nb
+
+
+class CompactMask(object):
+    """
+    A compact representation of a binary mask, consisting of the bounding box
+    of the mask and the bit-packed values within it, along with the shape and
+    affine of the full image so the mask can be expanded again.
+
+    Masking and statistics operations only need to touch the voxels within
+    the bounding box, which for a brain mask is typically less than half of
+    the field of view.
+
+    Parameters
+    ----------
+    bbox_offset : tuple[int]
+        The index of the first voxel of the bounding box in the full image
+    bbox_mask : numpy.ndarray
+        The (boolean) mask values within the bounding box
+    shape : tuple[int]
+        The shape of the full image
+    affine : numpy.ndarray
+        The affine of the full image
+    """
+
+    def __init__(self, bbox_offset, bbox_mask, shape, affine):
+        self.bbox_offset = tuple(int(i) for i in bbox_offset)
+        self.bbox_mask = numpy.asarray(bbox_mask, dtype=bool)
+        self.shape = tuple(int(i) for i in shape)
+        self.affine = numpy.asarray(affine)
+
+    @classmethod
+    def from_array(cls, mask, affine):
+        mask = numpy.asarray(mask) != 0
+        nonzero = numpy.nonzero(mask)
+        if not len(nonzero[0]):
+            return cls((0,) * mask.ndim, numpy.zeros((0,) * mask.ndim),
+                       mask.shape, affine)
+        start = [int(i.min()) for i in nonzero]
+        stop = [int(i.max()) + 1 for i in nonzero]
+        bbox = tuple(slice(a, b) for a, b in zip(start, stop))
+        return cls(start, mask[bbox], mask.shape, affine)
+
+    @classmethod
+    def from_nifti(cls, path):
+        img = nb.load(path)
+        return cls.from_array(numpy.asanyarray(img.dataobj), img.affine)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads a compact mask saved in .npz format, or creates one from a
+        NIfTI mask image
+        """
+        if not path.endswith('.npz'):
+            return cls.from_nifti(path)
+        with numpy.load(path) as f:
+            bbox_shape = tuple(f['bbox_shape'])
+            bbox_mask = numpy.unpackbits(
+                f['bits'], count=int(numpy.prod(bbox_shape))).reshape(
+                    bbox_shape)
+            return cls(f['bbox_offset'], bbox_mask, f['shape'], f['affine'])
+
+    def save(self, path):
+        numpy.savez_compressed(path, bbox_offset=self.bbox_offset,
+                               bbox_shape=self.bbox_mask.shape,
+                               bits=numpy.packbits(self.bbox_mask.ravel()),
+                               shape=self.shape, affine=self.affine)
+        return path
+
+    @property
+    def bbox(self):
+        """Slices that select the bounding box from the full image"""
+        return tuple(slice(o, o + s) for o, s in zip(self.bbox_offset,
+                                                     self.bbox_mask.shape))
+
+    @property
+    def num_voxels(self):
+        return int(numpy.prod(self.shape))
+
+    def to_array(self):
+        mask = numpy.zeros(self.shape, dtype=bool)
+        mask[self.bbox] = self.bbox_mask
+        return mask
+
+    def check_shape(self, shape, image_name='image'):
+        """
+        Checks that the spatial dimensions of an image (i.e. all dimensions
+        of the mask) match those of the mask
+
+        Raises
+        ------
+        ValueError
+            If the shapes don't match
+        """
+        if tuple(shape[:len(self.shape)]) != self.shape:
+            raise ValueError(
+                "Shape of {} {} doesn't match that of the mask {}".format(
+                    image_name, tuple(shape), self.shape))
+
+    def _expand(self, bbox_data):
+        # Broadcast the mask over any trailing (e.g. time) dimensions
+        return self.bbox_mask.reshape(
+            self.bbox_mask.shape + (1,) * (bbox_data.ndim
+                                           - self.bbox_mask.ndim))
+
+    def apply(self, data):
+        """
+        Masks an image, only reading the voxels within the bounding box of
+        the mask (voxels outside of it are set to zero)
+        """
+        self.check_shape(data.shape)
+        masked = numpy.zeros(data.shape, dtype=data.dtype)
+        bbox_data = numpy.asarray(data[self.bbox])
+        masked[self.bbox] = bbox_data * self._expand(bbox_data)
+        return masked
+
+    def masked_values(self, data):
+        """
+        Returns the values of the voxels within the mask, only reading the
+        voxels within the bounding box of the mask
+        """
+        self.check_shape(data.shape)
+        return numpy.asarray(data[self.bbox])[self.bbox_mask]
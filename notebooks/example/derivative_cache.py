@@ -0,0 +1,320 @@
+import os
+import os.path as op
+import json
+import shutil
+import hashlib
+import functools
+from contextlib import contextmanager
+from nipype.interfaces.base import isdefined, Undefined
+from example.utils import file_digest
+from example.transfer import transfer_file
+
+
+CACHE_DIR_ENV = 'EXAMPLE_CACHE_DIR'
+CACHE_MAX_SIZE_ENV = 'EXAMPLE_CACHE_MAX_SIZE'
+
+DEFAULT_MAX_SIZE = 20 * 1024 ** 3
+
+
+class DerivativeCache(object):
+    """
+    A content-addressed cache of the outputs of Nipype interfaces, shared
+    between analyses (and their work directories) so that an interface that
+    has already been run with the same inputs, e.g. BET on the same magnitude
+    image in two analyses with different names, isn't run again.
+
+    Entries are keyed on the interface class, its version, and the values of
+    its inputs, with the files passed as inputs hashed by their contents
+    rather than their paths. Output files are cloned into the cache and back
+    out of it into the working directory of the next node that uses the entry
+    (see example.transfer.transfer_file), which doesn't copy any data on file
+    systems that support reflinks (e.g. Btrfs and XFS) and falls back to a
+    copy otherwise. They aren't hard-linked, as the working files would then
+    share their data with the cache entry (and with any sinks they are
+    hard-linked into, see example.interfaces.LinkingDataSink), so modifying
+    any of them in place would corrupt the entry for all later uses.
+
+    The least recently used entries are removed when the total size of the
+    cache exceeds `max_size`.
+
+    Parameters
+    ----------
+    cache_dir : str
+        The directory the cache is stored in
+    max_size : int
+        The maximum total size of the files in the cache in bytes
+    """
+
+    OUTPUTS_FNAME = 'outputs.json'
+    FILES_DIR = 'files'
+
+    def __init__(self, cache_dir, max_size=DEFAULT_MAX_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_env(cls):
+        """
+        Returns the cache set by the EXAMPLE_CACHE_DIR environment variable
+        (see `derivative_cache`), or None if it isn't set
+        """
+        cache_dir = os.environ.get(CACHE_DIR_ENV)
+        if not cache_dir:
+            return None
+        return cls(cache_dir, max_size=int(os.environ.get(
+            CACHE_MAX_SIZE_ENV, DEFAULT_MAX_SIZE)))
+
+    def key(self, interface):
+        """
+        The digest of the interface class, its implementation version (see
+        CachedInterfaceMixin), the version of the tool it wraps and the values
+        of its (hashed) inputs
+        """
+        inputs = {}
+        for name, value in interface.inputs.get_traitsfree().items():
+            if not isdefined(value) or interface.inputs.trait(name).nohash:
+                continue
+            inputs[name] = _hash_value(value)
+        cls = type(interface)
+        provenance = {
+            'interface': '{}.{}'.format(cls.__module__, cls.__name__),
+            'cache_version': interface.cache_version,
+            'version': interface.version,
+            'inputs': inputs}
+        return hashlib.sha1(json.dumps(provenance, sort_keys=True,
+                                       default=str).encode()).hexdigest()
+
+    def fetch(self, key, out_dir):
+        """
+        Clones the files of a cached entry into `out_dir` and returns its
+        outputs (with paths within `out_dir`), or None if there is no entry
+        for the key
+        """
+        entry_dir = op.join(self.cache_dir, key)
+        outputs_path = op.join(entry_dir, self.OUTPUTS_FNAME)
+        try:
+            with open(outputs_path) as f:
+                outputs = json.load(f)
+        except (IOError, ValueError):
+            return None
+        files_dir = op.join(entry_dir, self.FILES_DIR)
+        for rel_path in _walk_files(files_dir):
+            _clone(op.join(files_dir, rel_path), op.join(out_dir, rel_path))
+        # Record the access for the least-recently-used eviction
+        os.utime(outputs_path)
+        return {n: _decode(v, out_dir) for n, v in outputs.items()}
+
+    def store(self, key, outputs, out_dir):
+        """
+        Adds the outputs of an interface run in `out_dir` to the cache. The
+        outputs aren't cached if they refer to files outside of `out_dir` or
+        contain values that can't be saved to JSON
+
+        Returns
+        -------
+        stored : bool
+            Whether the outputs were added to the cache
+        """
+        entry_dir = op.join(self.cache_dir, key)
+        if op.exists(entry_dir):
+            return True
+        paths = []
+        try:
+            encoded = {n: _encode(v, op.realpath(out_dir), paths)
+                       for n, v in outputs.items()}
+            json.dumps(encoded)
+        except (ValueError, TypeError):
+            return False
+        # Build the entry in a temporary directory and move it into place, so
+        # concurrent nodes never see a partial entry
+        tmp_dir = op.join(self.cache_dir,
+                          '.tmp-{}-{}'.format(key, os.getpid()))
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        files_dir = op.join(tmp_dir, self.FILES_DIR)
+        os.makedirs(files_dir)
+        for rel_path in paths:
+            src = op.join(out_dir, rel_path)
+            if op.isdir(src):
+                for sub_path in _walk_files(src):
+                    _clone(op.join(src, sub_path),
+                          op.join(files_dir, rel_path, sub_path))
+            else:
+                _clone(src, op.join(files_dir, rel_path))
+        with open(op.join(tmp_dir, self.OUTPUTS_FNAME), 'w') as f:
+            json.dump(encoded, f)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another node has stored the same entry in the meantime
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+        return True
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache is no larger
+        than its maximum size
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            outputs_path = op.join(self.cache_dir, key, self.OUTPUTS_FNAME)
+            try:
+                last_used = op.getmtime(outputs_path)
+            except OSError:
+                continue  # Temporary directory of an entry being stored
+            entries.append((last_used, key, _dir_size(
+                op.join(self.cache_dir, key))))
+        total_size = sum(e[2] for e in entries)
+        for _, key, size in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(op.join(self.cache_dir, key), ignore_errors=True)
+            total_size -= size
+
+
+class CachedInterfaceMixin(object):
+    """
+    Mixin for Nipype interfaces that reuses their outputs from the derivative
+    cache (see DerivativeCache) when caching is enabled (see
+    `derivative_cache`), e.g.
+
+        class BET(CachedInterfaceMixin, fsl.BET):
+
+            cache_version = '1'
+
+    Each interface it is mixed into must set 'cache_version', which is part
+    of the cache key and must be changed whenever the outputs the interface
+    produces for the same inputs change (e.g. when its algorithm is fixed),
+    so that outputs cached by the previous implementation aren't reused. The
+    'version' of the tool an interface wraps (e.g. the FSL version) is also
+    part of the key, but is None for in-process interfaces.
+
+    As for ProfiledInterfaceMixin, the methods of each class it is mixed into
+    are wrapped, whether they are defined by the class itself or inherited
+    """
+
+    cache_version = None
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if cls.cache_version is None:
+            raise TypeError(
+                "Cached interface {} doesn't set 'cache_version'".format(
+                    cls.__name__))
+        if not getattr(cls._run_interface, 'cached', False):
+            cls._run_interface = _cached_run_interface(cls._run_interface)
+        if not getattr(cls._list_outputs, 'cached', False):
+            cls._list_outputs = _cached_list_outputs(cls._list_outputs)
+
+
+def _cached_run_interface(run_interface):
+
+    @functools.wraps(run_interface)
+    def wrapper(self, runtime):
+        self._cached_outputs = None
+        cache = DerivativeCache.from_env()
+        if cache is None:
+            return run_interface(self, runtime)
+        key = cache.key(self)
+        self._cached_outputs = cache.fetch(key, os.getcwd())
+        if self._cached_outputs is not None:
+            return runtime
+        runtime = run_interface(self, runtime)
+        cache.store(key, self._list_outputs(), os.getcwd())
+        return runtime
+
+    wrapper.cached = True
+    return wrapper
+
+
+def _cached_list_outputs(list_outputs):
+
+    @functools.wraps(list_outputs)
+    def wrapper(self):
+        if getattr(self, '_cached_outputs', None) is not None:
+            return dict(self._cached_outputs)
+        return list_outputs(self)
+
+    wrapper.cached = True
+    return wrapper
+
+
+@contextmanager
+def derivative_cache(cache_dir, max_size=DEFAULT_MAX_SIZE):
+    """
+    Enables the derivative cache for all cached interfaces run within the
+    context, e.g.
+
+        with derivative_cache('/scratch/derivative-cache'):
+            analysis.data('brain', derive=True)
+
+    The cache can also be enabled for a whole session by setting the
+    EXAMPLE_CACHE_DIR (and optionally EXAMPLE_CACHE_MAX_SIZE) environment
+    variables
+    """
+    prev = {n: os.environ.get(n) for n in (CACHE_DIR_ENV, CACHE_MAX_SIZE_ENV)}
+    os.environ[CACHE_DIR_ENV] = cache_dir
+    os.environ[CACHE_MAX_SIZE_ENV] = str(max_size)
+    try:
+        yield DerivativeCache(cache_dir, max_size=max_size)
+    finally:
+        for name, value in prev.items():
+            if value is None:
+                del os.environ[name]
+            else:
+                os.environ[name] = value
+
+
+def _hash_value(value):
+    if isinstance(value, (list, tuple)):
+        return [_hash_value(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _hash_value(v) for k, v in value.items()}
+    if isinstance(value, str) and op.isfile(value):
+        return {'sha1': file_digest(value)}
+    if isinstance(value, str) and op.isdir(value):
+        return {'sha1': {p: file_digest(op.join(value, p))
+                         for p in _walk_files(value)}}
+    return value
+
+
+def _encode(value, out_dir, paths):
+    if isinstance(value, (list, tuple)):
+        return [_encode(v, out_dir, paths) for v in value]
+    if isinstance(value, str) and op.exists(value):
+        rel_path = op.relpath(op.realpath(value), out_dir)
+        if rel_path.startswith(os.pardir):
+            raise ValueError("{} is outside of {}".format(value, out_dir))
+        paths.append(rel_path)
+        return {'path': rel_path}
+    if isinstance(value, dict):
+        raise TypeError("Dictionary outputs can't be cached")
+    if not isdefined(value):
+        return {'undefined': True}
+    return value
+
+
+def _decode(value, out_dir):
+    if isinstance(value, list):
+        return [_decode(v, out_dir) for v in value]
+    if isinstance(value, dict):
+        if 'path' in value:
+            return op.join(out_dir, value['path'])
+        return Undefined
+    return value
+
+
+def _walk_files(dir_path):
+    for root, _, fnames in os.walk(dir_path):
+        for fname in fnames:
+            yield op.relpath(op.join(root, fname), dir_path)
+
+
+def _clone(src, dst):
+    os.makedirs(op.dirname(dst), exist_ok=True)
+    transfer_file(src, dst, mode='reflink')
+
+
+def _dir_size(dir_path):
+    return sum(op.getsize(op.join(dir_path, p)) for p in _walk_files(dir_path))
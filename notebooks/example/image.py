@@ -0,0 +1,188 @@
+import os
+import os.path as op
+import numpy
+import nibabel as nb
+from nibabel.openers import ImageOpener
+from scipy.ndimage import gaussian_filter1d
+from example.parallel_gzip import save_nifti
+from example.utils import file_digest
+
+
+# Ratio between the standard deviation and the full-width-half-maximum of a
+# Gaussian, i.e. 1 / (2 * sqrt(2 * ln(2)))
+FWHM_TO_SIGMA = 1.0 / (2.0 * numpy.sqrt(2.0 * numpy.log(2.0)))
+
+
+DEFAULT_TEMPLATE_CACHE_DIR = op.join(op.expanduser('~'), '.cache', 'example',
+                                     'templates')
+
+
+def fwhm_to_sigma(fwhm):
+    return fwhm * FWHM_TO_SIGMA
+
+
+def gaussian_smooth(data, sigma, voxel_sizes, truncate=4.0):
+    """
+    Smooths the spatial (first three) dimensions of an image with an isotropic
+    Gaussian kernel, applied separably along each axis as by
+    'fslmaths -s <sigma>'. As for fslmaths, the kernel is renormalised by the
+    sum of its weights that fall within the field of view, so the intensities
+    aren't pulled towards zero at the edges of the image
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        The image data
+    sigma : float
+        The standard deviation of the kernel in mm
+    voxel_sizes : tuple[float]
+        The voxel sizes of the image in mm
+    truncate : float
+        The number of standard deviations at which the kernel is truncated
+
+    Returns
+    -------
+    smoothed : numpy.ndarray
+        The smoothed data (float32)
+    """
+    smoothed = numpy.asarray(data, dtype=numpy.float32)
+    for axis, voxel_size in enumerate(voxel_sizes[:3]):
+        smoothed = gaussian_filter1d(smoothed, sigma / voxel_size, axis=axis,
+                                     mode='constant', truncate=truncate,
+                                     output=numpy.float32)
+        # The sum of the weights within the field of view at each position
+        # along the axis, which is only less than one near its ends
+        weights = gaussian_filter1d(
+            numpy.ones(smoothed.shape[axis], dtype=numpy.float32),
+            sigma / voxel_size, mode='constant', truncate=truncate,
+            output=numpy.float32)
+        shape = [1] * smoothed.ndim
+        shape[axis] = -1
+        smoothed /= weights.reshape(shape)
+    return smoothed
+
+
+def like_image(data, ref_img, dtype=None):
+    """
+    Creates an image from the data with the same affine and header as the
+    reference image, converting the data back to the data type it is stored
+    as on disk (rounding to the nearest integer for integer types as FSL does)
+    unless another data type is provided
+    """
+    if dtype is None:
+        dtype = ref_img.get_data_dtype()
+    if numpy.issubdtype(dtype, numpy.integer):
+        info = numpy.iinfo(dtype)
+        data = numpy.clip(numpy.rint(data), info.min, info.max)
+    img = type(ref_img)(numpy.asarray(data, dtype=dtype), ref_img.affine,
+                        ref_img.header)
+    img.set_data_dtype(dtype)
+    return img
+
+
+def load_mask(path):
+    """Loads a mask image as a boolean array"""
+    return numpy.asanyarray(nb.load(path).dataobj) != 0
+
+
+def save_image(img, path, compress_level=6, num_threads=1):
+    """
+    Saves an image, compressing it with multiple threads if it is being saved
+    to a .nii.gz file
+    """
+    if path.endswith('.nii.gz') and num_threads > 1:
+        save_nifti(img, path, compress_level=compress_level,
+                   num_threads=num_threads)
+    else:
+        nb.save(img, path)
+    return path
+
+
+def iter_slabs(path, slab_size=8, z_range=None, scaled=True):
+    """
+    Iterates over the axial slabs of a NIfTI image, reading them sequentially
+    from the (possibly compressed) file so that only one slab is held in
+    memory at a time. NIfTI data is stored in Fortran order, so each slab is a
+    contiguous block of the file
+
+    Parameters
+    ----------
+    path : str
+        Path to the image
+    slab_size : int
+        The number of slices in each slab
+    z_range : tuple[int] | None
+        The range of slices to read, defaults to all slices
+    scaled : bool
+        Whether to apply the scaling in the header to the stored values
+
+    Yields
+    ------
+    z : int
+        The index of the first slice of the slab
+    slab : numpy.ndarray
+        The slab (of shape (nx, ny, <= slab_size)), scaled if `scaled` is
+        set. For images with more than three dimensions, the slabs of each
+        volume are returned in turn
+    """
+    img = nb.load(path)
+    dtype = img.get_data_dtype()
+    nx, ny, nz = img.shape[:3]
+    num_volumes = int(numpy.prod(img.shape[3:]))
+    z_start, z_stop = z_range if z_range is not None else (0, nz)
+    slice_bytes = nx * ny * dtype.itemsize
+    slope, inter = img.dataobj.slope, img.dataobj.inter
+    with ImageOpener(path) as f:
+        for volume in range(num_volumes):
+            f.seek(img.dataobj.offset + (volume * nz + z_start) * slice_bytes)
+            for z in range(z_start, z_stop, slab_size):
+                num_slices = min(slab_size, z_stop - z)
+                slab = numpy.frombuffer(
+                    f.read(num_slices * slice_bytes), dtype=dtype).reshape(
+                        (nx, ny, num_slices), order='F')
+                if scaled and (slope != 1.0 or inter != 0.0):
+                    slab = slab * slope + inter
+                yield z, slab
+
+
+def cached_template(path, cache_dir=DEFAULT_TEMPLATE_CACHE_DIR):
+    """
+    Returns an uncompressed, float32 copy of a template image from a cache
+    keyed by the digest of the template's contents, creating it if it isn't
+    already in the cache.
+
+    Registrations to the same template (e.g. of each subject in a study, and
+    by each stage of a staged registration) then read the same uncompressed
+    file, which is usually already in the page cache, instead of each
+    decompressing the template and converting it to floating point (as for
+    the '--float' option). ANTs still reads the whole template into the
+    memory of each registration, and computes its pyramid levels and
+    histograms in each of them, as antsRegistration can't be given
+    precomputed ones
+
+    Parameters
+    ----------
+    path : str
+        Path to the template
+    cache_dir : str
+        The directory the prepared templates are cached in
+
+    Returns
+    -------
+    cached_path : str
+        Path to the prepared template in the cache
+    """
+    cached_path = op.join(cache_dir, file_digest(path) + '_float32.nii')
+    if op.exists(cached_path):
+        return cached_path
+    os.makedirs(cache_dir, exist_ok=True)
+    img = nb.load(path)
+    prepared = like_image(img.get_fdata(dtype=numpy.float32), img,
+                          dtype=numpy.float32)
+    # Write to a temporary file first so registrations run concurrently never
+    # read a partially written template
+    tmp_path = op.join(cache_dir, '.tmp-{}-{}'.format(
+        os.getpid(), op.basename(cached_path)))
+    nb.save(prepared, tmp_path)
+    os.replace(tmp_path, cached_path)
+    return cached_path
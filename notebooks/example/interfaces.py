@@ -1,10 +1,44 @@
 import os
+import re
+import json
+import gzip
+import shutil
+from warnings import warn
 import os.path as op
+from concurrent.futures import ThreadPoolExecutor
 import numpy
+import nibabel as nb
+from nipype.utils.filemanip import (
+    split_filename, simplify_list, ensure_list)
+from nipype.utils.misc import human_order_sorted
+from nipype.interfaces import fsl
+from nipype.interfaces.io import (
+    SelectFiles, SelectFilesInputSpec, DataSink, DataSinkInputSpec,
+    DataSinkOutputSpec)
+from nipype import logging
 from nipype.interfaces.base import (
-    TraitedSpec, traits, File, isdefined,
+    TraitedSpec, traits, File, Directory, isdefined,
     CommandLineInputSpec, CommandLine, BaseInterface,
-    InputMultiPath)
+    BaseInterfaceInputSpec, InputMultiPath, OutputMultiPath,
+    OutputMultiObject)
+from example.stats import RunningStats
+from example.arrays import ArrayFile, save_array, load_array
+from example.metrics_index import MetricsIndex
+from example.profiling import ProfiledInterfaceMixin
+from example.derivative_cache import CachedInterfaceMixin
+from example.image import (
+    fwhm_to_sigma, gaussian_smooth, like_image, save_image, iter_slabs,
+    cached_template, DEFAULT_TEMPLATE_CACHE_DIR)
+from example.compact_mask import CompactMask
+from example.parallel_gzip import compress_file
+from example.utils import file_digest
+from example.bids_index import BIDSIndex
+from example.transfer import transfer_file, transfer_tree, TRANSFER_MODES
+
+
+COPY_BUFFER_SIZE = 1024 ** 2
+
+iflogger = logging.getLogger('nipype.interface')
 
 
 class GrepInputSpec(CommandLineInputSpec):
@@ -20,7 +54,7 @@ class GrepOutputSpec(TraitedSpec):
     out_file = File(exists=True, desc="The search results")
 
 
-class Grep(CommandLine):
+class Grep(ProfiledInterfaceMixin, CommandLine):
     """
     Wraps the common Unix utility 'grep' used for searching through plain
     text files
@@ -59,7 +93,7 @@ class AwkOutputSpec(TraitedSpec):
     out_file = File(exists=True, desc="The parsed results")
 
 
-class Awk(CommandLine):
+class Awk(ProfiledInterfaceMixin, CommandLine):
     """
     Wraps the common Unix utility 'awk' for text processing
     """
@@ -84,57 +118,892 @@ class Awk(CommandLine):
         return fname
 
 
+def batch_out_paths(in_files, basename):
+    """
+    Generates an output path in the working directory for each of the input
+    files of a batched interface. A single input keeps the plain basename
+    (e.g. 'search_results.txt') so the results match the shell versions.
+    """
+    if len(in_files) == 1:
+        return [op.join(os.getcwd(), basename + '.txt')]
+    return [op.join(os.getcwd(), '{}_{}.txt'.format(basename, i))
+            for i in range(len(in_files))]
+
+
+def select_field(line, field):
+    """
+    Selects a whitespace-separated field from a line using the same
+    conventions as awk, i.e. 1-based with 0 meaning the whole line and an
+    empty string returned for fields past the end of the line
+    """
+    if field == 0:
+        return line.rstrip('\n')
+    fields = line.split()
+    return fields[field - 1] if field <= len(fields) else ''
+
+
+class GrepFieldInputSpec(BaseInterfaceInputSpec):
+    match_str = traits.Str(mandatory=True,
+                           desc="The regular expression to search for")
+    field = traits.Int(
+        2, usedefault=True,
+        desc=("The whitespace-separated field to print from each matching "
+              "line, 1-based as in awk, 0 for the whole line"))
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc="The file(s) to search")
+
+
+class GrepFieldOutputSpec(TraitedSpec):
+    out_file = OutputMultiPath(File(exists=True),
+                               desc="The selected fields for each input file")
+
+
+class GrepField(ProfiledInterfaceMixin, BaseInterface):
+    """
+    An in-process equivalent of a Grep node followed by an Awk node, i.e.
+    "grep -e <match_str> <in_file> | awk '{print $<field>}'". The regular
+    expression is compiled once and a list of files can be searched in a
+    single call. Each file is streamed line by line and only the selected
+    fields are written to disk, so there is one working directory and one
+    output file per file instead of two of each
+    """
+
+    input_spec = GrepFieldInputSpec
+    output_spec = GrepFieldOutputSpec
+
+    def _run_interface(self, runtime):
+        regex = re.compile(self.inputs.match_str)
+        for in_path, out_path in zip(self.inputs.in_files,
+                                     self._out_paths()):
+            with open(in_path) as f:
+                selected = [select_field(l, self.inputs.field)
+                            for l in f if regex.search(l)]
+            if not selected:
+                raise ValueError("Did not find a match for '{}' in {}"
+                                 .format(self.inputs.match_str, in_path))
+            with open(out_path, 'w') as f:
+                f.writelines(l + '\n' for l in selected)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._out_paths()
+        return outputs
+
+    def _out_paths(self):
+        return batch_out_paths(self.inputs.in_files, 'selected_field')
+
+
+class LookupMetricInputSpec(BaseInterfaceInputSpec):
+    metric = traits.Str(
+        mandatory=True,
+        desc=("A regular expression matching the name of the metric, which is "
+              "searched for in the metric names as GrepField searches for "
+              "'match_str' in each line"))
+    in_files = InputMultiPath(File(exists=True), mandatory=True,
+                              desc="The body-metrics files")
+    index_dir = traits.Str(
+        mandatory=True, nohash=True,
+        desc="The directory the metrics index is stored in")
+    return_array = traits.Bool(
+        True, usedefault=True,
+        desc=("Whether to also return the values in 'out_array'. Set to "
+              "False when only 'out_file' is connected so the array isn't "
+              "pickled into the node's results"))
+
+
+class LookupMetricOutputSpec(TraitedSpec):
+    out_array = traits.Array(dtype=numpy.float64, shape=(None,),
+                             desc="The value of the metric in each file")
+    out_file = ArrayFile(desc="The value of the metric in each file")
+    num_parsed = traits.Int(
+        desc="The number of files that needed to be (re)parsed")
+
+
+class LookupMetric(ProfiledInterfaceMixin, BaseInterface):
+    """
+    Looks up a metric for each of the body-metrics files from a persistent,
+    columnar index of all their metrics (see example.metrics_index). Only
+    files that are new or have changed since they were indexed are parsed, so
+    looking up a series of different metrics only reads the files once. The
+    metric is matched in the same way as by GrepField, except that it is only
+    matched against the names of the metrics and not their values
+    """
+
+    input_spec = LookupMetricInputSpec
+    output_spec = LookupMetricOutputSpec
+
+    def _run_interface(self, runtime):
+        index = MetricsIndex(self.inputs.index_dir)
+        self._num_parsed = index.update(self.inputs.in_files)
+        self._values = index.lookup(self.inputs.metric, self.inputs.in_files)
+        save_array(self._values, self._gen_filename('out_file'))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        if self.inputs.return_array:
+            outputs['out_array'] = self._values
+        outputs['out_file'] = self._gen_filename('out_file')
+        outputs['num_parsed'] = self._num_parsed
+        return outputs
+
+    def _gen_filename(self, name):
+        if name == 'out_file':
+            fname = op.join(os.getcwd(), 'values.npy')
+        else:
+            assert False
+        return fname
+
+
 class ConcatFloatsInputSpec(TraitedSpec):
     in_files = InputMultiPath(desc='file name')
+    num_threads = traits.Int(
+        8, usedefault=True, nohash=True,
+        desc="The maximum number of threads used to read the input files")
+    return_array = traits.Bool(
+        True, usedefault=True,
+        desc=("Whether to also return the values in 'out_array' and "
+              "'out_list'. Set to False when only 'out_file' is connected so "
+              "the values aren't validated and pickled into the node's "
+              "results"))
 
 
 class ConcatFloatsOutputSpec(TraitedSpec):
+    out_array = traits.Array(dtype=numpy.float64, shape=(None,),
+                             desc='input floats')
     out_list = traits.List(traits.Float, desc='input floats')
+    out_file = ArrayFile(desc='input floats')
 
 
-class ConcatFloats(BaseInterface):
-    """Joins values from a list of files into a single list"""
+class ConcatFloats(ProfiledInterfaceMixin, BaseInterface):
+    """
+    Joins values from a list of files into a single array. The files are read
+    concurrently and written into a preallocated array, which avoids the
+    per-element validation that a traits.List(traits.Float) output requires
+    """
 
     input_spec = ConcatFloatsInputSpec
     output_spec = ConcatFloatsOutputSpec
 
+    def _run_interface(self, runtime):
+        in_files = self.inputs.in_files
+        values = numpy.empty(len(in_files), dtype=numpy.float64)
+
+        def read_value(i):
+            with open(in_files[i]) as f:
+                values[i] = float(f.read())
+
+        with ThreadPoolExecutor(
+                max_workers=max(min(self.inputs.num_threads,
+                                    len(in_files)), 1)) as executor:
+            # Consume the iterator so any exceptions are reraised here
+            list(executor.map(read_value, range(len(in_files))))
+        save_array(values, self._gen_filename('out_file'))
+        self._values = values
+        return runtime
+
     def _list_outputs(self):
-        out_list = []
-        for path in self.inputs.in_files:
-            with open(path) as f:
-                val = float(f.read())
-                out_list.append(val)
         outputs = self._outputs().get()
-        outputs['out_list'] = out_list
+        if self.inputs.return_array:
+            outputs['out_array'] = self._values
+            outputs['out_list'] = self._values.tolist()
+        outputs['out_file'] = self._gen_filename('out_file')
         return outputs
 
-    def _run_interface(self, runtime):
-        # Do nothing
-        return runtime
+    def _gen_filename(self, name):
+        if name == 'out_file':
+            fname = op.join(os.getcwd(), 'values.npy')
+        else:
+            assert False
+        return fname
 
 
 class ExtractMetricsInputSpec(TraitedSpec):
-    in_list = traits.List(traits.Float, desc='input floats')
+    in_list = traits.List(
+        traits.Float, desc='input floats',
+        xor=('in_list', 'in_array', 'in_file', 'in_partials'))
+    in_array = traits.Array(
+        dtype=numpy.float64, shape=(None,),
+        desc=("input floats. Note that arrays are hashed by their repr, "
+              "which is truncated for large arrays, so 'in_file' should be "
+              "used to pass large arrays"),
+        xor=('in_list', 'in_array', 'in_file', 'in_partials'))
+    in_file = ArrayFile(
+        desc='input floats',
+        xor=('in_list', 'in_array', 'in_file', 'in_partials'))
+    in_partials = InputMultiPath(
+        File(exists=True),
+        desc=("Partial statistics saved by previous ExtractMetrics nodes "
+              "(e.g. over separate groups of subjects) to be merged"),
+        xor=('in_list', 'in_array', 'in_file', 'in_partials'))
+    quantiles = traits.List(
+        traits.Range(low=0.0, high=1.0),
+        desc=("Quantiles to estimate from a sketch of the values. If "
+              "provided, the sketch is saved with the partial statistics"))
+    sketch_size = traits.Int(
+        200, usedefault=True,
+        desc="The maximum number of centroids in the quantile sketch")
+    chunk_size = traits.Int(
+        65536, usedefault=True, nohash=True,
+        desc="The number of values to read into memory at a time")
 
 
 class ExtractMetricsOutputSpec(TraitedSpec):
     std = traits.Float(desc="The standard deviation")
     avg = traits.Float(desc="The average")
+    count = traits.Int(desc="The number of values")
+    min = traits.Float(desc="The minimum value")
+    max = traits.Float(desc="The maximum value")
+    quantiles = traits.List(traits.Float,
+                            desc="Estimates of the requested quantiles")
+    out_partial = File(exists=True,
+                       desc=("The partial statistics, which can be merged "
+                             "with those of other groups of values"))
 
 
-class ExtractMetrics(BaseInterface):
-    """Joins values from a list of files into a single list"""
+class ExtractMetrics(ProfiledInterfaceMixin, BaseInterface):
+    """
+    Calculates summary statistics from a list of values using a streaming
+    accumulator (see example.stats.RunningStats), so the values are never all
+    held in memory at once. The accumulated state is saved to 'out_partial'
+    and can be merged exactly with the state from other groups of values by
+    passing both to 'in_partials'
+    """
 
     input_spec = ExtractMetricsInputSpec
     output_spec = ExtractMetricsOutputSpec
 
+    def _run_interface(self, runtime):
+        sketch_size = (self.inputs.sketch_size
+                       if isdefined(self.inputs.quantiles) else None)
+        stats = RunningStats(sketch_size=sketch_size)
+        if isdefined(self.inputs.in_partials):
+            for path in self.inputs.in_partials:
+                stats.merge(RunningStats.load(path))
+        else:
+            values = self._values()
+            for i in range(0, len(values), self.inputs.chunk_size):
+                stats.update(values[i:i + self.inputs.chunk_size])
+        stats.save(self._gen_filename('out_partial'))
+        self._stats = stats
+        return runtime
+
+    def _list_outputs(self):
+        stats = self._stats
+        outputs = self._outputs().get()
+        outputs['std'] = stats.std()
+        outputs['avg'] = stats.mean
+        outputs['count'] = stats.count
+        outputs['min'] = stats.min
+        outputs['max'] = stats.max
+        if isdefined(self.inputs.quantiles) and stats.sketch is not None:
+            outputs['quantiles'] = [stats.quantile(q)
+                                    for q in self.inputs.quantiles]
+        outputs['out_partial'] = self._gen_filename('out_partial')
+        return outputs
+
+    def _values(self):
+        if isdefined(self.inputs.in_file):
+            return load_array(self.inputs.in_file)
+        elif isdefined(self.inputs.in_array):
+            return self.inputs.in_array
+        return numpy.asarray(self.inputs.in_list, dtype=numpy.float64)
+
+    def _gen_filename(self, name):
+        if name == 'out_partial':
+            fname = op.join(os.getcwd(), 'partial_stats.json')
+        else:
+            assert False
+        return fname
+
+
+class SmoothMaskInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="The image to smooth")
+    mask_file = File(exists=True, mandatory=True,
+                     desc=("The mask to apply to the smoothed image, either a "
+                           "NIfTI image or a compact mask (see CompressMask)"))
+    fwhm = traits.Float(
+        mandatory=True, xor=['fwhm', 'sigma'],
+        desc="The full-width-half-maximum of the smoothing kernel in mm")
+    sigma = traits.Float(
+        mandatory=True, xor=['fwhm', 'sigma'],
+        desc="The standard deviation of the smoothing kernel in mm")
+    truncate = traits.Float(
+        4.0, usedefault=True,
+        desc=("The number of standard deviations at which the kernel is "
+              "truncated"))
+    num_threads = traits.Int(
+        1, usedefault=True, nohash=True,
+        desc="The number of threads used to compress the output images")
+
+
+class SmoothMaskOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The smoothed image")
+    masked_file = File(exists=True, desc="The smoothed and masked image")
+
+
+class SmoothMask(ProfiledInterfaceMixin, CachedInterfaceMixin,
+                 BaseInterface):
+    """
+    Smooths an image with a separable Gaussian kernel and then masks it in a
+    single in-process pass, the equivalent of running
+    'fslmaths <in_file> -s <sigma> <out_file>' followed by
+    'fslmaths <out_file> -mas <mask_file> <masked_file>'. The input image and
+    mask are only decompressed once and the smoothed image isn't read back
+    from disk before it is masked
+    """
+
+    input_spec = SmoothMaskInputSpec
+    output_spec = SmoothMaskOutputSpec
+
+    # Change when the outputs for the same inputs change (see
+    # example.derivative_cache.CachedInterfaceMixin)
+    cache_version = '1'
+
+    def _run_interface(self, runtime):
+        if isdefined(self.inputs.sigma):
+            sigma = self.inputs.sigma
+        else:
+            sigma = fwhm_to_sigma(self.inputs.fwhm)
+        img = nb.load(self.inputs.in_file)
+        smoothed = gaussian_smooth(img.get_fdata(dtype=numpy.float32), sigma,
+                                   img.header.get_zooms(),
+                                   truncate=self.inputs.truncate)
+        save_image(like_image(smoothed, img), self._gen_filename('out_file'),
+                   num_threads=self.inputs.num_threads)
+        smoothed = CompactMask.load(self.inputs.mask_file).apply(smoothed)
+        save_image(like_image(smoothed, img),
+                   self._gen_filename('masked_file'),
+                   num_threads=self.inputs.num_threads)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_filename('out_file')
+        outputs['masked_file'] = self._gen_filename('masked_file')
+        return outputs
+
+    def _gen_filename(self, name):
+        if name == 'out_file':
+            suffix = '_smooth'
+        elif name == 'masked_file':
+            suffix = '_smooth_masked'
+        else:
+            assert False
+        _, base, ext = split_filename(self.inputs.in_file)
+        return op.join(os.getcwd(), base + suffix + ext)
+
+
+class SmoothMaskSweepInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="The image to smooth")
+    mask_file = File(exists=True, mandatory=True,
+                     desc=("The mask to apply to the smoothed images, either "
+                           "a NIfTI image or a compact mask (see "
+                           "CompressMask)"))
+    fwhms = traits.List(
+        traits.Float, mandatory=True, minlen=1,
+        desc=("The full-width-half-maximums of the smoothing kernels in mm"))
+    truncate = traits.Float(
+        4.0, usedefault=True,
+        desc=("The number of standard deviations at which the kernels are "
+              "truncated"))
+    num_threads = traits.Int(
+        1, usedefault=True, nohash=True,
+        desc="The number of threads used to compress the output images")
+
+
+class SmoothMaskSweepOutputSpec(TraitedSpec):
+    out_dir = Directory(
+        exists=True,
+        desc=("A directory containing a sub-directory for each kernel with "
+              "the smoothed and masked images and the parameters used to "
+              "generate them"))
+    out_files = OutputMultiPath(File(exists=True),
+                                desc="The smoothed images for each kernel")
+    masked_files = OutputMultiPath(
+        File(exists=True),
+        desc="The smoothed and masked images for each kernel")
+
+
+class SmoothMaskSweep(ProfiledInterfaceMixin, CachedInterfaceMixin,
+                      BaseInterface):
+    """
+    Smooths and masks an image with a range of smoothing kernels (see
+    SmoothMask), decompressing the input image and mask only once for all of
+    them. The images are smoothed in the same way as by SmoothMask, which
+    approximates 'fslmaths -s' (see scripts/test_smoothing.py), so they can
+    differ slightly from those smoothed with FSL.
+
+    The outputs of each kernel are saved in a 'fwhm-<fwhm>' sub-directory of
+    the output directory, along with a 'provenance.json' file recording the
+    kernel parameters and the digests of the input files, so each result can
+    be traced back to how it was generated independently of the others
+    """
+
+    input_spec = SmoothMaskSweepInputSpec
+    output_spec = SmoothMaskSweepOutputSpec
+
+    cache_version = '1'
+
+    out_dir_name = 'smoothing_sweep'
+
+    def _run_interface(self, runtime):
+        img = nb.load(self.inputs.in_file)
+        data = img.get_fdata(dtype=numpy.float32)
+        mask = CompactMask.load(self.inputs.mask_file)
+        provenance = {
+            'in_file': op.basename(self.inputs.in_file),
+            'in_file_sha1': file_digest(self.inputs.in_file),
+            'mask_file': op.basename(self.inputs.mask_file),
+            'mask_file_sha1': file_digest(self.inputs.mask_file),
+            'truncate': self.inputs.truncate}
+        for fwhm in self.inputs.fwhms:
+            kernel_dir = self._kernel_dir(fwhm)
+            os.makedirs(kernel_dir, exist_ok=True)
+            sigma = fwhm_to_sigma(fwhm)
+            smoothed = gaussian_smooth(data, sigma, img.header.get_zooms(),
+                                       truncate=self.inputs.truncate)
+            save_image(like_image(smoothed, img),
+                       self._kernel_path(fwhm, 'smooth'),
+                       num_threads=self.inputs.num_threads)
+            save_image(like_image(mask.apply(smoothed), img),
+                       self._kernel_path(fwhm, 'smooth_masked'),
+                       num_threads=self.inputs.num_threads)
+            with open(op.join(kernel_dir, 'provenance.json'), 'w') as f:
+                json.dump(dict(provenance, fwhm=fwhm, sigma=sigma), f,
+                          indent=2)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_dir'] = op.join(os.getcwd(), self.out_dir_name)
+        outputs['out_files'] = [self._kernel_path(f, 'smooth')
+                                for f in self.inputs.fwhms]
+        outputs['masked_files'] = [self._kernel_path(f, 'smooth_masked')
+                                   for f in self.inputs.fwhms]
+        return outputs
+
+    def _kernel_dir(self, fwhm):
+        return op.join(os.getcwd(), self.out_dir_name,
+                       'fwhm-{:g}'.format(fwhm))
+
+    def _kernel_path(self, fwhm, suffix):
+        _, base, ext = split_filename(self.inputs.in_file)
+        return op.join(self._kernel_dir(fwhm), base + '_' + suffix + ext)
+
+
+class BET(ProfiledInterfaceMixin, CachedInterfaceMixin, fsl.BET):
+    """
+    FSL's brain extraction tool, with its outputs reused from the derivative
+    cache (see example.derivative_cache) when the same image has already been
+    skull-stripped with the same parameters, e.g. by another analysis
+    """
+
+    cache_version = '1'
+
+
+class PrepareTemplateInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True,
+                   desc="The template to prepare for registration")
+    cache_dir = traits.Str(
+        DEFAULT_TEMPLATE_CACHE_DIR, usedefault=True, nohash=True,
+        desc="The directory the prepared templates are cached in")
+
+
+class PrepareTemplateOutputSpec(TraitedSpec):
+    out_file = File(exists=True,
+                    desc=("The prepared template, linked from the cache "
+                          "directory into the working directory"))
+
+
+class PrepareTemplate(ProfiledInterfaceMixin, BaseInterface):
+    """
+    Prepares a template for registration by saving it uncompressed in float32,
+    in a cache shared between workflows that is keyed by the digest of the
+    template (see example.image.cached_template).
+
+    The prepared template is hard-linked from the cache into the working
+    directory (falling back to a copy across file systems), so the result of
+    the node still refers to an existing file if the cache is cleared, while
+    registrations to the same template still read the same file
+    """
+
+    input_spec = PrepareTemplateInputSpec
+    output_spec = PrepareTemplateOutputSpec
+
+    def _run_interface(self, runtime):
+        transfer_file(cached_template(self.inputs.in_file,
+                                      cache_dir=self.inputs.cache_dir),
+                      self._gen_filename('out_file'), mode='link')
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_filename('out_file')
+        return outputs
+
+    def _gen_filename(self, name):
+        if name == 'out_file':
+            _, base, _ = split_filename(self.inputs.in_file)
+            fname = op.join(os.getcwd(), base + '_float32.nii')
+        else:
+            assert False
+        return fname
+
+
+class IndexedSelectFilesInputSpec(SelectFilesInputSpec):
+    base_directory = Directory(
+        exists=True, mandatory=True,
+        desc="Root path common to templates, which is indexed")
+    index_dir = traits.Str(
+        nohash=True,
+        desc=("The directory the index of the base directory is stored in "
+              "(see example.bids_index.BIDSIndex)"))
+
+
+class IndexedSelectFiles(SelectFiles):
+    """
+    SelectFiles that finds the files matching its templates in a persisted
+    index of the base directory (see example.bids_index.BIDSIndex), instead
+    of listing the directories of the dataset each time it is run. Only the
+    directories within the literal part of each filled template (e.g. the
+    directory of the subject) are checked for modifications, with a single
+    'stat' each, and only those that have been modified are listed again
+    """
+
+    input_spec = IndexedSelectFilesInputSpec
+
     def _list_outputs(self):
-        values = list(self.inputs.in_list)
+        outputs = {}
+        info = {k: v for k, v in self.inputs.__dict__.items()
+                if k in self._infields}
+        index = BIDSIndex(self.inputs.base_directory,
+                          index_dir=(self.inputs.index_dir
+                                     if isdefined(self.inputs.index_dir)
+                                     else None))
+        force_lists = self.inputs.force_lists
+        if isinstance(force_lists, bool):
+            force_lists = self._outfields if force_lists else []
+        bad_fields = set(force_lists) - set(self._outfields)
+        if bad_fields:
+            raise ValueError(
+                "The field(s) '{}' set in 'force_lists' are not in "
+                "'templates'".format("', '".join(sorted(bad_fields))))
+        for field, template in self._templates.items():
+            filled_template = template.format(**info)
+            filelist = index.glob(filled_template)
+            if not filelist:
+                msg = "No files were found matching {} template: {}".format(
+                    field, op.join(index.root, filled_template))
+                if self.inputs.raise_on_empty:
+                    raise IOError(msg)
+                warn(msg)
+            if self.inputs.sort_filelist:
+                filelist = human_order_sorted(filelist)
+            if field not in force_lists:
+                filelist = simplify_list(filelist)
+            outputs[field] = filelist
+        return outputs
+
+
+class LinkingDataSinkInputSpec(DataSinkInputSpec):
+    transfer_mode = traits.Enum(
+        *TRANSFER_MODES, usedefault=True,
+        desc=("How outputs are transferred to the sink when they are on the "
+              "same file system (see example.transfer.transfer_file). Files "
+              "are copied when they are on different file systems"))
+
+
+class LinkingDataSinkOutputSpec(DataSinkOutputSpec):
+    bytes_saved = traits.Int(
+        desc="The total size of the files transferred without being copied")
+    bytes_copied = traits.Int(
+        desc="The total size of the files that were copied")
+
+
+class LinkingDataSink(DataSink):
+    """
+    A DataSink that can also clone (reflink) or rename outputs into the sink,
+    depending on 'transfer_mode'. DataSink already hard-links outputs when
+    the working directory is on the same file system as the sink (unless
+    'execution.try_hard_link_datasink' is disabled), so the default 'link'
+    mode only differs from it in falling back to a reflink where hard links
+    aren't supported. 'reflink' gives the sink its own copy of the outputs
+    without writing their data again (on file systems that support it, e.g.
+    Btrfs and XFS), and 'move' renames them. None of these work across file
+    systems, where the outputs are copied a block at a time as by DataSink.
+
+    Destination files are replaced atomically, substitutions are applied to
+    their paths as for DataSink (the contents of the files are never
+    rewritten), and the total sizes of the files that were and weren't
+    copied are returned in 'bytes_copied' and 'bytes_saved'.
+
+    Hard-linked outputs share their data with the files in the working
+    directory, so they mustn't be modified in place, and moved outputs are
+    removed from the working directory, so the nodes that produced them will
+    be rerun by the next run of the workflow.
+
+    Uploading to S3 is handled by DataSink
+    """
+
+    input_spec = LinkingDataSinkInputSpec
+    output_spec = LinkingDataSinkOutputSpec
+
+    def _list_outputs(self):
+        if self._check_s3_base_dir()[0]:
+            outputs = super()._list_outputs()
+            outputs['bytes_saved'] = outputs['bytes_copied'] = 0
+            return outputs
         outputs = self._outputs().get()
-        outputs['std'] = numpy.std(values)
-        outputs['avg'] = numpy.average(values)
+        outdir = (self.inputs.local_copy if isdefined(self.inputs.local_copy)
+                  else self.inputs.base_directory)
+        if not isdefined(outdir):
+            outdir = '.'
+        if isdefined(self.inputs.container):
+            outdir = op.join(outdir, self.inputs.container)
+        outdir = op.abspath(outdir)
+        out_files = []
+        transferred = []
+        for key, files in list(self.inputs._outputs.items()):
+            if not isdefined(files):
+                continue
+            key_dir = op.join(outdir, *(d for d in key.split('.')
+                                        if not d.startswith('@')))
+            files = ensure_list(files)
+            if files and isinstance(files[0], list):
+                files = [f for sublist in files for f in sublist]
+            for src in files:
+                src = op.abspath(src)
+                if not op.isfile(src):
+                    src = op.join(src, '')
+                dst = self._substitute(op.join(key_dir, self._get_dst(src)))
+                os.makedirs(op.dirname(dst.rstrip(os.sep)), exist_ok=True)
+                if op.isfile(src):
+                    size = op.getsize(src)
+                    transferred.append((dst, transfer_file(
+                        src, dst, mode=self.inputs.transfer_mode), size))
+                elif op.isdir(src):
+                    if op.exists(dst) and self.inputs.remove_dest_dir:
+                        shutil.rmtree(dst)
+                    transferred.extend(transfer_tree(
+                        src, dst, mode=self.inputs.transfer_mode))
+                else:
+                    continue
+                out_files.append(dst)
+        saved = [s for _, m, s in transferred if m != 'copy']
+        copied = [s for _, m, s in transferred if m == 'copy']
+        outputs['out_file'] = out_files
+        outputs['bytes_saved'] = sum(saved)
+        outputs['bytes_copied'] = sum(copied)
+        iflogger.info(
+            "Transferred %d file(s) to %s without copying (%.1f MB saved) and "
+            "copied %d (%.1f MB)", len(saved), outdir,
+            outputs['bytes_saved'] / 1024 ** 2, len(copied),
+            outputs['bytes_copied'] / 1024 ** 2)
         return outputs
 
+
+class GzipInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="The file to compress")
+    compress_level = traits.Range(
+        low=1, high=9, value=6, usedefault=True,
+        desc="The zlib compression level (1 is fastest, 9 is smallest)")
+    num_threads = traits.Int(
+        1, usedefault=True, nohash=True,
+        desc="The number of threads used to compress the file")
+
+
+class GzipOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The compressed file")
+
+
+class Gzip(ProfiledInterfaceMixin, CachedInterfaceMixin, BaseInterface):
+    """
+    Compresses a file with gzip, e.g. to convert an uncompressed NIfTI image
+    (.nii) into a compressed one (.nii.gz). The file is streamed, so it isn't
+    loaded into memory, and its contents are copied as they are (i.e. the
+    image isn't decoded and re-encoded). If 'num_threads' is greater than one,
+    blocks of the file are compressed in parallel (see
+    example.parallel_gzip)
+    """
+
+    input_spec = GzipInputSpec
+    output_spec = GzipOutputSpec
+
+    cache_version = '1'
+
     def _run_interface(self, runtime):
-        # Do nothing
+        if self.inputs.num_threads > 1:
+            compress_file(self.inputs.in_file, self._gen_filename('out_file'),
+                          compress_level=self.inputs.compress_level,
+                          num_threads=self.inputs.num_threads)
+        else:
+            with open(self.inputs.in_file, 'rb') as f_in, gzip.open(
+                    self._gen_filename('out_file'), 'wb',
+                    compresslevel=self.inputs.compress_level) as f_out:
+                shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
         return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_filename('out_file')
+        return outputs
+
+    def _gen_filename(self, name):
+        if name == 'out_file':
+            fname = op.join(os.getcwd(),
+                            op.basename(self.inputs.in_file) + '.gz')
+        else:
+            assert False
+        return fname
+
+
+class CompressMaskInputSpec(BaseInterfaceInputSpec):
+    in_file = File(exists=True, mandatory=True, desc="The mask image")
+
+
+class CompressMaskOutputSpec(TraitedSpec):
+    out_file = File(exists=True, desc="The compact mask (.npz)")
+
+
+class CompressMask(ProfiledInterfaceMixin, BaseInterface):
+    """
+    Converts a mask image into a compact mask, i.e. the bit-packed mask
+    values within its bounding box plus the shape and affine of the full image
+    (see example.compact_mask.CompactMask)
+    """
+
+    input_spec = CompressMaskInputSpec
+    output_spec = CompressMaskOutputSpec
+
+    def _run_interface(self, runtime):
+        CompactMask.from_nifti(self.inputs.in_file).save(
+            self._gen_filename('out_file'))
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['out_file'] = self._gen_filename('out_file')
+        return outputs
+
+    def _gen_filename(self, name):
+        if name == 'out_file':
+            _, base, _ = split_filename(self.inputs.in_file)
+            fname = op.join(os.getcwd(), base + '_compact.npz')
+        else:
+            assert False
+        return fname
+
+
+class MaskedImageStatsInputSpec(BaseInterfaceInputSpec):
+    in_files = InputMultiPath(
+        File(exists=True), mandatory=True,
+        desc=("The image(s) to calculate the statistics of. A batch of images "
+              "can be passed to be processed in a single call"))
+    mask_files = InputMultiPath(
+        File(exists=True),
+        desc=("The mask(s), either NIfTI images or compact masks (see "
+              "CompressMask), one for each image or a single mask for all of "
+              "them. If not provided, the statistics are calculated over the "
+              "whole image"))
+    whole_image = traits.Bool(
+        False, usedefault=True,
+        desc=("Calculate the statistics of the masked image over the whole "
+              "field of view, i.e. counting the voxels outside the mask as "
+              "zeros as 'fslstats <masked-image> -m -s' does, instead of over "
+              "the voxels within the mask"))
+    percentiles = traits.List(
+        traits.Range(low=0.0, high=100.0),
+        desc=("Percentiles to estimate (from a sketch of the voxel values "
+              "within the mask)"))
+    slab_size = traits.Int(
+        8, usedefault=True, nohash=True,
+        desc=("The number of slices read into memory at a time, which bounds "
+              "the memory used"))
+
+
+class MaskedImageStatsOutputSpec(TraitedSpec):
+    mean = OutputMultiObject(traits.Float, desc="The mean of each image")
+    std = OutputMultiObject(traits.Float,
+                            desc="The standard deviation of each image")
+    count = OutputMultiObject(traits.Int,
+                              desc="The number of voxels in each image")
+    percentiles = OutputMultiObject(
+        traits.List(traits.Float),
+        desc="Estimates of the requested percentiles of each image")
+
+
+class MaskedImageStats(ProfiledInterfaceMixin, BaseInterface):
+    """
+    Calculates the mean, standard deviation and (estimated) percentiles of
+    images within masks. The images are read one slab of slices at a time and
+    the statistics are accumulated with Welford-style updates (see
+    example.stats.RunningStats), so only a few slabs are held in memory. Only
+    the slices within the bounding box of the mask are read, and the voxels
+    outside the mask are accounted for without being read when 'whole_image'
+    is set
+    """
+
+    input_spec = MaskedImageStatsInputSpec
+    output_spec = MaskedImageStatsOutputSpec
+
+    def _run_interface(self, runtime):
+        in_files = self.inputs.in_files
+        if isdefined(self.inputs.mask_files):
+            mask_files = self.inputs.mask_files
+            if len(mask_files) == 1:
+                mask_files = mask_files * len(in_files)
+            elif len(mask_files) != len(in_files):
+                raise ValueError(
+                    "Number of masks ({}) doesn't match the number of images "
+                    "({})".format(len(mask_files), len(in_files)))
+        else:
+            mask_files = [None] * len(in_files)
+        masks = {}
+        self._stats = []
+        for in_file, mask_file in zip(in_files, mask_files):
+            if mask_file is not None:
+                if mask_file not in masks:
+                    masks[mask_file] = CompactMask.load(mask_file)
+                # Only the header of the image is read to check its shape
+                masks[mask_file].check_shape(
+                    nb.load(in_file).shape,
+                    image_name="'{}' (masked by '{}')".format(in_file,
+                                                              mask_file))
+            self._stats.append(self._image_stats(in_file,
+                                                 masks.get(mask_file)))
+        return runtime
+
+    def _image_stats(self, in_file, mask):
+        sketch_size = 200 if isdefined(self.inputs.percentiles) else None
+        stats = RunningStats(track_range=False, sketch_size=sketch_size)
+        if mask is None:
+            for _, slab in iter_slabs(in_file, self.inputs.slab_size):
+                stats.update(slab)
+            return stats
+        bbox = mask.bbox
+        z_range = (bbox[2].start, bbox[2].stop)
+        for z, slab in iter_slabs(in_file, self.inputs.slab_size,
+                                  z_range=z_range):
+            z_slice = slice(z - z_range[0], z - z_range[0] + slab.shape[2])
+            stats.update(slab[bbox[0], bbox[1]][
+                mask.bbox_mask[:, :, z_slice]])
+        if self.inputs.whole_image:
+            num_volumes = int(numpy.prod(nb.load(in_file).shape[3:]))
+            zeros = RunningStats(track_range=False)
+            zeros.count = num_volumes * (mask.num_voxels
+                                         - int(mask.bbox_mask.sum()))
+            stats.merge(zeros)
+        return stats
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['mean'] = [s.mean for s in self._stats]
+        outputs['std'] = [s.std() for s in self._stats]
+        outputs['count'] = [s.count for s in self._stats]
+        if isdefined(self.inputs.percentiles):
+            outputs['percentiles'] = [
+                [s.quantile(p / 100.0) for p in self.inputs.percentiles]
+                for s in self._stats]
+        return outputs
@@ -0,0 +1,314 @@
+import os
+import os.path as op
+import re
+import time
+import uuid
+import queue
+import shlex
+import atexit
+import tempfile
+import threading
+import subprocess as sp
+from nipype.interfaces.base import isdefined
+
+
+POOL_SIZE_ENV = 'EXAMPLE_MATLAB_POOL_SIZE'
+ENGINE_CMD_ENV = 'EXAMPLE_MATLAB_ENGINE_CMD'
+JOB_TIMEOUT_ENV = 'EXAMPLE_MATLAB_JOB_TIMEOUT'
+
+DEFAULT_ENGINE_CMD = ('matlab -nodesktop -nosplash -nodisplay '
+                      '-singleCompThread')
+
+# Statements run when a session starts, which save its initial search path
+# to a file so that it can be restored after each job
+STARTUP_TEMPLATE = (
+    "example_fid = fopen('{path_file}', 'w'); "
+    "fprintf(example_fid, '%s', path()); fclose(example_fid); "
+    "clear all; fprintf('\\n{sentinel} %d\\n', 0); "
+    "if exist('OCTAVE_VERSION', 'builtin'), fflush(stdout); end\n")
+
+# Statements run for each job. The workspace (including global variables) is
+# cleared and the working directory set to the job's directory before the
+# script is run, errors are caught so they don't end the session, and the
+# end of the job's output is marked by a sentinel line with the exit status.
+# The search path is restored afterwards from the file saved at startup (as
+# the script may clear any variable it was saved in), so directories added by
+# one job aren't on the path of the next. Octave buffers its output when it
+# isn't run interactively, so it is flushed explicitly
+JOB_TEMPLATE = (
+    "clear all; clear global; close all; cd('{job_dir}'); "
+    "try, run('{script_path}'); example_job_status = 0; "
+    "catch example_job_err, disp(example_job_err.message); "
+    "example_job_status = 1; end; path(fileread('{path_file}')); "
+    "fprintf('\\n{sentinel} %d\\n', example_job_status); "
+    "clear all; clear global; "
+    "if exist('OCTAVE_VERSION', 'builtin'), fflush(stdout); end\n")
+
+
+class MatlabEngineError(Exception):
+    pass
+
+
+class MatlabEngineTimeout(MatlabEngineError):
+    pass
+
+
+class MatlabEngine(object):
+    """
+    A long-lived MATLAB (or Octave) session that runs scripts sent to it on
+    its standard input, so the cost of starting MATLAB is only paid once
+    instead of for every script.
+
+    Parameters
+    ----------
+    cmd : str
+        The command used to start the session, which should read commands
+        from its standard input, e.g. 'matlab -nodesktop -nosplash' or
+        'octave --no-gui --quiet'
+    timeout : float | None
+        The maximum time in seconds a script (or the session's startup) can
+        run for, after which the session is killed
+    """
+
+    def __init__(self, cmd=DEFAULT_ENGINE_CMD, timeout=None):
+        self.cmd = cmd
+        self.timeout = timeout
+        fd, self._path_file = tempfile.mkstemp(prefix='example-matlab-path-')
+        os.close(fd)
+        self._process = sp.Popen(
+            shlex.split(cmd), stdin=sp.PIPE, stdout=sp.PIPE, stderr=sp.STDOUT,
+            universal_newlines=True, bufsize=1)
+        # The output is read in a separate thread so that reading it can
+        # time out
+        self._lines = queue.Queue()
+        self._reader = threading.Thread(target=self._read_output,
+                                        daemon=True)
+        self._reader.start()
+        # Wait for the session to start up
+        self._send(STARTUP_TEMPLATE, 'startup')
+
+    @property
+    def alive(self):
+        return self._process.poll() is None
+
+    def run(self, script, job_dir, script_fname='pyscript.m'):
+        """
+        Saves a script to the job directory and runs it (see
+        `run_script_file`)
+        """
+        script_path = op.join(job_dir, script_fname)
+        with open(script_path, 'w') as f:
+            f.write(script)
+        return self.run_script_file(script_path, job_dir)
+
+    def run_script_file(self, script_path, job_dir):
+        """
+        Runs a script file in a clean workspace with `job_dir` as the working
+        directory
+
+        Returns
+        -------
+        output : str
+            The output of the script, including the message of any error
+            raised by it
+        status : int
+            0 if the script completed and 1 if it raised an error
+
+        Raises
+        ------
+        MatlabEngineTimeout
+            If the script doesn't complete within the timeout, in which case
+            the session is killed
+        """
+        return self._send(JOB_TEMPLATE, script_path, job_dir=_quote(job_dir),
+                          script_path=_quote(script_path))
+
+    def close(self):
+        if self.alive:
+            try:
+                self._process.stdin.write('exit\n')
+                self._process.stdin.close()
+                self._process.wait(timeout=10)
+            except (BrokenPipeError, sp.TimeoutExpired):
+                self._kill()
+        if op.exists(self._path_file):
+            os.remove(self._path_file)
+
+    def _send(self, template, job_name, **kwargs):
+        sentinel = 'EXAMPLE-JOB-END-' + uuid.uuid4().hex
+        command = template.format(sentinel=sentinel,
+                                  path_file=_quote(self._path_file), **kwargs)
+        try:
+            self._process.stdin.write(command)
+            self._process.stdin.flush()
+        except (BrokenPipeError, ValueError):
+            self._kill()
+            raise MatlabEngineError(
+                "MATLAB session '{}' has exited".format(self.cmd))
+        end_re = re.compile(r'^(>>\s*)*' + sentinel + r' (\d+)$')
+        deadline = (time.monotonic() + self.timeout
+                    if self.timeout is not None else None)
+        lines = []
+        while True:
+            try:
+                line = self._lines.get(
+                    timeout=(max(deadline - time.monotonic(), 0)
+                             if deadline is not None else None))
+            except queue.Empty:
+                # The session can't be interrupted without losing track of
+                # its output, so it is killed (and restarted by the pool)
+                self._kill()
+                raise MatlabEngineTimeout(
+                    "MATLAB session '{}' timed out after {}s running {}:"
+                    "\n\n{}".format(self.cmd, self.timeout, job_name,
+                                     ''.join(lines)))
+            if line is None:
+                break
+            match = end_re.match(line.strip())
+            if match:
+                return self._clean_output(lines), int(match.group(2))
+            lines.append(line)
+        # The session can't be used once its output has closed
+        self._kill()
+        raise MatlabEngineError(
+            "MATLAB session '{}' exited while running {}:\n\n{}".format(
+                self.cmd, job_name, ''.join(lines)))
+
+    def _read_output(self):
+        for line in self._process.stdout:
+            self._lines.put(line)
+        self._lines.put(None)
+
+    def _kill(self):
+        self._process.kill()
+        self._process.wait()
+        if op.exists(self._path_file):
+            os.remove(self._path_file)
+
+    @classmethod
+    def _clean_output(cls, lines):
+        # Strip the prompts MATLAB prints before reading each command
+        output = ''.join(re.sub(r'^(>>\s*)+', '', l) for l in lines)
+        # and the newline printed before the sentinel
+        return output[:-1] if output.endswith('\n') else output
+
+
+class MatlabEnginePool(object):
+    """
+    A pool of MATLAB sessions (see MatlabEngine) that scripts can be run in
+    from multiple threads. Sessions are started as they are needed, up to
+    `size`, and restarted if they exit or are killed after a script times out
+
+    Parameters
+    ----------
+    size : int
+        The maximum number of sessions
+    cmd : str
+        The command used to start each session
+    timeout : float | None
+        The maximum time in seconds a script can run for
+    """
+
+    def __init__(self, size=1, cmd=DEFAULT_ENGINE_CMD, timeout=None):
+        self.size = size
+        self.cmd = cmd
+        self.timeout = timeout
+        # Sessions that aren't in use, with None in place of the sessions
+        # that haven't been started yet (or have exited). The most recently
+        # used sessions are reused first, so sessions are only started when
+        # the existing ones are all busy
+        self._idle = queue.LifoQueue()
+        for _ in range(size):
+            self._idle.put(None)
+
+    def run(self, script, job_dir, script_fname='pyscript.m'):
+        """
+        Runs a script in the next available session (see MatlabEngine.run)
+        """
+        engine = self._idle.get()
+        try:
+            if engine is None:
+                engine = MatlabEngine(self.cmd, timeout=self.timeout)
+            return engine.run(script, job_dir, script_fname=script_fname)
+        finally:
+            self._idle.put(engine if engine is not None and engine.alive
+                           else None)
+
+    def close(self):
+        engines = []
+        while not self._idle.empty():
+            engines.append(self._idle.get())
+        for engine in engines:
+            if engine is not None:
+                engine.close()
+            self._idle.put(None)
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Returns the pool of MATLAB sessions of the current process, as configured
+    by the EXAMPLE_MATLAB_POOL_SIZE, EXAMPLE_MATLAB_ENGINE_CMD and
+    EXAMPLE_MATLAB_JOB_TIMEOUT (in seconds) environment variables, or None if
+    pooling isn't enabled (i.e. the pool size isn't set or is 0). Each
+    process has its own pool, so when nodes are run by the MultiProc plugin
+    each worker process keeps its own sessions
+    """
+    size = int(os.environ.get(POOL_SIZE_ENV, 0) or 0)
+    if not size:
+        return None
+    cmd = os.environ.get(ENGINE_CMD_ENV, DEFAULT_ENGINE_CMD)
+    timeout = os.environ.get(JOB_TIMEOUT_ENV)
+    timeout = float(timeout) if timeout else None
+    with _pools_lock:
+        try:
+            return _pools[(size, cmd, timeout)]
+        except KeyError:
+            pool = _pools[(size, cmd, timeout)] = MatlabEnginePool(
+                size, cmd, timeout=timeout)
+            return pool
+
+
+@atexit.register
+def _close_pools():
+    for pool in _pools.values():
+        pool.close()
+
+
+class PooledMatlabMixin(object):
+    """
+    Mixin for MatlabCommand interfaces that runs their scripts in a pool of
+    long-lived MATLAB sessions (see `get_pool`), when enabled, instead of
+    starting MATLAB for each call, e.g.
+
+        class BrainVolume(PooledMatlabMixin, MatlabCommand):
+            ...
+
+    Only the script (and the 'paths' input) is run in the session, not the
+    prescript and postscript that MatlabCommand wraps it in, which exit MATLAB
+    on errors
+    """
+
+    def _run_interface(self, runtime):
+        pool = get_pool()
+        if pool is None:
+            return super()._run_interface(runtime)
+        script = self.inputs.script
+        if isdefined(self.inputs.paths):
+            script = ''.join("addpath('{}');\n".format(_quote(p))
+                             for p in self.inputs.paths) + script
+        output, status = pool.run(script, runtime.cwd,
+                                  script_fname=self.inputs.script_file)
+        runtime.stdout = runtime.merged = output
+        runtime.stderr = ''
+        runtime.returncode = status
+        if status:
+            self.raise_exception(runtime)
+        return runtime
+
+
+def _quote(string):
+    return string.replace("'", "''")
@@ -0,0 +1,191 @@
+import os
+import re
+import os.path as op
+import json
+import hashlib
+import numpy
+
+
+class MetricsIndex(object):
+    """
+    A columnar table of the metrics contained in a set of body-metrics files
+    (i.e. text files with a "<metric-name> <value>" pair on each line), so that
+    any metric can be looked up without searching the files again.
+
+    The table is stored in `index_dir` as a float64 NumPy array with a row for
+    each file and a column for each metric name (missing values are NaN),
+    which is memory-mapped when loaded, along with JSON lists of the files and
+    metric names. Each file is only parsed again when its modification time or
+    size has changed and the digest of its contents no longer matches.
+    Metrics are looked up by regular expression, as they are searched for by
+    GrepField (see `lookup`).
+
+    Parameters
+    ----------
+    index_dir : str
+        The directory the index is stored in
+    """
+
+    VALUES_FNAME = 'values.npy'
+    FILES_FNAME = 'files.json'
+    METRICS_FNAME = 'metrics.json'
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        try:
+            with open(op.join(index_dir, self.FILES_FNAME)) as f:
+                self.files = json.load(f)
+            with open(op.join(index_dir, self.METRICS_FNAME)) as f:
+                self.metrics = json.load(f)
+            self.values = numpy.load(op.join(index_dir, self.VALUES_FNAME),
+                                     mmap_mode='r')
+        except (IOError, ValueError):
+            self.files = []
+            self.metrics = []
+            self.values = numpy.empty((0, 0))
+        self._rows = {e['path']: i for i, e in enumerate(self.files)}
+
+    def update(self, paths):
+        """
+        Parses any of the given files that are not in the index or have
+        changed since they were indexed, and saves the updated index. Files
+        already in the index that aren't in `paths` are left as they are
+
+        Parameters
+        ----------
+        paths : list[str]
+            Paths to the body-metrics files to index
+
+        Returns
+        -------
+        num_parsed : int
+            The number of files that were (re)parsed
+        """
+        entries = list(self.files)
+        parsed = {}
+        changed = False
+        # Files that are passed more than once are only indexed once
+        for path in dict.fromkeys(op.abspath(p) for p in paths):
+            stat = os.stat(path)
+            entry = {'path': path, 'mtime': stat.st_mtime,
+                     'size': stat.st_size}
+            row = self._rows.get(path)
+            old_entry = self.files[row] if row is not None else None
+            if old_entry is not None and (
+                    old_entry['mtime'], old_entry['size']) == (
+                        entry['mtime'], entry['size']):
+                continue
+            with open(path, 'rb') as f:
+                contents = f.read()
+            entry['digest'] = hashlib.sha1(contents).hexdigest()
+            # If only the timestamp has changed the existing row is kept
+            if old_entry is None or old_entry['digest'] != entry['digest']:
+                parsed[path] = parse_metrics(contents.decode())
+            if row is None:
+                entries.append(entry)
+            else:
+                entries[row] = entry
+            changed = True
+        if changed:
+            self._save(entries, parsed)
+        return len(parsed)
+
+    def _save(self, entries, parsed):
+        metrics = list(self.metrics)
+        new_metrics = set()
+        for file_metrics in parsed.values():
+            new_metrics.update(file_metrics)
+        metrics.extend(sorted(new_metrics - set(metrics)))
+        columns = {m: i for i, m in enumerate(metrics)}
+        values = numpy.full((len(entries), len(metrics)), numpy.nan)
+        for i, entry in enumerate(entries):
+            path = entry['path']
+            if path in parsed:
+                for metric, value in parsed[path].items():
+                    values[i, columns[metric]] = value
+            else:
+                values[i, :self.values.shape[1]] = self.values[
+                    self._rows[path]]
+        os.makedirs(self.index_dir, exist_ok=True)
+        # Write to temporary files and then rename them over the old ones so
+        # that readers don't see a partially written array
+        self._write(self.VALUES_FNAME, lambda f: numpy.save(f, values))
+        self._write(self.METRICS_FNAME, lambda f: f.write(
+            json.dumps(metrics).encode()))
+        self._write(self.FILES_FNAME, lambda f: f.write(
+            json.dumps(entries).encode()))
+        self.files = entries
+        self.metrics = metrics
+        self.values = numpy.load(op.join(self.index_dir, self.VALUES_FNAME),
+                                 mmap_mode='r')
+        self._rows = {e['path']: i for i, e in enumerate(self.files)}
+
+    def _write(self, fname, write):
+        path = op.join(self.index_dir, fname)
+        with open(path + '.tmp', 'wb') as f:
+            write(f)
+        os.replace(path + '.tmp', path)
+
+    def lookup(self, metric, paths):
+        """
+        Looks up the values of a metric for each of the given files, which
+        must have already been indexed (see `update`).
+
+        As for the equivalent "grep -e <metric> | awk '{print $2}'" (see
+        example.interfaces.GrepField), `metric` is a regular expression that
+        is searched for anywhere in the metric names, e.g. 'eight' matches
+        both 'height' and 'weight', and it must match exactly one of the
+        metrics in each file. Unlike grep, it is only matched against the
+        names of the metrics and not their values
+
+        Parameters
+        ----------
+        metric : str
+            A regular expression matching the name of the metric
+        paths : list[str]
+            The paths of the files to look up the metric for
+
+        Returns
+        -------
+        values : numpy.ndarray
+            The value of the metric for each file
+        """
+        regex = re.compile(metric)
+        columns = [i for i, m in enumerate(self.metrics) if regex.search(m)]
+        if not columns:
+            raise KeyError(
+                "'{}' doesn't match any of the metrics in the indexed files in "
+                "{}".format(metric, self.index_dir))
+        rows = [self._rows[op.abspath(p)] for p in paths]
+        values = numpy.asarray(self.values[rows][:, columns])
+        found = ~numpy.isnan(values)
+        num_found = found.sum(axis=1)
+        if (num_found != 1).any():
+            missing = [p for p, n in zip(paths, num_found) if not n]
+            if missing:
+                raise KeyError("'{}' metric was not found in {}".format(
+                    metric, ', '.join(missing)))
+            ambiguous = [p for p, n in zip(paths, num_found) if n > 1]
+            raise KeyError(
+                "'{}' matches more than one metric ('{}') in {}".format(
+                    metric, "', '".join(self.metrics[c] for c in columns),
+                    ', '.join(ambiguous)))
+        # There is a single value in each row, so they are in row order
+        return values[found]
+
+
+def parse_metrics(contents):
+    """
+    Parses the "<metric-name> <value>" pairs from the lines of a body-metrics
+    file, ignoring any lines that don't match this form
+    """
+    metrics = {}
+    for line in contents.splitlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        try:
+            metrics[fields[0]] = float(fields[1])
+        except ValueError:
+            continue
+    return metrics
@@ -0,0 +1,127 @@
+import os
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+BLOCK_SIZE = 128 * 1024
+# The maximum distance of a back-reference in a deflate stream
+WINDOW_SIZE = 32 * 1024
+
+
+def compress_file(in_path, out_path, compress_level=6, num_threads=None,
+                  block_size=BLOCK_SIZE):
+    """
+    Compresses a file with gzip, compressing independent blocks in parallel
+    in the manner of pigz. See `ParallelGzipWriter` for details
+    """
+    with open(in_path, 'rb') as f_in, ParallelGzipWriter(
+            out_path, compress_level=compress_level, num_threads=num_threads,
+            block_size=block_size) as writer:
+        while True:
+            data = f_in.read(block_size)
+            if not data:
+                break
+            writer.write(data)
+    return out_path
+
+
+def save_nifti(img, out_path, compress_level=6, num_threads=None):
+    """
+    Saves a single-file NIfTI image to a .nii.gz file using parallel
+    compression
+    """
+    with ParallelGzipWriter(out_path, compress_level=compress_level,
+                            num_threads=num_threads) as writer:
+        writer.write(img.to_bytes())
+    return out_path
+
+
+class ParallelGzipWriter(object):
+    """
+    Writes a gzip file, compressing blocks of the data in parallel threads
+    (zlib releases the GIL while compressing). As in pigz, each block is
+    compressed as part of a single raw deflate stream, using the last 32KB of
+    the previous block as a preset dictionary and ending in a sync flush, so
+    the output is a standard, single-member gzip file that can be read by
+    any gzip reader (e.g. nibabel or FSL) with a compression ratio close to
+    that of serial compression.
+
+    Parameters
+    ----------
+    out_path : str
+        The path to write the compressed file to
+    compress_level : int
+        The zlib compression level (1-9)
+    num_threads : int | None
+        The number of threads to compress with. Defaults to the number of
+        CPUs
+    block_size : int
+        The size of the uncompressed blocks that are compressed independently
+    """
+
+    def __init__(self, out_path, compress_level=6, num_threads=None,
+                 block_size=BLOCK_SIZE):
+        self.compress_level = compress_level
+        self.num_threads = num_threads or os.cpu_count() or 1
+        self.block_size = block_size
+        self._file = open(out_path, 'wb')
+        self._executor = ThreadPoolExecutor(max_workers=self.num_threads)
+        self._pending = deque()
+        self._buffer = b''
+        self._dictionary = b''
+        self._crc = 0
+        self._size = 0
+        # Gzip header with no file name or modification time, deflate
+        # compression and an unknown OS
+        self._file.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+    def write(self, data):
+        data = bytes(data)
+        self._crc = zlib.crc32(data, self._crc)
+        self._size += len(data)
+        if self._buffer:
+            data = self._buffer + data
+        start = 0
+        # Always hold back the final block so that it can be compressed as
+        # the last one when the writer is closed
+        while len(data) - start > self.block_size:
+            self._submit(data[start:start + self.block_size], last=False)
+            start += self.block_size
+        self._buffer = data[start:]
+
+    def close(self):
+        if self._file.closed:
+            return
+        try:
+            self._submit(self._buffer, last=True)
+            self._buffer = b''
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+            self._file.write(struct.pack('<II', self._crc & 0xffffffff,
+                                         self._size & 0xffffffff))
+        finally:
+            self._executor.shutdown()
+            self._file.close()
+
+    def _submit(self, block, last):
+        self._pending.append(self._executor.submit(
+            self._compress_block, block, self._dictionary, last))
+        self._dictionary = (self._dictionary + block)[-WINDOW_SIZE:]
+        # Limit the number of blocks held in memory
+        while len(self._pending) > 2 * self.num_threads:
+            self._file.write(self._pending.popleft().result())
+
+    def _compress_block(self, block, dictionary, last):
+        kwargs = {'zdict': dictionary} if dictionary else {}
+        compressor = zlib.compressobj(self.compress_level, zlib.DEFLATED,
+                                      -zlib.MAX_WBITS, **kwargs)
+        return compressor.compress(block) + compressor.flush(
+            zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
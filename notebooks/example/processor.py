@@ -0,0 +1,12 @@
+from arcana.processor import MultiProc
+from example.scheduler import PackingMultiProcPlugin
+
+
+class PackingMultiProc(MultiProc):
+    """
+    Arcana's MultiProc processor, with the number of threads of the nodes
+    adapted to the free processors when they are scheduled (see
+    example.scheduler.ResourcePackingMixin)
+    """
+
+    nipype_plugin_cls = PackingMultiProcPlugin
@@ -0,0 +1,210 @@
+import os
+import os.path as op
+import json
+import time
+import shutil
+import resource
+import tempfile
+import threading
+import functools
+from contextlib import contextmanager
+
+
+TRACE_DIR_ENV = 'EXAMPLE_TRACE_DIR'
+
+_write_lock = threading.Lock()
+
+# The number of profiled calls in progress in each thread
+_depth = threading.local()
+
+
+class ProfiledInterfaceMixin(object):
+    """
+    Mixin for Nipype interfaces that records the wall time, CPU time, peak
+    RSS (of the process and its children) and the bytes read/written during
+    each call to `_run_interface` and `_list_outputs`.
+
+    On Linux, the peak RSS of the process is reset at the start of each call,
+    so 'peak_rss_kb' is the peak during the call. Where it can't be reset, or
+    for calls nested within another profiled call, only the peak over the
+    lifetime of the process is available, which is recorded as
+    'process_peak_rss_kb'. As the peak is per process, the peaks of calls run
+    concurrently in threads of the same process include each other's. The
+    peak of the child processes of a call (e.g. of a command-line tool) is
+    recorded as 'child_peak_rss_kb' when it exceeds that of all previous
+    children of the process.
+
+    'chars_read' and 'chars_written' are all the bytes read and written by
+    the process, including through pipes and terminals and from the page
+    cache, whereas 'storage_bytes_read' and 'storage_bytes_written' are the
+    bytes read from and written to storage.
+
+    Events are only recorded while tracing is enabled (see `trace`), in which
+    case they are appended to a file per process in the directory given by the
+    EXAMPLE_TRACE_DIR environment variable, so they are also collected from
+    nodes run in separate processes (e.g. by MultiProc).
+
+    The mixin wraps the methods of each class it is mixed into, so it works
+    whether the methods are defined by the class itself or inherited, e.g.
+
+        class Grep(ProfiledInterfaceMixin, CommandLine):
+            ...
+    """
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name in ('_run_interface', '_list_outputs'):
+            method = getattr(cls, name, None)
+            if method is not None and not getattr(method, 'profiled', False):
+                setattr(cls, name, _profiled(method, cls.__name__))
+
+
+def _profiled(method, class_name):
+    event_name = '{}.{}'.format(class_name, method.__name__)
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        trace_dir = os.environ.get(TRACE_DIR_ENV)
+        if not trace_dir:
+            return method(self, *args, **kwargs)
+        depth = getattr(_depth, 'value', 0)
+        # The peak RSS is only reset by the outermost call, e.g. not when
+        # _list_outputs is called from within _run_interface, so the peak
+        # of the enclosing call isn't lost
+        start = _snapshot(start=(depth == 0))
+        _depth.value = depth + 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _depth.value = depth
+            _write_event(trace_dir, event_name, start, _snapshot())
+
+    wrapper.profiled = True
+    return wrapper
+
+
+def _snapshot(start=False):
+    # The peak RSS of the process (its "high water mark") is reset at the
+    # start of each call where possible (Linux), so the peak at the end is
+    # the peak during the call rather than over the lifetime of the process
+    peak_reset = start and _reset_peak_rss()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        'wall': time.time(),
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'child_cpu': child_usage.ru_utime + child_usage.ru_stime,
+        'peak_reset': peak_reset,
+        'hwm': _read_status_kb('VmHWM'),
+        'maxrss': usage.ru_maxrss,
+        'child_maxrss': child_usage.ru_maxrss,
+        'io': _read_io_counters()}
+
+
+def _reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        return False
+    return True
+
+
+def _read_status_kb(field):
+    # Only available on Linux
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (IOError, ValueError):
+        pass
+    return None
+
+
+def _read_io_counters():
+    # Only available on Linux
+    try:
+        with open('/proc/self/io') as f:
+            return {k: int(v) for k, v in (l.split(': ')
+                                           for l in f.read().splitlines())}
+    except (IOError, ValueError):
+        return None
+
+
+def _write_event(trace_dir, name, start, end):
+    args = {
+        'cwd': os.getcwd(),
+        'cpu_time_s': end['cpu'] - start['cpu'],
+        'child_cpu_time_s': end['child_cpu'] - start['child_cpu']}
+    if start['peak_reset'] and end['hwm'] is not None:
+        args['peak_rss_kb'] = end['hwm']
+    else:
+        # Only the peak over the lifetime of the process is available, which
+        # may have been reached by a previous call (ru_maxrss is in kB on
+        # Linux)
+        args['process_peak_rss_kb'] = end['maxrss']
+    # ru_maxrss of the children is the peak of the largest child waited for
+    # by the process, so it is only the peak of a child of this call if it
+    # increased during the call
+    if end['child_maxrss'] > start['child_maxrss']:
+        args['child_peak_rss_kb'] = end['child_maxrss']
+    if start['io'] is not None and end['io'] is not None:
+        # All bytes passed to read()/write() calls, including pipes, sockets
+        # and terminals, and reads served from the page cache
+        args['chars_read'] = end['io']['rchar'] - start['io']['rchar']
+        args['chars_written'] = end['io']['wchar'] - start['io']['wchar']
+        # Bytes actually fetched from or sent to the storage layer
+        args['storage_bytes_read'] = (end['io']['read_bytes']
+                                      - start['io']['read_bytes'])
+        args['storage_bytes_written'] = (end['io']['write_bytes']
+                                         - start['io']['write_bytes'])
+    # A complete ("X") event in the Chrome trace event format, with times in
+    # microseconds
+    event = {'name': name, 'cat': 'interface', 'ph': 'X',
+             'ts': start['wall'] * 1e6,
+             'dur': (end['wall'] - start['wall']) * 1e6,
+             'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args}
+    with _write_lock:
+        with open(op.join(trace_dir, 'events-{}.jsonl'.format(os.getpid())),
+                  'a') as f:
+            f.write(json.dumps(event) + '\n')
+
+
+def merge_trace_events(trace_dir, out_path):
+    """
+    Merges the events recorded in a trace directory into a single Chrome
+    trace file, which can be opened in chrome://tracing or Perfetto
+    """
+    events = []
+    for fname in sorted(os.listdir(trace_dir)):
+        if fname.startswith('events-') and fname.endswith('.jsonl'):
+            with open(op.join(trace_dir, fname)) as f:
+                events.extend(json.loads(l) for l in f if l.strip())
+    events.sort(key=lambda e: e['ts'])
+    with open(out_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return out_path
+
+
+@contextmanager
+def trace(out_path):
+    """
+    Records the events from all profiled interfaces run within the context,
+    e.g. a whole Analysis derivation, and saves them to a Chrome trace file
+
+        with trace('std_dev_trace.json'):
+            analysis.data('std_dev', derive=True)
+    """
+    prev_trace_dir = os.environ.get(TRACE_DIR_ENV)
+    trace_dir = tempfile.mkdtemp(prefix='trace-')
+    os.environ[TRACE_DIR_ENV] = trace_dir
+    try:
+        yield
+    finally:
+        if prev_trace_dir is None:
+            del os.environ[TRACE_DIR_ENV]
+        else:
+            os.environ[TRACE_DIR_ENV] = prev_trace_dir
+        merge_trace_events(trace_dir, out_path)
+        shutil.rmtree(trace_dir, ignore_errors=True)
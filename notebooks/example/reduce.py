@@ -0,0 +1,120 @@
+from nipype import Node, JoinNode
+from nipype.interfaces.utility import IdentityInterface
+
+
+def group_ids(ids, fan_in):
+    """
+    Arranges a list of IDs into a tree in which no node has more than
+    `fan_in` children.
+
+    Parameters
+    ----------
+    ids : list[str]
+        The IDs to group (e.g. subject IDs)
+    fan_in : int
+        The maximum number of children of each node in the tree
+
+    Returns
+    -------
+    levels : list
+        The group keys at the top of the tree followed by a dictionary for
+        each subsequent level mapping the key of each group to the keys of
+        its children. The keys of the last level are the IDs themselves
+    """
+    if fan_in < 2:
+        raise ValueError("Fan-in must be at least 2 ({})".format(fan_in))
+    ids = list(ids)
+    if not ids:
+        raise ValueError("No IDs to group")
+    # The number of levels, counted with integer arithmetic as the
+    # logarithm is inexact for powers of the fan-in (e.g. log(125, 5) > 3)
+    depth = 1
+    num_groups = len(ids)
+    while num_groups > fan_in:
+        num_groups = -(-num_groups // fan_in)
+        depth += 1
+    levels = []
+    children = ids
+    for level in reversed(range(depth - 1)):
+        parents = {}
+        for i in range(0, len(children), fan_in):
+            parents['{}_{}'.format(level, i // fan_in)] = children[
+                i:i + fan_in]
+        levels.append(parents)
+        children = list(parents)
+    levels.append(children)
+    return list(reversed(levels))
+
+
+def add_tree_reduction(workflow, ids, id_field, process, process_out,
+                       reducer, reducer_in, reducer_out, fan_in=16,
+                       name='tree'):
+    """
+    Adds a hierarchical reduction over a list of IDs to a Nipype workflow,
+    as an alternative to iterating over all the IDs in one node and joining
+    them all in a single JoinNode.
+
+    The IDs are arranged in a tree (see `group_ids`) that is iterated over
+    with dependent iterables (i.e. `itersource`). The `reducer` is then
+    applied at each level of the tree, so no join node receives more than
+    `fan_in` inputs, and the number of inputs to be hashed and pickled in each
+    node grows with the fan-in rather than the number of IDs. The reducer
+    must be able to reduce its own outputs, e.g. ExtractMetrics with
+    in_partials/out_partial.
+
+    This is a helper for plain Nipype workflows, in which the iterables are
+    set by the workflow itself (e.g. notebooks/scripts/ANTS_registration.py).
+    Arcana creates the iterables and joins over subjects and visits of
+    its pipelines, so it can't be used in them (ToyAnalysis instead merges
+    per-subject partial statistics, see 'subject_statistics_pipeline').
+
+    Parameters
+    ----------
+    workflow : nipype.Workflow
+        The workflow to add the reduction to
+    ids : list[str]
+        The IDs to iterate over (e.g. subject IDs)
+    id_field : str
+        The name of the input of the `process` node that receives the ID
+    process : nipype.Node
+        The node that processes each ID, which must be already added to the
+        workflow (along with any nodes it is connected to downstream of it)
+    process_out : str
+        The output of `process` to be reduced
+    reducer : nipype.interfaces.base.BaseInterface
+        The interface used to reduce each group of outputs
+    reducer_in : str
+        The list input of the reducer
+    reducer_out : str
+        The output of the reducer, which is connected to `reducer_in` of the
+        reducer at the next level
+    fan_in : int
+        The maximum number of inputs to each reduction node
+    name : str
+        Prefix for the names of the nodes added to the workflow
+
+    Returns
+    -------
+    root : nipype.JoinNode
+        The reduction node at the top of the tree
+    """
+    levels = group_ids(ids, fan_in)
+    iter_nodes = []
+    for i, level in enumerate(levels):
+        field = id_field if i == len(levels) - 1 else 'group'
+        iter_node = Node(IdentityInterface(fields=['parent', field]),
+                         name='{}_iter{}'.format(name, i))
+        iter_node.iterables = (field, level)
+        if iter_nodes:
+            iter_node.itersource = (iter_nodes[-1].name, 'group')
+            workflow.connect(iter_nodes[-1], 'group', iter_node, 'parent')
+        iter_nodes.append(iter_node)
+    workflow.connect(iter_nodes[-1], id_field, process, id_field)
+    # Reduce up from the leaves to the root of the tree
+    prev_node, prev_out = process, process_out
+    for i, iter_node in reversed(list(enumerate(iter_nodes))):
+        reduce_node = JoinNode(reducer, name='{}_reduce{}'.format(name, i),
+                               joinsource=iter_node, joinfield=[reducer_in])
+        workflow.connect(prev_node, prev_out, reduce_node, reducer_in)
+        prev_node, prev_out = reduce_node, reducer_out
+    return prev_node
@@ -0,0 +1,138 @@
+from nipype import Workflow, Node
+from nipype.interfaces.ants import Registration
+from nipype.interfaces.utility import IdentityInterface
+from example.interfaces import PrepareTemplate
+
+
+# Inputs of Registration that take a value for each stage
+STAGE_INPUTS = (
+    'transforms', 'transform_parameters', 'metric', 'metric_weight',
+    'radius_or_number_of_bins', 'sampling_strategy', 'sampling_percentage',
+    'number_of_iterations', 'convergence_threshold',
+    'convergence_window_size', 'smoothing_sigmas', 'sigma_units',
+    'shrink_factors', 'use_histogram_matching', 'restrict_deformation',
+    'fixed_image_masks', 'moving_image_masks')
+
+# Outputs of the final stage that are passed to the output node
+OUTPUT_FIELDS = ('warped_image', 'inverse_warped_image',
+                 'composite_transform', 'inverse_composite_transform')
+
+
+def staged_registration(name='antsreg', mem_gb=None, template_cache_dir=None,
+                        **inputs):
+    """
+    Creates a workflow that runs a multi-stage ANTs registration (e.g.
+    Rigid -> Affine -> SyN) as a separate Registration node for each stage,
+    with the composite transform of each stage used as the initial moving
+    transform of the next one.
+
+    Each stage is cached by Nipype with its own inputs and provenance, so
+    if the registration is interrupted, or only the parameters of the later
+    stages are changed (e.g. the 'number_of_iterations' of the SyN stage),
+    the earlier stages aren't run again.
+
+    Parameters
+    ----------
+    name : str
+        The name of the workflow
+    mem_gb : float | None
+        The estimated peak memory of each stage
+    template_cache_dir : str | None
+        If provided, the fixed image is prepared once and shared between
+        registrations through a cache in this directory (see
+        example.image.cached_template)
+    **inputs
+        The inputs of the Registration interface, as for a single multi-stage
+        node. Inputs that are lists with a value for each stage (see
+        STAGE_INPUTS) are split between the stages, and the other inputs are
+        passed to every stage. The warped images are only generated by the
+        final stage
+
+    Returns
+    -------
+    workflow : nipype.Workflow
+        A workflow with 'fixed_image' and 'moving_image' fields in its
+        'inputnode' and the outputs of the final stage ('warped_image',
+        'inverse_warped_image', 'composite_transform' and
+        'inverse_composite_transform') in its 'outputnode'
+    """
+    transforms = inputs.pop('transforms')
+    num_stages = len(transforms)
+    fixed_image = inputs.pop('fixed_image', None)
+    stage_inputs = {}
+    for input_name in STAGE_INPUTS[1:]:
+        value = inputs.get(input_name)
+        if isinstance(value, (list, tuple)) and len(value) == num_stages > 1:
+            stage_inputs[input_name] = inputs.pop(input_name)
+    output_warped_image = inputs.pop('output_warped_image', False)
+    output_inverse_warped_image = inputs.pop('output_inverse_warped_image',
+                                             False)
+    initial_moving_transform_com = inputs.pop('initial_moving_transform_com',
+                                              None)
+    node_kwargs = {'mem_gb': mem_gb} if mem_gb is not None else {}
+
+    workflow = Workflow(name=name)
+    inputnode = Node(IdentityInterface(fields=['fixed_image',
+                                               'moving_image']),
+                     name='inputnode')
+    outputnode = Node(IdentityInterface(fields=list(OUTPUT_FIELDS)),
+                      name='outputnode')
+
+    if template_cache_dir is not None:
+        fixed_image_source = Node(
+            PrepareTemplate(cache_dir=template_cache_dir),
+            name='prepare_template')
+        fixed_image_field = 'out_file'
+        # A fixed template is set directly instead of through the input node,
+        # which is expanded for each subject when the moving image is iterated
+        # over, so the template is only prepared once
+        if fixed_image is not None:
+            fixed_image_source.inputs.in_file = fixed_image
+        else:
+            workflow.connect(inputnode, 'fixed_image',
+                             fixed_image_source, 'in_file')
+    else:
+        if fixed_image is not None:
+            inputnode.inputs.fixed_image = fixed_image
+        fixed_image_source = inputnode
+        fixed_image_field = 'fixed_image'
+
+    prev_stage = None
+    for i, transform in enumerate(transforms):
+        is_final = i == num_stages - 1
+        stage_kwargs = dict(inputs)
+        stage_kwargs.update((n, [v[i]]) for n, v in stage_inputs.items())
+        stage_kwargs.update(
+            transforms=[transform],
+            # The composite transform of each stage, which includes the
+            # initial moving transform, initialises the next stage
+            write_composite_transform=True,
+            collapse_output_transforms=True,
+            output_warped_image=output_warped_image if is_final else False,
+            output_inverse_warped_image=(output_inverse_warped_image
+                                         if is_final else False))
+        if prev_stage is None and initial_moving_transform_com is not None:
+            stage_kwargs['initial_moving_transform_com'] = (
+                initial_moving_transform_com)
+        stage = Node(Registration(**stage_kwargs),
+                     name='stage{}_{}'.format(i + 1, transform.lower()),
+                     **node_kwargs)
+        workflow.connect(fixed_image_source, fixed_image_field,
+                         stage, 'fixed_image')
+        workflow.connect(inputnode, 'moving_image', stage, 'moving_image')
+        if prev_stage is not None:
+            workflow.connect(prev_stage, 'composite_transform',
+                             stage, 'initial_moving_transform')
+        prev_stage = stage
+
+    workflow.connect(prev_stage, 'composite_transform',
+                     outputnode, 'composite_transform')
+    workflow.connect(prev_stage, 'inverse_composite_transform',
+                     outputnode, 'inverse_composite_transform')
+    if output_warped_image:
+        workflow.connect(prev_stage, 'warped_image',
+                         outputnode, 'warped_image')
+    if output_inverse_warped_image:
+        workflow.connect(prev_stage, 'inverse_warped_image',
+                         outputnode, 'inverse_warped_image')
+    return workflow
@@ -0,0 +1,122 @@
+import numpy
+from nipype import logging
+from nipype.pipeline.engine import MapNode
+from nipype.pipeline.plugins.multiproc import MultiProcPlugin
+
+
+logger = logging.getLogger('nipype.workflow')
+
+# The private attributes of MultiProcPlugin that the adaptation of the thread
+# counts relies on, which were written against Nipype 1.11 (see
+# scripts/test_scheduler.py). If a version of Nipype doesn't have them, the
+# thread counts aren't adapted and the plugin behaves as MultiProc
+MULTIPROC_INTERNALS = ('procs', 'depidx', 'proc_done', 'pending_tasks',
+                       'processors', 'memory_gb', '_check_resources')
+
+
+class ResourcePackingMixin(object):
+    """
+    Mixin for the MultiProc plugin (and plugins derived from it) that adapts
+    the number of threads of the nodes that are ready to run to the number of
+    free processors, before they are packed into the free processors and
+    memory by MultiProc.
+
+    The free processors are shared between the ready jobs, accounting for the
+    jobs that can't be adapted and the number of jobs that fit in the free
+    memory (from their 'mem_gb' estimates). So when only a few jobs are ready
+    they are given more threads, e.g. the last subjects of an iterable, and
+    when more jobs are ready than there are processors for at their declared
+    thread counts, they are given fewer threads so more of them run at once.
+
+    Only nodes whose interfaces have a 'num_threads' input that isn't hashed
+    (e.g. ANTs, FSL and the interfaces in example.interfaces) are adapted,
+    so changing the number of threads doesn't change the hash of the node.
+
+    In addition to the arguments of MultiProc, the plugin accepts
+
+    - adapt_threads: whether to adapt the number of threads of nodes
+        (default True)
+    - min_threads: the minimum number of threads given to a node (default 1)
+    - max_threads: the maximum number of threads given to a node (defaults
+        to 'n_procs')
+
+    The adaptation uses private attributes of MultiProc (see
+    MULTIPROC_INTERNALS), so it is skipped, with a warning, on versions of
+    Nipype that don't have them
+    """
+
+    def _prerun_check(self, graph):
+        # Adaptable nodes that declare more threads than there are processors
+        # are capped rather than rejected as needing insufficient resources
+        if self.plugin_args.get('adapt_threads', True):
+            for node in graph.nodes():
+                if (self._is_adaptable(node)
+                        and node.n_procs > self.processors):
+                    node.n_procs = self.processors
+        return super()._prerun_check(graph)
+
+    def _send_procs_to_workers(self, updatehash=False, graph=None):
+        if (self.plugin_args.get('adapt_threads', True)
+                and self._supports_adaptation()):
+            self._adapt_threads()
+        return super()._send_procs_to_workers(updatehash=updatehash,
+                                              graph=graph)
+
+    def _adapt_threads(self):
+        # Jobs that are ready to run, as selected by MultiProc
+        jobids = numpy.flatnonzero(
+            ~self.proc_done & (self.depidx.sum(axis=0) == 0).__array__())
+        free_memory_gb, free_processors = self._check_resources(
+            self.pending_tasks)[:2]
+        adaptable = []
+        fixed_threads = 0
+        for jobid in jobids:
+            if self._is_adaptable(self.procs[jobid]):
+                adaptable.append(jobid)
+            else:
+                fixed_threads += min(self.procs[jobid].n_procs,
+                                     self.processors)
+        available = free_processors - fixed_threads
+        if not adaptable or available <= 0:
+            return
+        # The number of the adaptable jobs that fit in the free memory
+        mem_gb = numpy.cumsum([min(self.procs[j].mem_gb, self.memory_gb)
+                               for j in adaptable])
+        num_fit = max(int(numpy.searchsorted(mem_gb, free_memory_gb,
+                                             side='right')), 1)
+        share = available // min(len(adaptable), num_fit)
+        min_threads = self.plugin_args.get('min_threads', 1)
+        max_threads = min(self.plugin_args.get('max_threads', self.processors),
+                          self.processors)
+        for jobid in adaptable:
+            self.procs[jobid].n_procs = min(max(share, min_threads),
+                                            max_threads)
+
+    def _supports_adaptation(self):
+        missing = [a for a in MULTIPROC_INTERNALS if not hasattr(self, a)]
+        if missing:
+            if not getattr(self, '_warned_unsupported', False):
+                logger.warning(
+                    "Not adapting the number of threads of nodes as this "
+                    "version of Nipype's MultiProc plugin doesn't have '%s'",
+                    "', '".join(missing))
+                self._warned_unsupported = True
+            return False
+        return True
+
+    @classmethod
+    def _is_adaptable(cls, node):
+        if isinstance(node, MapNode):
+            return False
+        trait = node.interface.inputs.trait('num_threads')
+        return trait is not None and bool(trait.nohash)
+
+
+class PackingMultiProcPlugin(ResourcePackingMixin, MultiProcPlugin):
+    """
+    The MultiProc plugin with the number of threads of nodes adapted to the
+    free processors (see ResourcePackingMixin), e.g.
+
+        workflow.run(plugin=PackingMultiProcPlugin(
+            plugin_args={'n_procs': 16, 'memory_gb': 32}))
+    """
@@ -0,0 +1,189 @@
+import json
+import numpy
+
+
+class RunningStats(object):
+    """
+    Accumulates summary statistics over a stream of values using Welford's
+    algorithm, so that memory use doesn't grow with the number of values.
+
+    The accumulated state (count, mean and M2, plus optional min/max and
+    quantile sketch) can be saved and merged with the state accumulated over
+    another group of values. Merging is exact for the count, mean, variance,
+    min and max (Chan et al.'s parallel update) and approximate only for the
+    quantiles.
+
+    Parameters
+    ----------
+    track_range : bool
+        Whether to track the minimum and maximum values
+    sketch_size : int | None
+        The maximum number of centroids held in the quantile sketch. If None
+        quantiles are not tracked
+    """
+
+    def __init__(self, track_range=True, sketch_size=None):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.track_range = track_range
+        self.min = numpy.inf if track_range else None
+        self.max = -numpy.inf if track_range else None
+        self.sketch = (QuantileSketch(sketch_size)
+                       if sketch_size is not None else None)
+
+    def update(self, values):
+        """
+        Folds a chunk of values into the accumulated statistics. The chunk is
+        reduced with numpy and then merged in, which is both faster and more
+        numerically stable than updating one value at a time
+        """
+        values = numpy.asarray(values, dtype=numpy.float64).ravel()
+        if not len(values):
+            return self
+        chunk = type(self)(track_range=self.track_range)
+        chunk.count = len(values)
+        chunk.mean = float(values.mean())
+        chunk.m2 = float(((values - chunk.mean) ** 2).sum())
+        if self.track_range:
+            chunk.min = float(values.min())
+            chunk.max = float(values.max())
+        self._merge_moments(chunk)
+        if self.sketch is not None:
+            self.sketch.update(values)
+        return self
+
+    def merge(self, other):
+        """
+        Merges the state accumulated by another RunningStats object into this
+        one, as if all its values had been passed to this object
+        """
+        self._merge_moments(other)
+        if self.sketch is not None and other.sketch is not None:
+            self.sketch.merge(other.sketch)
+        return self
+
+    def _merge_moments(self, other):
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.count = count
+        if self.track_range and other.track_range:
+            self.min = min(self.min, other.min)
+            self.max = max(self.max, other.max)
+
+    def variance(self, ddof=0):
+        if self.count <= ddof:
+            return numpy.nan
+        return self.m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        """The standard deviation (population by default as in numpy.std)"""
+        return numpy.sqrt(self.variance(ddof=ddof))
+
+    def quantile(self, q):
+        if self.sketch is None:
+            raise ValueError("Quantiles were not tracked (sketch_size=None)")
+        return self.sketch.quantile(q)
+
+    def to_dict(self):
+        dct = {'count': self.count, 'mean': self.mean, 'm2': self.m2,
+               'track_range': self.track_range}
+        if self.track_range:
+            dct['min'] = self.min
+            dct['max'] = self.max
+        if self.sketch is not None:
+            dct['sketch'] = self.sketch.to_dict()
+        return dct
+
+    @classmethod
+    def from_dict(cls, dct):
+        stats = cls(track_range=dct['track_range'])
+        stats.count = dct['count']
+        stats.mean = dct['mean']
+        stats.m2 = dct['m2']
+        if stats.track_range:
+            stats.min = dct['min']
+            stats.max = dct['max']
+        if 'sketch' in dct:
+            stats.sketch = QuantileSketch.from_dict(dct['sketch'])
+        return stats
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.from_dict(json.load(f))
+
+
+class QuantileSketch(object):
+    """
+    A simple mergeable quantile sketch holding at most `max_size` weighted
+    centroids. When the limit is exceeded, neighbouring values are collapsed
+    into centroids of approximately equal weight
+
+    Parameters
+    ----------
+    max_size : int
+        The maximum number of centroids to hold
+    """
+
+    def __init__(self, max_size=200):
+        self.max_size = max_size
+        self.values = numpy.empty(0)
+        self.weights = numpy.empty(0)
+
+    def update(self, values):
+        values = numpy.asarray(values, dtype=numpy.float64).ravel()
+        self._add(values, numpy.ones(len(values)))
+        return self
+
+    def merge(self, other):
+        self._add(other.values, other.weights)
+        return self
+
+    def _add(self, values, weights):
+        values = numpy.concatenate((self.values, values))
+        weights = numpy.concatenate((self.weights, weights))
+        order = numpy.argsort(values, kind='mergesort')
+        self.values = values[order]
+        self.weights = weights[order]
+        if len(self.values) > self.max_size:
+            self._compress()
+
+    def _compress(self):
+        cum_weights = numpy.cumsum(self.weights)
+        # Assign each centroid to one of max_size bins of equal total weight
+        bins = numpy.minimum(
+            (cum_weights - self.weights / 2) / cum_weights[-1] * self.max_size,
+            self.max_size - 1).astype(int)
+        weights = numpy.bincount(bins, weights=self.weights)
+        sums = numpy.bincount(bins, weights=self.values * self.weights)
+        nonempty = weights > 0
+        self.weights = weights[nonempty]
+        self.values = sums[nonempty] / self.weights
+
+    def quantile(self, q):
+        if not len(self.values):
+            return numpy.nan
+        cum_weights = numpy.cumsum(self.weights) - self.weights / 2
+        return float(numpy.interp(q * self.weights.sum(), cum_weights,
+                                  self.values))
+
+    def to_dict(self):
+        return {'max_size': self.max_size,
+                'values': self.values.tolist(),
+                'weights': self.weights.tolist()}
+
+    @classmethod
+    def from_dict(cls, dct):
+        sketch = cls(dct['max_size'])
+        sketch.values = numpy.asarray(dct['values'], dtype=numpy.float64)
+        sketch.weights = numpy.asarray(dct['weights'], dtype=numpy.float64)
+        return sketch
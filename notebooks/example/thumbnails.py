@@ -0,0 +1,57 @@
+import os
+import os.path as op
+import numpy
+import nibabel as nb
+from example.arrays import save_array
+from example.utils import file_digest
+
+
+def load_slice(path, offset=10):
+    """
+    Loads an axial slice just above the middle of an image, rotated for
+    display. Only the slice is read through the image's array proxy (which
+    memory-maps uncompressed images) instead of loading the whole volume
+    """
+    img = nb.load(path)
+    cut = int(img.shape[2] / 2) + offset
+    index = (slice(None), slice(None), cut) + (0,) * (len(img.shape) - 3)
+    return numpy.rot90(numpy.asanyarray(img.dataobj[index]))
+
+
+def cached_slice(path, cache_dir=None, offset=10):
+    """
+    Loads a slice of an image (see `load_slice`), caching it in `cache_dir`
+    by the digest of the image file, so the same image is only decoded once
+    """
+    if cache_dir is None:
+        return load_slice(path, offset=offset)
+    cache_path = op.join(cache_dir, '{}_{}.npy'.format(file_digest(path),
+                                                      offset))
+    try:
+        return numpy.load(cache_path)
+    except IOError:
+        pass
+    data = load_slice(path, offset=offset)
+    os.makedirs(cache_dir, exist_ok=True)
+    save_array(data, cache_path)
+    return data
+
+
+def render_comparison(slices, suptitle, out_path, titles, figsize=(12, 4)):
+    """
+    Renders a row of slices into an image file without using pyplot, so it
+    can be called from worker processes
+    """
+    # Imported here so that pyplot's backend selection isn't affected
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    fig.suptitle(suptitle)
+    for i, (data, title) in enumerate(zip(slices, titles)):
+        ax = fig.add_subplot(1, len(slices), i + 1)
+        ax.imshow(data, cmap='gray')
+        ax.set_axis_off()
+        ax.set_title(title)
+    fig.savefig(out_path)
+    return out_path
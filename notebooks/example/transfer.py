@@ -0,0 +1,145 @@
+import os
+import os.path as op
+import errno
+import shutil
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+COPY_BUFFER_SIZE = 1024 ** 2
+
+# The Linux ioctl that clones the extents of one file into another (i.e.
+# creates a copy-on-write copy), supported by Btrfs, XFS and overlayfs
+FICLONE = 0x40049409
+
+TRANSFER_MODES = ('link', 'reflink', 'move', 'copy')
+
+
+def transfer_file(src, dst, mode='link'):
+    """
+    Transfers a file to a new path without copying its data if possible, i.e.
+    when the source and destination are on the same file system, falling back
+    to a streaming copy otherwise. The destination is replaced atomically, so
+    a partially written file is never seen at it
+
+    Parameters
+    ----------
+    src : str
+        The path of the file to transfer
+    dst : str
+        The path to transfer it to. Its directory must exist
+    mode : str
+        How the file is transferred when it is on the same file system as the
+        destination
+
+        - 'link': hard-linked, falling back to a reflink (copy-on-write
+            clone). The file therefore mustn't be modified in place afterwards
+        - 'reflink': cloned (on file systems that support it), so the source
+            and destination can be modified independently
+        - 'move': renamed, i.e. the source is removed (and is removed after
+            being copied when on a different file system)
+        - 'copy': always copied
+
+    Returns
+    -------
+    method : str
+        How the file was transferred, one of 'hardlink', 'reflink', 'rename'
+        or 'copy'
+    """
+    if mode not in TRANSFER_MODES:
+        raise ValueError("Unrecognised transfer mode '{}' (can be one of {})"
+                         .format(mode, "', '".join(TRANSFER_MODES)))
+    src_stat = os.stat(src)
+    try:
+        dst_stat = os.stat(dst)
+    except OSError:
+        dst_stat = None
+    if dst_stat is not None and op.samestat(src_stat, dst_stat):
+        # Already linked by a previous run
+        if mode == 'move':
+            os.remove(src)
+        return 'hardlink'
+    dst_dir = op.dirname(op.abspath(dst))
+    same_fs = src_stat.st_dev == os.stat(dst_dir).st_dev
+    tmp_path = op.join(dst_dir, '.{}.{}.tmp'.format(op.basename(dst),
+                                                    os.getpid()))
+    if op.lexists(tmp_path):
+        os.remove(tmp_path)  # Left by an interrupted transfer
+    if same_fs and mode == 'move':
+        os.replace(src, dst)
+        return 'rename'
+    method = None
+    if same_fs and mode == 'link':
+        try:
+            os.link(src, tmp_path)
+            method = 'hardlink'
+        except OSError:
+            pass  # e.g. file systems that don't support hard links
+    if method is None and same_fs and mode in ('link', 'reflink'):
+        if _reflink(src, tmp_path):
+            method = 'reflink'
+    if method is None:
+        _stream_copy(src, tmp_path)
+        method = 'copy'
+    try:
+        os.replace(tmp_path, dst)
+    except OSError:
+        os.remove(tmp_path)
+        raise
+    if mode == 'move':
+        os.remove(src)
+    return method
+
+
+def transfer_tree(src, dst, mode='link'):
+    """
+    Transfers the files in a directory (see `transfer_file`), creating the
+    sub-directories of the destination as required
+
+    Returns
+    -------
+    transferred : list[tuple[str, str, int]]
+        The destination path, transfer method and size of each file
+    """
+    transferred = []
+    for root, _, fnames in os.walk(src):
+        dst_root = op.join(dst, op.relpath(root, src))
+        os.makedirs(dst_root, exist_ok=True)
+        for fname in fnames:
+            src_path = op.join(root, fname)
+            size = op.getsize(src_path)
+            dst_path = op.join(dst_root, fname)
+            transferred.append((dst_path, transfer_file(src_path, dst_path,
+                                                        mode=mode), size))
+    if mode == 'move':
+        shutil.rmtree(src)
+    return transferred
+
+
+def _reflink(src, dst):
+    if fcntl is None:
+        return False
+    with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+        try:
+            fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+        except OSError as e:
+            if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+                           errno.EINVAL, errno.EBADF):
+                cloned = False
+            else:
+                raise
+        else:
+            cloned = True
+    if cloned:
+        shutil.copystat(src, dst)
+    else:
+        os.remove(dst)
+    return cloned
+
+
+def _stream_copy(src, dst):
+    with open(src, 'rb') as f_in, open(dst, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out, COPY_BUFFER_SIZE)
+    shutil.copystat(src, dst)
@@ -0,0 +1,16 @@
+import hashlib
+
+
+HASH_CHUNK_SIZE = 1024 ** 2
+
+
+def file_digest(path):
+    """
+    Returns the SHA-1 digest of the contents of a file, which is read a chunk
+    at a time so it is never all held in memory
+    """
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
@@ -1,30 +1,63 @@
-import re  # Regular-expressions module
+import csv
+import shlex
+import shutil
 import os.path as op
-from nipype.interfaces.base import (CommandLine, traits, TraitedSpec,
-                                    BaseInterface, BaseInterfaceInputSpec,
-                                    File)
+from nipype.interfaces.base import (traits, TraitedSpec, InputMultiPath,
+                                    OutputMultiObject, File, isdefined)
 from nipype.interfaces.matlab import MatlabCommand, MatlabInputSpec
+from example.profiling import ProfiledInterfaceMixin  # qa pylint: disable=unrecognised-import
+from example.matlab_pool import PooledMatlabMixin, get_pool  # qa pylint: disable=unrecognised-import
+from example.image import iter_slabs  # qa pylint: disable=unrecognised-import
 
 
 class AltBrainVolumeMATLABInputSpec(MatlabInputSpec):
-    in_file = File(exists=True, mandatory=True)
+    in_files = InputMultiPath(
+        File(exists=True), mandatory=True,
+        desc=("The brain image(s) to calculate the volume of, which are all "
+              "processed by a single MATLAB script"))
+    use_numpy = traits.Bool(
+        desc=("Count the voxels in-process with NumPy instead of MATLAB. "
+              "Defaults to using NumPy only if MATLAB isn't available"))
 
 
 class AltBrainVolumeMATLABOutputSpec(TraitedSpec):
-    volume = traits.Int(desc='brain volume')
+    volume = OutputMultiObject(traits.Int,
+                               desc='brain volume (in voxels) of each image')
+    out_file = File(exists=True,
+                    desc="CSV file with the path and volume of each image")
     raw_output = traits.Str()
 
 
-class AltBrainVolumeMATLAB(MatlabCommand):
+class AltBrainVolumeMATLAB(ProfiledInterfaceMixin, PooledMatlabMixin,
+                           MatlabCommand):
+    """
+    Calculates the brain volume with MATLAB. The script is run in a pool of
+    long-lived MATLAB sessions if EXAMPLE_MATLAB_POOL_SIZE is set (see
+    example.matlab_pool), so MATLAB isn't started for each call.
+
+    A batch of images is processed by a single script, which writes the
+    volumes to a CSV file instead of printing them, and the volumes are
+    counted with NumPy when MATLAB isn't available
+    """
+
     input_spec = AltBrainVolumeMATLABInputSpec
     output_spec = AltBrainVolumeMATLABOutputSpec
 
+    out_fname = 'volumes.csv'
+
     def _generate_script(self):
         """This is where you implement your script"""
+        in_files = ', '.join("'{}'".format(f.replace("'", "''"))
+                             for f in self.inputs.in_files)
         return """
-            data = niftiread('{in_file}');
-            total = sum(data(:) > 0)
-        """.format(in_file=self.inputs.in_file)
+            in_files = {{{in_files}}};
+            fid = fopen('{out_file}', 'w');
+            for i = 1:numel(in_files)
+                data = niftiread(in_files{{i}});
+                fprintf(fid, '%s,%d\\n', in_files{{i}}, sum(data(:) > 0));
+            end
+            fclose(fid);
+        """.format(in_files=in_files, out_file=self.out_fname)
 
     def run(self, *args, **kwargs):
         # Inject our script into the Matlab input interface
@@ -32,10 +65,18 @@ class AltBrainVolumeMATLAB(MatlabCommand):
         return super().run(*args, **kwargs)
 
     def _run_interface(self, runtime):
+        if self._use_numpy():
+            self._volumes = [self._count_voxels(f)
+                             for f in self.inputs.in_files]
+            with open(self.out_fname, 'w') as f:
+                csv.writer(f, lineterminator='\n').writerows(
+                    zip(self.inputs.in_files, self._volumes))
+            self._raw_output = ''
+            return runtime
         runtime = super()._run_interface(runtime)
         # Save the stdout output to use in _list_outputs
         self._raw_output = runtime.stdout
-
+        self._volumes = self._read_volumes()
         return runtime
 
     def _list_outputs(self):
@@ -43,19 +84,46 @@ class AltBrainVolumeMATLAB(MatlabCommand):
         outputs = self._outputs().get()
         # Save the raw output to the outputs dictionary
         outputs['raw_output'] = self._raw_output
-        # Use a regular expression to extract out the volume from the matlab
-        # output
-        match = re.search(r'total =\s+([0-9]+)', self._raw_output)
-        if match:
-            outputs['volume'] = int(match.group(1))
-        else:
-            raise Exception(("Did not find match for 'total =\\s+([0-9]+)' in "
-                             "raw output:\n\n{}").format(self._raw_output))
-
+        outputs['volume'] = self._volumes
+        outputs['out_file'] = op.abspath(self.out_fname)
         return outputs
 
+    def _use_numpy(self):
+        if isdefined(self.inputs.use_numpy):
+            return self.inputs.use_numpy
+        return (get_pool() is None
+                and shutil.which(shlex.split(self.cmd)[0]) is None)
+
+    def _read_volumes(self):
+        try:
+            with open(self.out_fname) as f:
+                # The paths may contain commas, so split on the last one
+                volumes = dict(l.rstrip('\n').rsplit(',', 1) for l in f)
+        except IOError:
+            raise Exception(("MATLAB script didn't write '{}', raw output:"
+                             "\n\n{}").format(self.out_fname,
+                                              self._raw_output))
+        try:
+            return [int(volumes[f]) for f in self.inputs.in_files]
+        except KeyError as e:
+            raise Exception(("Did not find volume of {} in '{}', raw output:"
+                             "\n\n{}").format(e, self.out_fname,
+                                              self._raw_output))
+
+    @staticmethod
+    def _count_voxels(in_file):
+        # Count the stored values like 'niftiread' (which doesn't apply the
+        # scaling in the header), one slab at a time
+        return int(sum((slab > 0).sum()
+                       for _, slab in iter_slabs(in_file, scaled=False)))
+
+
+if __name__ == '__main__':
 
-matlab = AltBrainVolumeMATLAB(in_file=op.abspath(
-    'notebooks/data/ds000114/sub-01/ses-test/anat/sub-01_ses-test_T1w.nii.gz'))
-result = matlab.run()
-print(result.outputs)
+    data_dir = op.abspath('notebooks/data/ds000114')
+    matlab = AltBrainVolumeMATLAB(in_files=[
+        op.join(data_dir, 'sub-{:02}'.format(i), 'ses-test', 'anat',
+                'sub-{:02}_ses-test_T1w.nii.gz'.format(i))
+        for i in range(1, 3)])
+    result = matlab.run()
+    print(result.outputs)
@@ -0,0 +1,200 @@
+"""
+Benchmarks the derivation of ToyAnalysis 'std_dev' over synthetic depth-2
+datasets of increasing size, recording the end-to-end time, the time spent in
+each node, the peak RSS and the number of files created. The results are saved
+to JSON and can be compared against those of a previous (baseline) run, e.g.
+
+    python scripts/benchmark_toy_analysis.py --sizes 10 1000 10000 \
+        --out bench.json
+    # ... make changes ...
+    python scripts/benchmark_toy_analysis.py --sizes 10 1000 10000 \
+        --out bench-new.json --baseline bench.json
+"""
+import os
+import os.path as op
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import argparse
+from collections import defaultdict
+import numpy
+from nipype.utils.filemanip import loadpkl
+from arcana import Dataset, SingleProc, MultiProc
+from example.analysis import ToyAnalysis  # qa pylint: disable=unrecognised-import
+
+
+METRICS = {'height': (170.0, 10.0), 'weight': (70.0, 12.0),
+           'waist': (85.0, 10.0), 'bmi': (24.0, 4.0),
+           'heart_rate': (70.0, 10.0)}
+
+
+def generate_toy_dataset(path, num_sessions, num_visits=2, seed=0):
+    """
+    Generates a depth-2 dataset (i.e. <subject>/<visit>/metrics.txt) with
+    randomly generated body metrics. Every subject has the same visits, as
+    required by Arcana, so the number of sessions must be a multiple of the
+    number of visits
+    """
+    if num_sessions % num_visits:
+        raise ValueError(
+            "Number of sessions ({}) isn't a multiple of the number of visits "
+            "({})".format(num_sessions, num_visits))
+    rng = numpy.random.RandomState(seed)
+    for i in range(num_sessions):
+        session_dir = op.join(path, 'subject{}'.format(i // num_visits),
+                              'visit{}'.format(i % num_visits))
+        os.makedirs(session_dir)
+        with open(op.join(session_dir, 'metrics.txt'), 'w') as f:
+            for name, (mean, std) in METRICS.items():
+                f.write('{} {:.2f}\n'.format(name, rng.normal(mean, std)))
+
+
+def node_timings(work_dir):
+    """
+    Collects the run times of the nodes from the result files Nipype saves
+    in the working directory
+    """
+    durations = defaultdict(list)
+    for dpath, _, fnames in os.walk(work_dir):
+        for fname in fnames:
+            if not (fname.startswith('result_') and fname.endswith('.pklz')):
+                continue
+            result = loadpkl(op.join(dpath, fname))
+            duration = getattr(result.runtime, 'duration', None)
+            if duration is not None:
+                durations[fname[len('result_'):-len('.pklz')]].append(
+                    duration)
+    return {n: {'count': len(d), 'total': sum(d), 'mean': sum(d) / len(d),
+                'max': max(d)}
+            for n, d in durations.items()}
+
+
+def count_files(path):
+    return sum(len(fnames) for _, _, fnames in os.walk(path))
+
+
+def peak_rss():
+    """
+    Peak RSS of this process and its (waited-for) children in MB. Note that
+    these are high-water marks over the whole run, so sizes should be
+    benchmarked in ascending order
+    """
+    # ru_maxrss is in kB on Linux and bytes on macOS
+    scale = 1024 ** 2 if sys.platform == 'darwin' else 1024
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        'children': (resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+                     / scale)}
+
+
+def run_benchmark(num_sessions, base_dir, num_visits=2, processor='single',
+                  num_processes=4, parameters=None):
+    dataset_dir = op.join(base_dir, 'dataset')
+    work_dir = op.join(base_dir, 'work')
+    generate_toy_dataset(dataset_dir, num_sessions, num_visits=num_visits)
+    num_input_files = count_files(dataset_dir)
+    if processor == 'multi':
+        proc = MultiProc(work_dir, num_processes=num_processes)
+    else:
+        proc = SingleProc(work_dir)
+    analysis = ToyAnalysis(
+        'benchmark',
+        dataset=Dataset(dataset_dir, depth=2),
+        processor=proc,
+        inputs={'body_metrics': 'metrics'},
+        parameters=parameters)
+    start = time.perf_counter()
+    std_dev = analysis.data('std_dev', derive=True).value()
+    wall_time = time.perf_counter() - start
+    return {
+        'num_sessions': num_sessions,
+        'wall_time': wall_time,
+        'std_dev': std_dev,
+        'nodes': node_timings(work_dir),
+        'peak_rss_mb': peak_rss(),
+        'files_created': {
+            'work': count_files(work_dir),
+            'dataset': count_files(dataset_dir) - num_input_files}}
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints the ratio of the wall times against the baseline and returns the
+    sizes that regressed by more than the tolerance
+    """
+    baseline = {r['num_sessions']: r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        base = baseline.get(result['num_sessions'])
+        if base is None:
+            continue
+        ratio = result['wall_time'] / base['wall_time']
+        print('{:>8} sessions: {:8.2f}s vs {:8.2f}s baseline ({:.2f}x)'.format(
+            result['num_sessions'], result['wall_time'], base['wall_time'],
+            ratio))
+        if ratio > 1 + tolerance:
+            regressions.append(result['num_sessions'])
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000],
+                        help=("Numbers of sessions to benchmark (multiples of "
+                              "the number of visits)"))
+    parser.add_argument('--visits', type=int, default=2,
+                        help="Number of visits per subject")
+    parser.add_argument('--processor', choices=('single', 'multi'),
+                        default='single')
+    parser.add_argument('--num_processes', type=int, default=4)
+    parser.add_argument('--metric', default='height',
+                        help="The metric of interest")
+    parser.add_argument('--use_metrics_index', action='store_true',
+                        default=False)
+    parser.add_argument('--out', default='bench_output.json',
+                        help="Path to save the JSON results to")
+    parser.add_argument('--baseline', default=None,
+                        help="JSON results of a previous run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help=("Fractional increase in wall time over the "
+                              "baseline considered a regression"))
+    parser.add_argument('--keep', action='store_true', default=False,
+                        help="Don't delete the generated datasets")
+    args = parser.parse_args()
+    uneven = [s for s in args.sizes if s % args.visits]
+    if uneven:
+        parser.error("Sizes must be multiples of the number of visits ({}): {}"
+                     .format(args.visits, ', '.join(str(s) for s in uneven)))
+
+    parameters = {'metric_of_interest': args.metric,
+                  'use_metrics_index': args.use_metrics_index}
+    results = []
+    for size in args.sizes:
+        base_dir = tempfile.mkdtemp(prefix='toy-bench-{}-'.format(size))
+        try:
+            result = run_benchmark(
+                size, base_dir, num_visits=args.visits,
+                processor=args.processor, num_processes=args.num_processes,
+                parameters=parameters)
+        finally:
+            if not args.keep:
+                shutil.rmtree(base_dir, ignore_errors=True)
+        print('{:>8} sessions: {:8.2f}s, peak RSS {:.0f}MB, {} files'.format(
+            size, result['wall_time'], result['peak_rss_mb']['self'],
+            sum(result['files_created'].values())))
+        results.append(result)
+
+    with open(args.out, 'w') as f:
+        json.dump({'args': vars(args), 'results': results}, f, indent=2,
+                  default=float)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions found for sizes: {}".format(
+                ', '.join(str(s) for s in regressions)))
+            sys.exit(1)
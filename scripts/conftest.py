@@ -0,0 +1,11 @@
+import os.path as op
+import sys
+
+# The example package lives in the notebooks directory, which is the working
+# directory of the notebooks and scripts
+sys.path.insert(0, op.join(op.dirname(op.dirname(op.abspath(__file__))),
+                           'notebooks'))
+
+# Scripts that run whole analyses when they are imported, rather than tests
+collect_ignore = ['test_entrypoint.py', 'test_banana_extension.py',
+                  'alt_matlab_interface.py', 'benchmark_toy_analysis.py']
@@ -0,0 +1,183 @@
+"""
+A stand-in for a MATLAB session, used to test example.matlab_pool without
+MATLAB. It reads commands from its standard input and interprets the small
+subset of MATLAB used by the job templates of the pool, plus the following
+statements in scripts:
+
+    addpath('dir')      prepends a directory to the search path
+    global name         declares a global variable
+    name = 1            assigns a number to a variable
+    disp(path())        prints the search path
+    disp(name)          prints a variable (raising an error if undefined)
+    error('message')    raises an error
+    pause(seconds)      sleeps
+
+The values of global variables are kept until 'clear global', so a script
+that declares a global variable again sees the value from a previous script
+unless they have been cleared, while 'clear all' and 'clear variables' only
+clear the workspace.
+"""
+import os
+import re
+import sys
+import time
+
+
+INITIAL_PATH = '/fake/toolbox/matlab'
+
+
+class FakeMatlabError(Exception):
+    pass
+
+
+class FakeMatlab(object):
+
+    def __init__(self):
+        self.path = os.environ.get('FAKE_MATLAB_PATH', INITIAL_PATH)
+        self.variables = {}
+        self.global_names = set()
+        self.globals = {}
+
+    def run_command(self, command, nested=False):
+        statements = split_statements(command)
+        i = 0
+        in_try = False
+        while i < len(statements):
+            statement = statements[i]
+            i += 1
+            if statement == 'try':
+                in_try = True
+                continue
+            if statement.startswith('catch'):
+                # Reached without an error, so skip to the end of the block
+                while statements[i] != 'end':
+                    i += 1
+                in_try = False
+                continue
+            try:
+                self.run_statement(statement)
+            except FakeMatlabError as e:
+                if not in_try:
+                    if nested:
+                        raise
+                    print('Error: ' + str(e))
+                    continue
+                while not statements[i].startswith('catch'):
+                    i += 1
+                self.variables[statements[i].split()[1]] = str(e)
+                i += 1
+                in_try = False
+
+    def run_statement(self, statement):
+        match = re.match(r"(\w+)\((.*)\)$", statement)
+        func, args = match.groups() if match else (None, None)
+        if statement == 'clear variables':
+            self.variables = {}
+        elif statement == 'clear all':
+            self.variables = {}
+            self.global_names = set()
+        elif statement == 'clear global':
+            self.global_names = set()
+            self.globals = {}
+        elif statement.startswith('global '):
+            for name in statement.split()[1:]:
+                self.global_names.add(name)
+                self.globals.setdefault(name, [])
+        elif func == 'run':
+            with open(unquote(args)) as f:
+                self.run_command(f.read(), nested=True)
+        elif func == 'cd':
+            os.chdir(unquote(args))
+        elif func == 'addpath':
+            self.path = unquote(args) + os.pathsep + self.path
+        elif func == 'path':
+            self.path = self.evaluate(args)
+        elif func == 'disp':
+            value = self.evaluate(args)
+            print(value if not isinstance(value, list) else '[]')
+        elif func == 'error':
+            raise FakeMatlabError(unquote(args))
+        elif func == 'pause':
+            time.sleep(float(args))
+        elif func == 'fprintf':
+            args = split_args(args)
+            if args[0].startswith("'"):
+                print(unquote(args[0]).replace('\\n', '\n')
+                      .replace('%d', str(self.evaluate(args[1]))), end='')
+            else:
+                # Writing a string to a file opened with fopen
+                with open(self.variables[args[0]], 'w') as f:
+                    f.write(self.evaluate(args[2]))
+            sys.stdout.flush()
+        elif func == 'fclose' or func == 'fflush':
+            pass
+        elif statement.startswith('if ') or statement in ('end', 'close all'):
+            pass
+        elif '=' in statement:
+            name, value = (s.strip() for s in statement.split('=', 1))
+            value = self.evaluate(value)
+            if name in self.global_names:
+                self.globals[name] = value
+            else:
+                self.variables[name] = value
+        elif statement:
+            raise FakeMatlabError("Undefined function '{}'".format(statement))
+
+    def evaluate(self, expr):
+        match = re.match(r"(\w+)\((.*)\)$", expr)
+        if expr == 'path()':
+            return self.path
+        if expr.startswith("'"):
+            return unquote(expr)
+        if match and match.group(1) == 'fileread':
+            with open(unquote(match.group(2))) as f:
+                return f.read()
+        if match and match.group(1) == 'fopen':
+            return unquote(split_args(match.group(2))[0])
+        if re.match(r'-?\d+(\.\d+)?$', expr):
+            return int(expr) if expr.lstrip('-').isdigit() else float(expr)
+        name = expr.split('.')[0]
+        if name in self.global_names:
+            return self.globals[name]
+        if name in self.variables:
+            return self.variables[name]
+        raise FakeMatlabError("Undefined variable '{}'".format(name))
+
+
+def split_statements(command):
+    # Split on separators that aren't within strings or brackets
+    statements = []
+    current = ''
+    in_string = False
+    depth = 0
+    for char in command:
+        if char == "'":
+            in_string = not in_string
+        elif not in_string and char in '([':
+            depth += 1
+        elif not in_string and char in ')]':
+            depth -= 1
+        elif not in_string and not depth and char in ';,\n':
+            statements.append(current.strip())
+            current = ''
+            continue
+        current += char
+    statements.append(current.strip())
+    return [s for s in statements if s]
+
+
+def split_args(args):
+    return [a.strip() for a in re.findall(r"'(?:[^']|'')*'|[^,]+", args)]
+
+
+def unquote(string):
+    return string.strip()[1:-1].replace("''", "'")
+
+
+if __name__ == '__main__':
+    matlab = FakeMatlab()
+    for line in sys.stdin:
+        if line.strip() == 'exit':
+            break
+        matlab.run_command(line)
+        sys.stdout.flush()
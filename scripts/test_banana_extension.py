@@ -12,6 +12,7 @@ from arcana import (
 from arcana import OutputFilesetSpec
 from banana.file_format import nifti_gz_format
 from example.analysis import BasicBrainAnalysis  # qa pylint: disable=unrecognised-import
+from example.interfaces import Gzip  # qa pylint: disable=unrecognised-import
 
 
 
@@ -35,8 +36,15 @@ class MyExtendedBasicBrainAnalysis(BasicBrainAnalysis, metaclass=AnalysisMetaCla
         # Set the input of the BET node so that it outputs a Skull mask
         bet.inputs.surfaces = True
 
-        pipeline.connect_output(
-            'skull_mask', bet, 'skull_mask_file', nifti_gz_format)
+        # BET writes uncompressed images so the skull mask is compressed
+        # before it is stored as an output
+        pipeline.add(
+            'compress_skull_mask',
+            Gzip(),
+            inputs={
+                'in_file': (bet, 'skull_mask_file')},
+            outputs={
+                'skull_mask': ('out_file', nifti_gz_format)})
 
         return pipeline
 
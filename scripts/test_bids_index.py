@@ -0,0 +1,111 @@
+import os
+import os.path as op
+import shutil
+from glob import glob
+import pytest
+from example.bids_index import BIDSIndex, parse_entities  # qa pylint: disable=unrecognised-import
+from example.interfaces import IndexedSelectFiles  # qa pylint: disable=unrecognised-import
+
+
+def touch(path):
+    os.makedirs(op.dirname(path), exist_ok=True)
+    with open(path, 'w'):
+        pass
+
+
+@pytest.fixture
+def dataset(tmpdir):
+    root = str(tmpdir.join('ds'))
+    touch(op.join(root, 'dataset_description.json'))
+    touch(op.join(root, '.hidden'))
+    for sub in ('01', '02', '03'):
+        for ses in ('test', 'retest'):
+            prefix = op.join(root, 'sub-' + sub, 'ses-' + ses)
+            name = 'sub-{}_ses-{}'.format(sub, ses)
+            touch(op.join(prefix, 'anat', name + '_T1w.nii.gz'))
+            touch(op.join(prefix, 'anat', name + '_T1w.json'))
+            touch(op.join(prefix, 'func', name + '_task-rest_bold.nii.gz'))
+    return root
+
+
+@pytest.fixture
+def index(dataset, tmpdir):
+    return BIDSIndex(dataset, index_dir=str(tmpdir.join('index')))
+
+
+@pytest.mark.parametrize('pattern', [
+    'sub-01/ses-test/anat/sub-01_ses-test_T1w.nii.gz',
+    'sub-*/ses-test/anat/*_T1w.nii.gz',
+    'sub-0[12]/*/*/*.json',
+    'sub-02/*/func/*',
+    'sub-*/',
+    'sub-01/*/',
+    '*',
+    '*/*/*/*',
+    'sub-01',
+    'sub-01/ses-test/anat/missing.nii.gz'])
+def test_glob_matches_glob(dataset, index, pattern):
+    assert (sorted(index.glob(pattern))
+            == sorted(glob(op.join(dataset, pattern))))
+
+
+def test_only_modified_directories_are_relisted(dataset, index, tmpdir):
+    # All directories are listed the first time
+    assert index.update() == 1 + 3 + 6 + 12
+    # and none if nothing has changed, even from a newly loaded index
+    reloaded = BIDSIndex(dataset, index_dir=str(tmpdir.join('index')))
+    assert reloaded.update() == 0
+    new_file = op.join(dataset, 'sub-02', 'ses-test', 'anat',
+                       'sub-02_ses-test_T2w.nii.gz')
+    touch(new_file)
+    assert index.update() == 1
+    assert new_file in index.glob('sub-02/ses-test/anat/*_T2w.nii.gz')
+
+
+def test_glob_only_validates_literal_prefix(dataset, index):
+    index.update()
+    touch(op.join(dataset, 'sub-01', 'ses-test', 'anat', 'new.txt'))
+    touch(op.join(dataset, 'sub-02', 'ses-test', 'anat', 'new.txt'))
+    assert len(index.glob('sub-01/*/anat/new.txt')) == 1
+    # The directories of sub-02 haven't been checked yet
+    assert not index.glob('sub-02/*/anat/new.txt', validate=False)
+    assert len(index.glob('sub-02/*/anat/new.txt')) == 1
+
+
+def test_removed_directories(dataset, index):
+    index.update()
+    shutil.rmtree(op.join(dataset, 'sub-03'))
+    assert not index.glob('sub-03/*/*/*')
+    assert not index.query(sub='03')
+
+
+def test_query_and_filter(dataset, index):
+    index.update()
+    assert index.query(sub='01', suffix='T1w', extension='.nii.gz') == [
+        op.join(dataset, 'sub-01', 'ses-test', 'anat',
+                'sub-01_ses-test_T1w.nii.gz'),
+        op.join(dataset, 'sub-01', 'ses-retest', 'anat',
+                'sub-01_ses-retest_T1w.nii.gz')][::-1]
+    assert len(index.query(datatype='func')) == 6
+    assert len(index.filter('.*T1w$', ses='test')) == 6
+
+
+def test_parse_entities():
+    assert parse_entities(
+        'sub-01/ses-test/func/sub-01_ses-test_task-rest_bold.nii.gz') == {
+            'sub': '01', 'ses': 'test', 'task': 'rest', 'suffix': 'bold',
+            'datatype': 'func', 'extension': '.nii.gz'}
+
+
+def test_indexed_select_files(dataset, tmpdir):
+    select = IndexedSelectFiles(
+        {'anat': 'sub-{subject_id}/ses-test/anat/'
+                 'sub-{subject_id}_ses-test_T1w.nii.gz',
+         'func': 'sub-{subject_id}/*/func/*.nii.gz'},
+        base_directory=dataset, index_dir=str(tmpdir.join('index')))
+    select.inputs.subject_id = '02'
+    outputs = select.run(cwd=str(tmpdir)).outputs
+    assert outputs.anat == op.join(dataset, 'sub-02', 'ses-test', 'anat',
+                                   'sub-02_ses-test_T1w.nii.gz')
+    assert outputs.func == sorted(glob(op.join(dataset, 'sub-02', '*',
+                                               'func', '*.nii.gz')))
@@ -0,0 +1,42 @@
+import os.path as op
+import numpy
+from example.interfaces import ConcatFloats, ExtractMetrics  # qa pylint: disable=unrecognised-import
+from example.arrays import load_array  # qa pylint: disable=unrecognised-import
+
+
+VALUES = [1.5, -2.25, 3.0, 1e6]
+
+
+def write_values(dir_path):
+    paths = []
+    for i, value in enumerate(VALUES):
+        path = op.join(str(dir_path), 'metric{}.txt'.format(i))
+        with open(path, 'w') as f:
+            f.write(repr(value))
+        paths.append(path)
+    return paths
+
+
+def test_concat_floats_outputs(tmpdir):
+    result = ConcatFloats(in_files=write_values(tmpdir),
+                          num_threads=3).run(cwd=str(tmpdir))
+    assert result.outputs.out_list == VALUES
+    assert result.outputs.out_array.dtype == numpy.float64
+    assert list(result.outputs.out_array) == VALUES
+    assert list(load_array(result.outputs.out_file)) == VALUES
+
+
+def test_concat_floats_file_only(tmpdir):
+    result = ConcatFloats(in_files=write_values(tmpdir),
+                          return_array=False).run(cwd=str(tmpdir))
+    assert not result.outputs.out_list
+    assert list(load_array(result.outputs.out_file)) == VALUES
+
+
+def test_out_list_connects_to_extract_metrics(tmpdir):
+    # The connection used by ToyAnalysis in the tutorials
+    concat = ConcatFloats(in_files=write_values(tmpdir)).run(cwd=str(tmpdir))
+    stats = ExtractMetrics(in_list=concat.outputs.out_list).run(
+        cwd=str(tmpdir)).outputs
+    assert numpy.isclose(stats.avg, numpy.mean(VALUES))
+    assert numpy.isclose(stats.std, numpy.std(VALUES))
@@ -0,0 +1,94 @@
+import os
+import os.path as op
+import pytest
+from nipype.interfaces.base import BaseInterface
+from example.derivative_cache import (  # qa pylint: disable=unrecognised-import
+    DerivativeCache, CachedInterfaceMixin, derivative_cache)
+from example.interfaces import Gzip  # qa pylint: disable=unrecognised-import
+
+
+def write_file(dir_path, fname='data.nii', contents=b'0123456789' * 1000):
+    os.makedirs(dir_path, exist_ok=True)
+    path = op.join(dir_path, fname)
+    with open(path, 'wb') as f:
+        f.write(contents)
+    return path
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def cache_entries(cache_dir):
+    return sorted(k for k in os.listdir(cache_dir) if not k.startswith('.'))
+
+
+def run_gzip(in_file, work_dir):
+    os.makedirs(work_dir, exist_ok=True)
+    return Gzip(in_file=in_file).run(cwd=work_dir).outputs.out_file
+
+
+def test_hit_for_same_contents(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    with derivative_cache(cache_dir):
+        first = run_gzip(write_file(str(tmpdir.join('a'))),
+                         str(tmpdir.join('work1')))
+        # The same contents at a different path
+        second = run_gzip(write_file(str(tmpdir.join('b'))),
+                          str(tmpdir.join('work2')))
+    assert len(cache_entries(cache_dir)) == 1
+    # The output of the second run is cloned from the cache, not linked to it
+    assert read_file(second) == read_file(first)
+    assert not op.samefile(first, second)
+
+
+def test_modified_outputs_dont_change_cache(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    in_file = write_file(str(tmpdir.join('a')))
+    with derivative_cache(cache_dir):
+        first = run_gzip(in_file, str(tmpdir.join('work1')))
+        contents = read_file(first)
+        second = run_gzip(in_file, str(tmpdir.join('work2')))
+        # Modify the outputs of both the original run and the cache hit in
+        # place
+        for path in (first, second):
+            with open(path, 'r+b') as f:
+                f.write(b'corrupted')
+        third = run_gzip(in_file, str(tmpdir.join('work3')))
+    assert read_file(third) == contents
+    # Only the cache's own copy is counted towards its size
+    entry_dir = op.join(cache_dir, cache_entries(cache_dir)[0])
+    assert all(os.stat(op.join(r, f)).st_nlink == 1
+               for r, _, fs in os.walk(entry_dir) for f in fs)
+
+
+def test_miss_for_different_contents(tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    with derivative_cache(cache_dir):
+        run_gzip(write_file(str(tmpdir.join('a'))), str(tmpdir.join('work1')))
+        run_gzip(write_file(str(tmpdir.join('b')), contents=b'different'),
+                 str(tmpdir.join('work2')))
+    assert len(cache_entries(cache_dir)) == 2
+
+
+def test_miss_for_changed_cache_version(tmpdir, monkeypatch):
+    cache_dir = str(tmpdir.join('cache'))
+    in_file = write_file(str(tmpdir.join('a')))
+    cache = DerivativeCache(cache_dir)
+    old_key = cache.key(Gzip(in_file=in_file))
+    with derivative_cache(cache_dir):
+        first = run_gzip(in_file, str(tmpdir.join('work1')))
+        monkeypatch.setattr(Gzip, 'cache_version',
+                            str(int(Gzip.cache_version) + 1))
+        assert cache.key(Gzip(in_file=in_file)) != old_key
+        second = run_gzip(in_file, str(tmpdir.join('work2')))
+    assert len(cache_entries(cache_dir)) == 2
+    # The output was regenerated rather than linked from the old entry
+    assert not op.samefile(first, second)
+
+
+def test_cache_version_is_required():
+    with pytest.raises(TypeError):
+        class Unversioned(CachedInterfaceMixin, BaseInterface):
+            pass
@@ -24,7 +24,8 @@ from arcana import (Analysis, AnalysisMetaClass, ParamSpec, InputFilesetSpec,
 from banana.file_format import text_format, nifti_gz_format
 from banana.citation import fsl_cite
 from banana.requirement import fsl_req
-from example.interfaces import Grep, Awk, ConcatFloats, ExtractMetrics
+from example.interfaces import (
+    Grep, Awk, ConcatFloats, ExtractMetrics, MaskedImageStats)
 from arcana import Dataset, FilesetFilter, AnalysisMetaClass, OutputFilesetSpec
 
 
@@ -262,9 +263,8 @@ class MyExtendedBasicBrainAnalysis(BasicBrainAnalysis, metaclass=AnalysisMetaCla
     add_data_specs = [
         OutputFilesetSpec('smooth', nifti_gz_format, 'smooth_mask_pipeline',
                           desc="Smoothed magnitude image in Mrtrix format"),
-        OutputFilesetSpec('image_std', nifti_gz_format,
-                          'image_std_pipeline',
-                          desc="Standard deviation of the smoothed masked image")]
+        OutputFieldSpec('image_std', float, 'image_std_pipeline',
+                        desc="Standard deviation of the smoothed masked image")]
 
     def image_std_pipeline(self, **name_maps):
 
@@ -274,16 +274,18 @@ class MyExtendedBasicBrainAnalysis(BasicBrainAnalysis, metaclass=AnalysisMetaCla
             name_maps=name_maps,
             citations=[fsl_cite])
 
+        # Streams the slices within the bounding box of the brain mask
+        # in-process, counting the voxels outside it as zeros as
+        # 'fslstats -s' would
         pipeline.add(
             'mask',
-            fsl.ImageStats(
-                op_string='-s'),
+            MaskedImageStats(
+                whole_image=True),
             inputs={
-                'in_file': ('smooth_masked', nifti_gz_format)},
+                'in_files': ('smooth_masked', nifti_gz_format),
+                'mask_files': ('brain_mask', nifti_gz_format)},
             outputs={
-                'image_std': ('out_file', nifti_gz_format)},
-            requirements=[
-                fsl_req.v('5.0.10')])
+                'image_std': ('std', float)})
 
         return pipeline
 
@@ -0,0 +1,71 @@
+import os.path as op
+import shutil
+import subprocess as sp
+import pytest
+from example.interfaces import GrepField  # qa pylint: disable=unrecognised-import
+
+
+METRICS = 'height 1712.5\nweight 68.25\nhead_circ 571.0\n'
+
+
+def write_metrics(dir_path, name='metrics.txt', contents=METRICS):
+    path = op.join(str(dir_path), name)
+    with open(path, 'w') as f:
+        f.write(contents)
+    return path
+
+
+def read_lines(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def test_select_field(tmpdir):
+    in_file = write_metrics(tmpdir)
+    out_file = GrepField(match_str='weight', in_files=[in_file]).run(
+        cwd=str(tmpdir)).outputs.out_file
+    assert out_file == op.join(str(tmpdir), 'selected_field.txt')
+    assert read_lines(out_file) == ['68.25']
+
+
+def test_regex_and_whole_line(tmpdir):
+    in_file = write_metrics(tmpdir)
+    # The match string is a regular expression searched for anywhere in the
+    # line, as for grep
+    out_file = GrepField(match_str='^h.*t ', field=0, in_files=[in_file]).run(
+        cwd=str(tmpdir)).outputs.out_file
+    assert read_lines(out_file) == ['height 1712.5']
+    out_file = GrepField(match_str='ei', field=3, in_files=[in_file]).run(
+        cwd=str(tmpdir)).outputs.out_file
+    # Fields past the end of the line are empty
+    assert read_lines(out_file) == ['', '']
+
+
+@pytest.mark.skipif(not (shutil.which('grep') and shutil.which('awk')),
+                    reason="grep and awk are not installed")
+@pytest.mark.parametrize('match_str', ['weight', 'h', '5$', '^[hw]e'])
+def test_matches_grep_awk(tmpdir, match_str):
+    in_file = write_metrics(tmpdir)
+    out_file = GrepField(match_str=match_str, in_files=[in_file]).run(
+        cwd=str(tmpdir)).outputs.out_file
+    expected = sp.check_output(
+        "grep -e '{}' {} | awk '{{print $2}}'".format(match_str, in_file),
+        shell=True).decode()
+    assert read_lines(out_file) == expected.splitlines()
+
+
+def test_batch(tmpdir):
+    in_files = [write_metrics(tmpdir, 'metrics{}.txt'.format(i),
+                              'height {}\n'.format(i)) for i in range(3)]
+    out_files = GrepField(match_str='height', in_files=in_files).run(
+        cwd=str(tmpdir)).outputs.out_file
+    assert out_files == [
+        op.join(str(tmpdir), 'selected_field_{}.txt'.format(i))
+        for i in range(3)]
+    assert [read_lines(p) for p in out_files] == [['0'], ['1'], ['2']]
+
+
+def test_no_match(tmpdir):
+    in_file = write_metrics(tmpdir)
+    with pytest.raises(ValueError, match="Did not find a match for 'bmi'"):
+        GrepField(match_str='bmi', in_files=[in_file]).run(cwd=str(tmpdir))
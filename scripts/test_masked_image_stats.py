@@ -0,0 +1,62 @@
+import os.path as op
+import numpy
+import nibabel as nb
+import pytest
+from example.compact_mask import CompactMask  # qa pylint: disable=unrecognised-import
+from example.interfaces import MaskedImageStats  # qa pylint: disable=unrecognised-import
+
+
+def save(data, path):
+    nb.Nifti1Image(data, numpy.eye(4)).to_filename(path)
+    return path
+
+
+@pytest.fixture
+def images(tmpdir):
+    random = numpy.random.RandomState(0)
+    data = random.normal(100, 20, (20, 18, 16)).astype(numpy.float32)
+    mask = numpy.zeros(data.shape, dtype=numpy.uint8)
+    mask[4:15, 3:12, 5:13] = random.uniform(size=(11, 9, 8)) > 0.3
+    return (data, mask,
+            save(data, op.join(str(tmpdir), 'image.nii.gz')),
+            save(mask, op.join(str(tmpdir), 'mask.nii.gz')))
+
+
+def test_compact_mask_roundtrip(images, tmpdir):
+    data, mask, _, mask_path = images
+    compact = CompactMask.load(mask_path)
+    assert numpy.array_equal(compact.to_array(), mask != 0)
+    saved = CompactMask.load(compact.save(str(tmpdir.join('mask.npz'))))
+    assert numpy.array_equal(saved.to_array(), mask != 0)
+    assert numpy.array_equal(saved.apply(data), data * (mask != 0))
+    assert numpy.array_equal(numpy.sort(saved.masked_values(data)),
+                             numpy.sort(data[mask != 0]))
+
+
+def test_masked_stats(images, tmpdir):
+    data, mask, in_path, mask_path = images
+    outputs = MaskedImageStats(in_files=[in_path], mask_files=[mask_path],
+                               slab_size=3).run(cwd=str(tmpdir)).outputs
+    values = data[mask != 0].astype(numpy.float64)
+    assert outputs.count == len(values)
+    assert numpy.isclose(outputs.mean, values.mean())
+    assert numpy.isclose(outputs.std, values.std())
+
+
+def test_whole_image_stats(images, tmpdir):
+    data, mask, in_path, mask_path = images
+    outputs = MaskedImageStats(in_files=[in_path], mask_files=[mask_path],
+                               whole_image=True).run(cwd=str(tmpdir)).outputs
+    masked = (data * (mask != 0)).astype(numpy.float64)
+    assert outputs.count == masked.size
+    assert numpy.isclose(outputs.mean, masked.mean())
+    assert numpy.isclose(outputs.std, masked.std())
+
+
+def test_mismatched_mask(images, tmpdir):
+    data, _, in_path, _ = images
+    other_mask = save(numpy.ones((20, 18, 15), dtype=numpy.uint8),
+                      op.join(str(tmpdir), 'other_mask.nii.gz'))
+    with pytest.raises(ValueError, match="doesn't match that of the mask"):
+        MaskedImageStats(in_files=[in_path],
+                         mask_files=[other_mask]).run(cwd=str(tmpdir))
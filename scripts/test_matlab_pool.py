@@ -0,0 +1,101 @@
+import os
+import os.path as op
+import sys
+import time
+import threading
+import pytest
+from example.matlab_pool import (  # qa pylint: disable=unrecognised-import
+    MatlabEngine, MatlabEnginePool, MatlabEngineTimeout)
+from fake_matlab_repl import INITIAL_PATH  # qa pylint: disable=unrecognised-import
+
+
+FAKE_CMD = '{} {}'.format(sys.executable,
+                          op.join(op.dirname(op.abspath(__file__)),
+                                  'fake_matlab_repl.py'))
+
+
+def run(runner, script, job_dir):
+    output, status = runner.run(script, job_dir)
+    return output.strip(), status
+
+
+@pytest.fixture
+def engine():
+    engine = MatlabEngine(FAKE_CMD, timeout=10)
+    yield engine
+    engine.close()
+
+
+def test_run_script(engine, tmpdir):
+    output, status = run(engine, "x = 3; disp(x)", str(tmpdir))
+    assert (output, status) == ('3', 0)
+    assert op.exists(str(tmpdir.join('pyscript.m')))
+
+
+def test_error_doesnt_end_session(engine, tmpdir):
+    output, status = run(engine, "error('boom')", str(tmpdir))
+    assert (output, status) == ('boom', 1)
+    assert engine.alive
+    assert run(engine, "disp('ok')", str(tmpdir)) == ('ok', 0)
+
+
+def test_variables_cleared_between_jobs(engine, tmpdir):
+    run(engine, "x = 1", str(tmpdir))
+    output, status = run(engine, "disp(x)", str(tmpdir))
+    assert status == 1
+    assert 'Undefined' in output
+
+
+def test_globals_cleared_between_jobs(engine, tmpdir):
+    run(engine, "global g; g = 1", str(tmpdir))
+    assert run(engine, "global g; disp(g)", str(tmpdir)) == ('[]', 0)
+
+
+def test_path_restored_between_jobs(engine, tmpdir):
+    output, _ = run(engine, "addpath('/job/one'); disp(path())", str(tmpdir))
+    assert output.startswith('/job/one')
+    # Also restored after a job that fails
+    run(engine, "addpath('/job/two'); error('boom')", str(tmpdir))
+    assert run(engine, "disp(path())", str(tmpdir)) == (INITIAL_PATH, 0)
+
+
+def test_timeout_kills_session(tmpdir):
+    engine = MatlabEngine(FAKE_CMD, timeout=1)
+    start = time.monotonic()
+    with pytest.raises(MatlabEngineTimeout):
+        run(engine, "pause(60)", str(tmpdir))
+    assert time.monotonic() - start < 30
+    assert not engine.alive
+    engine.close()
+
+
+def test_pool_restarts_timed_out_session(tmpdir):
+    pool = MatlabEnginePool(size=1, cmd=FAKE_CMD, timeout=1)
+    try:
+        with pytest.raises(MatlabEngineTimeout):
+            run(pool, "pause(60)", str(tmpdir))
+        # The hung session doesn't block the pool
+        assert run(pool, "disp('ok')", str(tmpdir)) == ('ok', 0)
+    finally:
+        pool.close()
+
+
+def test_pool_runs_jobs_concurrently(tmpdir):
+    pool = MatlabEnginePool(size=2, cmd=FAKE_CMD, timeout=10)
+    results = {}
+
+    def run_job(i):
+        job_dir = str(tmpdir.join(str(i)))
+        os.makedirs(job_dir)
+        results[i] = run(pool, "x = {}; disp(x)".format(i), job_dir)
+
+    try:
+        threads = [threading.Thread(target=run_job, args=(i,))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        pool.close()
+    assert results == {i: (str(i), 0) for i in range(4)}
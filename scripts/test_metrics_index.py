@@ -0,0 +1,121 @@
+import os
+import os.path as op
+import numpy
+import pytest
+from example.metrics_index import MetricsIndex, parse_metrics  # qa pylint: disable=unrecognised-import
+from example.interfaces import LookupMetric, GrepField, ConcatFloats  # qa pylint: disable=unrecognised-import
+from example.arrays import load_array  # qa pylint: disable=unrecognised-import
+
+
+def write_metrics(path, **metrics):
+    with open(path, 'w') as f:
+        for name, value in metrics.items():
+            f.write('{} {}\n'.format(name, value))
+    return path
+
+
+@pytest.fixture
+def files(tmpdir):
+    return [write_metrics(str(tmpdir.join('metrics{}.txt'.format(i))),
+                          height=170.0 + i, weight=70.0 + i, head_circ=57.0)
+            for i in range(3)]
+
+
+@pytest.fixture
+def index_dir(tmpdir):
+    return str(tmpdir.join('index'))
+
+
+def test_add(files, index_dir):
+    index = MetricsIndex(index_dir)
+    assert index.update(files) == 3
+    assert sorted(index.metrics) == ['head_circ', 'height', 'weight']
+    assert list(index.lookup('height', files)) == [170.0, 171.0, 172.0]
+    # The index is persisted, so nothing needs to be parsed again
+    index = MetricsIndex(index_dir)
+    assert index.update(files) == 0
+    assert list(index.lookup('weight', files[::-1])) == [72.0, 71.0, 70.0]
+    # New files are appended to the existing rows
+    new_file = write_metrics(op.join(op.dirname(files[0]), 'new.txt'),
+                             height=180.0, bmi=22.0)
+    assert index.update([new_file]) == 1
+    assert list(index.lookup('height', files + [new_file])) == [
+        170.0, 171.0, 172.0, 180.0]
+    assert list(index.lookup('bmi', [new_file])) == [22.0]
+
+
+def test_duplicate_paths(files, index_dir):
+    index = MetricsIndex(index_dir)
+    assert index.update(files + files[:1]) == 3
+    assert len(index.files) == index.values.shape[0] == 3
+    assert len(MetricsIndex(index_dir).files) == 3
+    assert list(index.lookup('height', files + files[:1])) == [
+        170.0, 171.0, 172.0, 170.0]
+
+
+def test_reparse_on_change(files, index_dir):
+    index = MetricsIndex(index_dir)
+    index.update(files)
+    write_metrics(files[1], height=165.5, weight=60.25, head_circ=57.0)
+    stat = os.stat(files[1])
+    os.utime(files[1], (stat.st_atime, stat.st_mtime + 10))
+    assert index.update(files) == 1
+    assert list(index.lookup('height', files)) == [170.0, 165.5, 172.0]
+    assert list(MetricsIndex(index_dir).lookup('weight', files)) == [
+        70.0, 60.25, 72.0]
+
+
+def test_touch_only(files, index_dir):
+    index = MetricsIndex(index_dir)
+    index.update(files)
+    stat = os.stat(files[0])
+    os.utime(files[0], (stat.st_atime, stat.st_mtime + 10))
+    # The digest is unchanged so the file isn't parsed again, but its new
+    # timestamp is recorded so it isn't even read the next time
+    assert index.update(files) == 0
+    assert index.files[0]['mtime'] == stat.st_mtime + 10
+    assert list(index.lookup('height', files)) == [170.0, 171.0, 172.0]
+
+
+def test_lookup_regex(files, index_dir):
+    index = MetricsIndex(index_dir)
+    index.update(files)
+    assert list(index.lookup('^w', files)) == [70.0, 71.0, 72.0]
+    assert list(index.lookup('circ', files)) == [57.0] * 3
+    with pytest.raises(KeyError, match='more than one metric'):
+        index.lookup('eight', files)
+    with pytest.raises(KeyError, match="doesn't match any"):
+        index.lookup('bmi', files)
+
+
+def test_lookup_missing(files, index_dir):
+    other = write_metrics(op.join(op.dirname(files[0]), 'other.txt'),
+                          weight=80.0)
+    index = MetricsIndex(index_dir)
+    index.update(files + [other])
+    with pytest.raises(KeyError, match='not found in .*other.txt'):
+        index.lookup('height', files + [other])
+
+
+def test_parse_metrics():
+    assert parse_metrics('height 170\n\nnote abc\nweight 70.5 kg\n') == {
+        'height': 170.0, 'weight': 70.5}
+
+
+@pytest.mark.parametrize('metric', ['height', 'weight', '^w', 'circ'])
+def test_lookup_metric_matches_grep_field(files, index_dir, tmpdir, metric):
+    lookup = LookupMetric(metric=metric, in_files=files,
+                          index_dir=index_dir).run(
+                              cwd=str(tmpdir.mkdir('lookup'))).outputs
+    assert lookup.num_parsed == 3
+    selected = GrepField(match_str=metric, in_files=files).run(
+        cwd=str(tmpdir.mkdir('grep_field'))).outputs.out_file
+    concat = ConcatFloats(in_files=selected).run(
+        cwd=str(tmpdir.mkdir('concat'))).outputs
+    assert numpy.array_equal(lookup.out_array, concat.out_array)
+    assert numpy.array_equal(load_array(lookup.out_file), concat.out_array)
+    # The second lookup is served from the index
+    lookup = LookupMetric(metric=metric, in_files=files,
+                          index_dir=index_dir).run(
+                              cwd=str(tmpdir.mkdir('lookup2'))).outputs
+    assert lookup.num_parsed == 0
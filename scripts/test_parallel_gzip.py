@@ -0,0 +1,31 @@
+import gzip
+import os.path as op
+import numpy
+import nibabel as nb
+import pytest
+from example.parallel_gzip import save_nifti  # qa pylint: disable=unrecognised-import
+from example.interfaces import Gzip  # qa pylint: disable=unrecognised-import
+
+
+@pytest.mark.parametrize('num_threads', [1, 4])
+def test_gzip_roundtrip(tmpdir, num_threads):
+    # Compressible data spanning several blocks, with a partial last block
+    data = numpy.random.RandomState(0).randint(
+        0, 16, 1000003, dtype=numpy.uint8).tobytes()
+    in_path = str(tmpdir.join('data.nii'))
+    with open(in_path, 'wb') as f:
+        f.write(data)
+    out_file = Gzip(in_file=in_path, num_threads=num_threads).run(
+        cwd=str(tmpdir)).outputs.out_file
+    assert out_file == op.join(str(tmpdir), 'data.nii.gz')
+    with gzip.open(out_file) as f:
+        assert f.read() == data
+
+
+def test_save_nifti(tmpdir):
+    data = numpy.random.RandomState(0).normal(size=(40, 30, 20)).astype(
+        numpy.float32)
+    out_path = save_nifti(nb.Nifti1Image(data, numpy.eye(4)),
+                          str(tmpdir.join('image.nii.gz')), num_threads=4)
+    assert numpy.array_equal(nb.load(out_path).get_fdata(dtype=numpy.float32),
+                             data)
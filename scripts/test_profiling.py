@@ -0,0 +1,61 @@
+import os
+import json
+import numpy
+import pytest
+from nipype.interfaces.base import (
+    BaseInterface, BaseInterfaceInputSpec, TraitedSpec, traits)
+from example.profiling import ProfiledInterfaceMixin, trace  # qa pylint: disable=unrecognised-import
+
+
+class AllocateInputSpec(BaseInterfaceInputSpec):
+    size_mb = traits.Int(mandatory=True)
+
+
+class AllocateOutputSpec(TraitedSpec):
+    total = traits.Float()
+
+
+class Allocate(ProfiledInterfaceMixin, BaseInterface):
+
+    input_spec = AllocateInputSpec
+    output_spec = AllocateOutputSpec
+
+    def _run_interface(self, runtime):
+        # Touch every page so the array is resident
+        data = numpy.ones(self.inputs.size_mb * 1024 ** 2 // 8)
+        self._total = float(data.sum())
+        del data
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['total'] = self._total
+        return outputs
+
+
+def run_traced(tmpdir, sizes):
+    trace_path = str(tmpdir.join('trace.json'))
+    with trace(trace_path):
+        for size_mb in sizes:
+            Allocate(size_mb=size_mb).run(cwd=str(tmpdir))
+    with open(trace_path) as f:
+        return [e for e in json.load(f)['traceEvents']
+                if e['name'] == 'Allocate._run_interface']
+
+
+@pytest.mark.skipif(not os.access('/proc/self/clear_refs', os.W_OK),
+                    reason="Peak RSS can't be reset on this system")
+def test_peak_rss_is_per_call(tmpdir):
+    large, small = run_traced(tmpdir, [256, 1])
+    assert large['args']['peak_rss_kb'] > small['args']['peak_rss_kb'] + 200000
+    assert 'process_peak_rss_kb' not in small['args']
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/io'),
+                    reason="I/O counters aren't available on this system")
+def test_io_counters(tmpdir):
+    args = run_traced(tmpdir, [1])[0]['args']
+    for name in ('chars_read', 'chars_written', 'storage_bytes_read',
+                 'storage_bytes_written'):
+        assert args[name] >= 0
+    assert 'bytes_read' not in args
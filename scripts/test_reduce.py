@@ -0,0 +1,56 @@
+import pytest
+from nipype import Workflow, Node
+from nipype.interfaces.utility import Function
+from example.reduce import group_ids, add_tree_reduction  # qa pylint: disable=unrecognised-import
+
+
+def leaves(levels):
+    groups = levels[0]
+    for level in levels[1:]:
+        groups = [c for g in groups for c in level[g]]
+    return groups
+
+
+@pytest.mark.parametrize('num_ids, fan_in, depth', [
+    (1, 2, 1), (5, 5, 1), (6, 5, 2), (25, 5, 2), (26, 5, 3), (125, 5, 3),
+    (126, 5, 4), (1000, 10, 3), (4096, 16, 3), (4097, 16, 4)])
+def test_group_ids(num_ids, fan_in, depth):
+    ids = ['{:04}'.format(i) for i in range(num_ids)]
+    levels = group_ids(ids, fan_in)
+    assert len(levels) == depth
+    assert len(levels[0]) <= fan_in
+    assert all(len(c) <= fan_in for level in levels[1:]
+               for c in level.values())
+    # Every ID is a leaf of the tree, in order
+    assert leaves(levels) == ids
+
+
+def test_group_ids_errors():
+    with pytest.raises(ValueError):
+        group_ids(['01', '02'], 1)
+    with pytest.raises(ValueError):
+        group_ids([], 4)
+
+
+def to_value(subject_id):
+    return float(subject_id)
+
+
+def total(values):
+    return sum(values)
+
+
+def test_tree_reduction(tmpdir):
+    ids = [str(i) for i in range(1, 11)]
+    workflow = Workflow(name='tree_test', base_dir=str(tmpdir))
+    process = Node(Function(input_names=['subject_id'],
+                            output_names=['value'], function=to_value),
+                   name='process')
+    workflow.add_nodes([process])
+    root = add_tree_reduction(
+        workflow, ids, 'subject_id', process, 'value',
+        Function(input_names=['values'], output_names=['total'],
+                 function=total),
+        'values', 'total', fan_in=3)
+    result = [n for n in workflow.run().nodes() if n.name == root.name][0]
+    assert result.result.outputs.total == sum(range(1, 11))
@@ -0,0 +1,130 @@
+import pytest
+from nipype.interfaces.base import isdefined
+from example.registration import staged_registration, OUTPUT_FIELDS  # qa pylint: disable=unrecognised-import
+
+
+STAGE_NAMES = ['stage1_rigid', 'stage2_affine', 'stage3_syn']
+
+
+def registration_inputs(**kwargs):
+    inputs = dict(
+        transforms=['Rigid', 'Affine', 'SyN'],
+        transform_parameters=[(0.1,), (0.1,), (0.1, 3.0, 0.0)],
+        metric=['MI', 'MI', 'CC'],
+        metric_weight=[1.0] * 3,
+        radius_or_number_of_bins=[32, 32, 4],
+        number_of_iterations=[[1000, 500], [1000, 500], [100, 70, 50]],
+        convergence_threshold=[1e-6] * 3,
+        convergence_window_size=[10] * 3,
+        smoothing_sigmas=[[1, 0], [1, 0], [2, 1, 0]],
+        sigma_units=['vox'] * 3,
+        shrink_factors=[[2, 1], [2, 1], [4, 2, 1]],
+        use_histogram_matching=[False, False, True],
+        dimension=3,
+        float=True,
+        output_warped_image='warped.nii.gz',
+        initial_moving_transform_com=1)
+    inputs.update(kwargs)
+    return inputs
+
+
+def connections(workflow):
+    """
+    The connections of the workflow as (source, output, dest, input) tuples
+    """
+    return {(u.name, src, v.name, dst)
+            for u, v, d in workflow._graph.edges(data=True)
+            for src, dst in d['connect']}
+
+
+def stage_input(workflow, stage_name, input_name):
+    value = getattr(workflow.get_node(stage_name).inputs, input_name)
+    return value if isdefined(value) else None
+
+
+def test_stage_inputs_are_split():
+    workflow = staged_registration(**registration_inputs())
+    assert sorted(n for n in workflow.list_node_names()
+                  if n.startswith('stage')) == STAGE_NAMES
+    for i, stage_name in enumerate(STAGE_NAMES):
+        inputs = registration_inputs()
+        for name in ('transforms', 'metric', 'number_of_iterations',
+                     'smoothing_sigmas', 'shrink_factors',
+                     'use_histogram_matching'):
+            assert stage_input(workflow, stage_name, name) == [
+                inputs[name][i]], name
+        # Inputs that aren't per-stage are passed to every stage
+        assert stage_input(workflow, stage_name, 'dimension') == 3
+        assert stage_input(workflow, stage_name, 'float') is True
+        assert stage_input(workflow, stage_name,
+                           'write_composite_transform') is True
+
+
+def test_stages_are_chained():
+    workflow = staged_registration(**registration_inputs())
+    edges = connections(workflow)
+    for prev_stage, stage in zip(STAGE_NAMES, STAGE_NAMES[1:]):
+        assert (prev_stage, 'composite_transform',
+                stage, 'initial_moving_transform') in edges
+    # The first stage isn't initialised by another stage
+    assert not any(d == STAGE_NAMES[0] and i == 'initial_moving_transform'
+                   for _, _, d, i in edges)
+    for stage in STAGE_NAMES:
+        assert ('inputnode', 'fixed_image', stage, 'fixed_image') in edges
+        assert ('inputnode', 'moving_image', stage, 'moving_image') in edges
+
+
+def test_centre_of_mass_initialisation_only_on_first_stage():
+    workflow = staged_registration(**registration_inputs())
+    assert stage_input(workflow, STAGE_NAMES[0],
+                       'initial_moving_transform_com') == 1
+    for stage in STAGE_NAMES[1:]:
+        assert stage_input(workflow, stage,
+                           'initial_moving_transform_com') is None
+
+
+@pytest.mark.parametrize('inverse', [False, True])
+def test_warped_images_only_from_final_stage(inverse):
+    kwargs = {}
+    if inverse:
+        kwargs['output_inverse_warped_image'] = 'inverse.nii.gz'
+    workflow = staged_registration(**registration_inputs(**kwargs))
+    for stage in STAGE_NAMES[:-1]:
+        assert stage_input(workflow, stage, 'output_warped_image') is False
+        assert stage_input(workflow, stage,
+                           'output_inverse_warped_image') is False
+    assert stage_input(workflow, STAGE_NAMES[-1],
+                       'output_warped_image') == 'warped.nii.gz'
+    expected = {(STAGE_NAMES[-1], f, 'outputnode', f)
+                for f in OUTPUT_FIELDS
+                if inverse or f != 'inverse_warped_image'}
+    assert {e for e in connections(workflow)
+            if e[2] == 'outputnode'} == expected
+
+
+def test_single_stage():
+    workflow = staged_registration(**registration_inputs(
+        transforms=['Rigid'], metric=['MI']))
+    assert sorted(n for n in workflow.list_node_names()
+                  if n.startswith('stage')) == ['stage1_rigid']
+    # Lists that don't have a value for each of several stages are passed
+    # on as they are
+    assert stage_input(workflow, 'stage1_rigid', 'metric') == ['MI']
+    assert stage_input(workflow, 'stage1_rigid',
+                       'output_warped_image') == 'warped.nii.gz'
+
+
+def test_prepared_template(tmpdir):
+    template = str(tmpdir.join('template.nii.gz'))
+    with open(template, 'wb'):
+        pass
+    workflow = staged_registration(
+        template_cache_dir=str(tmpdir.join('cache')),
+        **registration_inputs(fixed_image=template))
+    prepare = workflow.get_node('prepare_template')
+    assert prepare.inputs.in_file == template
+    edges = connections(workflow)
+    for stage in STAGE_NAMES:
+        assert ('prepare_template', 'out_file',
+                stage, 'fixed_image') in edges
+        assert ('inputnode', 'fixed_image', stage, 'fixed_image') not in edges
@@ -0,0 +1,76 @@
+import numpy
+import pytest
+from example.stats import RunningStats  # qa pylint: disable=unrecognised-import
+from example.interfaces import ExtractMetrics  # qa pylint: disable=unrecognised-import
+
+
+@pytest.fixture
+def values():
+    # A large offset relative to the spread, where naive sums of squares
+    # lose precision
+    return numpy.random.RandomState(0).normal(1e8, 1.0, 10000)
+
+
+def accumulate(values, chunk_size, **kwargs):
+    stats = RunningStats(**kwargs)
+    for i in range(0, len(values), chunk_size):
+        stats.update(values[i:i + chunk_size])
+    return stats
+
+
+def test_update(values):
+    stats = accumulate(values, 333)
+    assert stats.count == len(values)
+    assert numpy.isclose(stats.mean, values.mean(), rtol=1e-14)
+    assert numpy.isclose(stats.std(), values.std(), rtol=1e-9)
+    assert numpy.isclose(stats.std(ddof=1), values.std(ddof=1), rtol=1e-9)
+    assert (stats.min, stats.max) == (values.min(), values.max())
+
+
+def test_merge(values):
+    # Uneven groups, including an empty one
+    groups = numpy.split(values, [10, 10, 2500, 7777])
+    stats = RunningStats()
+    for group in groups:
+        stats.merge(accumulate(group, 100))
+    expected = accumulate(values, len(values))
+    assert stats.count == expected.count
+    assert numpy.isclose(stats.mean, expected.mean, rtol=1e-14)
+    assert numpy.isclose(stats.variance(), expected.variance(), rtol=1e-9)
+    assert (stats.min, stats.max) == (expected.min, expected.max)
+
+
+def test_save_and_load(values, tmpdir):
+    path = str(tmpdir.join('partial_stats.json'))
+    stats = accumulate(values, 1000, sketch_size=100)
+    stats.save(path)
+    loaded = RunningStats.load(path)
+    assert loaded.count == stats.count
+    assert loaded.mean == stats.mean
+    assert loaded.variance() == stats.variance()
+    assert loaded.quantile(0.5) == stats.quantile(0.5)
+
+
+def test_merged_quantiles(values):
+    stats = RunningStats(sketch_size=200)
+    for group in numpy.array_split(values, 7):
+        stats.merge(accumulate(group, 500, sketch_size=200))
+    for q in (0.05, 0.5, 0.95):
+        # The sketch is approximate, so compare ranks rather than values
+        rank = (values <= stats.quantile(q)).mean()
+        assert abs(rank - q) < 0.02
+
+
+def test_extract_metrics_merges_partials(values, tmpdir):
+    # The merge of the per-subject partials in ToyAnalysis.statistics_pipeline
+    partials = []
+    for i, group in enumerate(numpy.array_split(values, 5)):
+        node_dir = tmpdir.mkdir('subject{}'.format(i))
+        partials.append(ExtractMetrics(in_array=group).run(
+            cwd=str(node_dir)).outputs.out_partial)
+    outputs = ExtractMetrics(in_partials=partials).run(
+        cwd=str(tmpdir)).outputs
+    assert outputs.count == len(values)
+    assert numpy.isclose(outputs.avg, values.mean(), rtol=1e-14)
+    assert numpy.isclose(outputs.std, values.std(), rtol=1e-9)
+    assert (outputs.min, outputs.max) == (values.min(), values.max())
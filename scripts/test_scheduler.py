@@ -0,0 +1,101 @@
+import os.path as op
+import pytest
+import nipype.pipeline.engine as pe
+from nipype.interfaces.utility import IdentityInterface
+from example.scheduler import PackingMultiProcPlugin, MULTIPROC_INTERNALS  # qa pylint: disable=unrecognised-import
+from example.interfaces import Gzip, ExtractMetrics  # qa pylint: disable=unrecognised-import
+
+
+NUM_PROCESSORS = 4
+
+
+class RecordingPlugin(PackingMultiProcPlugin):
+    """
+    Records the threads of each job when it is submitted, along with the
+    threads of the jobs that are already running
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.submitted = []
+
+    def _submit_job(self, node, updatehash=False):
+        running = [self.procs[j].n_procs for _, j in self.pending_tasks]
+        self.submitted.append((node.name, node.n_procs,
+                               node.interface.inputs.num_threads
+                               if node.name == 'gzip' else None, running))
+        return super()._submit_job(node, updatehash=updatehash)
+
+
+def gzip_workflow(tmpdir, num_files, num_threads):
+    in_files = []
+    for i in range(num_files):
+        path = op.join(str(tmpdir), 'data{}.nii'.format(i))
+        with open(path, 'wb') as f:
+            f.write(b'0123456789' * 10000)
+        in_files.append(path)
+    workflow = pe.Workflow('packing', base_dir=str(tmpdir.join('work')))
+    source = pe.Node(IdentityInterface(['in_file']), name='source')
+    source.iterables = ('in_file', in_files)
+    gzip = pe.Node(Gzip(num_threads=num_threads), name='gzip')
+    workflow.connect(source, 'in_file', gzip, 'in_file')
+    return workflow
+
+
+def run(workflow, **plugin_args):
+    plugin = RecordingPlugin(plugin_args=dict(
+        n_procs=NUM_PROCESSORS, memory_gb=4, **plugin_args))
+    graph = workflow.run(plugin=plugin)
+    return plugin, graph
+
+
+@pytest.mark.parametrize('num_files,num_threads', [(1, 1), (3, 2), (6, 16)])
+def test_threads_never_exceed_processors(tmpdir, num_files, num_threads):
+    plugin, graph = run(gzip_workflow(tmpdir, num_files, num_threads))
+    gzip_jobs = [s for s in plugin.submitted if s[0] == 'gzip']
+    assert len(gzip_jobs) == num_files
+    for _, n_procs, node_threads, running in gzip_jobs:
+        # The interface's threads follow the node's
+        assert node_threads == n_procs
+        assert 1 <= n_procs <= NUM_PROCESSORS
+        assert n_procs + sum(running) <= NUM_PROCESSORS
+    # The nodes were run with the adapted threads
+    for node in graph.nodes():
+        if node.name == 'gzip':
+            assert op.exists(node.result.outputs.out_file)
+            assert (node.result.inputs['num_threads']
+                    <= NUM_PROCESSORS)
+
+
+def test_single_job_gets_free_processors(tmpdir):
+    plugin, _ = run(gzip_workflow(tmpdir, 1, 1))
+    assert [s[1] for s in plugin.submitted if s[0] == 'gzip'] == [
+        NUM_PROCESSORS]
+
+
+def test_max_threads_and_no_adaptation(tmpdir):
+    plugin, _ = run(gzip_workflow(tmpdir.mkdir('max'), 1, 1), max_threads=2)
+    assert [s[1] for s in plugin.submitted if s[0] == 'gzip'] == [2]
+    plugin, _ = run(gzip_workflow(tmpdir.mkdir('off'), 1, 3),
+                    adapt_threads=False)
+    assert [s[1] for s in plugin.submitted if s[0] == 'gzip'] == [3]
+
+
+def test_is_adaptable():
+    assert PackingMultiProcPlugin._is_adaptable(
+        pe.Node(Gzip(), name='gzip'))
+    # Interfaces without a 'num_threads' input
+    assert not PackingMultiProcPlugin._is_adaptable(
+        pe.Node(ExtractMetrics(), name='extract_metrics'))
+    assert not PackingMultiProcPlugin._is_adaptable(
+        pe.MapNode(Gzip(), iterfield=['in_file'], name='gzip'))
+
+
+def test_multiproc_internals():
+    # Fails when a version of Nipype no longer has the private attributes
+    # the adaptation relies on, in which case it is silently skipped
+    plugin = PackingMultiProcPlugin(plugin_args={'n_procs': 1,
+                                                 'memory_gb': 1})
+    plugin.procs, plugin.depidx, plugin.proc_done = [], None, None
+    assert plugin._supports_adaptation()
+    assert all(hasattr(plugin, a) for a in MULTIPROC_INTERNALS)
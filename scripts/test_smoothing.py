@@ -0,0 +1,85 @@
+import os.path as op
+import shutil
+import subprocess as sp
+import numpy
+import nibabel as nb
+import pytest
+from scipy.ndimage import convolve
+from example.image import gaussian_smooth, fwhm_to_sigma  # qa pylint: disable=unrecognised-import
+from example.interfaces import SmoothMask  # qa pylint: disable=unrecognised-import
+
+
+VOXEL_SIZES = (1.0, 1.5, 2.0)
+
+# The maximum difference from fslmaths, relative to the range of the image
+FSLMATHS_TOLERANCE = 1e-3
+
+
+def random_image(shape=(24, 20, 16), seed=0):
+    # Smooth random data with a bright block touching the edge of the field of
+    # view, where the handling of the boundary matters
+    data = numpy.random.RandomState(seed).uniform(0, 100, shape)
+    data[:6, :, :4] += 500
+    return data.astype(numpy.float32)
+
+
+def save(data, path):
+    nb.Nifti1Image(data, numpy.diag(VOXEL_SIZES + (1.0,))).to_filename(path)
+    return path
+
+
+def reference_smooth(data, sigma, truncate=4.0):
+    # Direct 3-D convolution, renormalised by the weights within the field of
+    # view
+    radii = [int(truncate * sigma / v + 0.5) for v in VOXEL_SIZES]
+    grids = numpy.meshgrid(*(numpy.arange(-r, r + 1) * v
+                             for r, v in zip(radii, VOXEL_SIZES)),
+                           indexing='ij')
+    kernel = numpy.exp(-sum(g ** 2 for g in grids) / (2 * sigma ** 2))
+    smoothed = convolve(data.astype(numpy.float64), kernel, mode='constant')
+    weights = convolve(numpy.ones(data.shape), kernel, mode='constant')
+    return smoothed / weights
+
+
+def test_constant_image_is_unchanged_at_edges():
+    data = numpy.full((10, 9, 8), 7.0, dtype=numpy.float32)
+    smoothed = gaussian_smooth(data, 3.0, VOXEL_SIZES)
+    assert numpy.allclose(smoothed, 7.0, rtol=1e-5)
+
+
+def test_matches_3d_convolution():
+    data = random_image()
+    sigma = fwhm_to_sigma(4.0)
+    assert numpy.allclose(gaussian_smooth(data, sigma, VOXEL_SIZES),
+                          reference_smooth(data, sigma), rtol=1e-4, atol=1e-3)
+
+
+def test_smooth_mask(tmpdir):
+    data = random_image()
+    mask = numpy.zeros(data.shape, dtype=numpy.uint8)
+    mask[5:15, 4:12, 3:10] = 1
+    result = SmoothMask(
+        in_file=save(data, op.join(str(tmpdir), 'image.nii.gz')),
+        mask_file=save(mask, op.join(str(tmpdir), 'mask.nii.gz')),
+        fwhm=4.0).run(cwd=str(tmpdir))
+    smoothed = nb.load(result.outputs.out_file).get_fdata()
+    masked = nb.load(result.outputs.masked_file).get_fdata()
+    assert numpy.allclose(smoothed, reference_smooth(data, fwhm_to_sigma(4.0)),
+                          rtol=1e-4, atol=1e-3)
+    assert numpy.array_equal(masked[mask == 0], numpy.zeros((mask == 0).sum()))
+    assert numpy.array_equal(masked[mask != 0], smoothed[mask != 0])
+
+
+@pytest.mark.skipif(shutil.which('fslmaths') is None,
+                    reason="FSL isn't installed")
+@pytest.mark.parametrize('sigma', [1.0, fwhm_to_sigma(4.0), 3.0])
+def test_matches_fslmaths(tmpdir, sigma):
+    data = random_image()
+    in_path = save(data, op.join(str(tmpdir), 'image.nii.gz'))
+    out_path = op.join(str(tmpdir), 'smooth.nii.gz')
+    sp.check_call(['fslmaths', in_path, '-s', str(sigma), out_path,
+                   '-odt', 'float'])
+    expected = nb.load(out_path).get_fdata()
+    smoothed = gaussian_smooth(data, sigma, VOXEL_SIZES)
+    assert (numpy.abs(smoothed - expected).max()
+            <= FSLMATHS_TOLERANCE * numpy.ptp(data))
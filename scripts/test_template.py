@@ -0,0 +1,56 @@
+import os
+import os.path as op
+import shutil
+import numpy
+import nibabel as nb
+import nipype.pipeline.engine as pe
+from example.image import cached_template  # qa pylint: disable=unrecognised-import
+from example.interfaces import PrepareTemplate  # qa pylint: disable=unrecognised-import
+
+
+def save_template(path, seed=0):
+    data = numpy.random.RandomState(seed).randint(
+        0, 1000, (12, 10, 8)).astype(numpy.int16)
+    img = nb.Nifti1Image(data, numpy.diag([2.0, 2.0, 2.0, 1.0]))
+    img.header.set_slope_inter(0.5, 10.0)
+    img.to_filename(path)
+    return path
+
+
+def test_cached_template(tmpdir):
+    template = save_template(str(tmpdir.join('template.nii.gz')))
+    cache_dir = str(tmpdir.join('cache'))
+    cached_path = cached_template(template, cache_dir=cache_dir)
+    assert cached_path.endswith('_float32.nii')
+    prepared = nb.load(cached_path)
+    assert prepared.get_data_dtype() == numpy.float32
+    assert numpy.array_equal(prepared.affine, nb.load(template).affine)
+    assert numpy.allclose(numpy.asanyarray(prepared.dataobj),
+                          nb.load(template).get_fdata())
+    # The same contents at another path are prepared only once
+    other = str(tmpdir.join('other.nii.gz'))
+    shutil.copy(template, other)
+    mtime = op.getmtime(cached_path)
+    assert cached_template(other, cache_dir=cache_dir) == cached_path
+    assert op.getmtime(cached_path) == mtime
+    assert cached_template(save_template(other, seed=1),
+                           cache_dir=cache_dir) != cached_path
+    assert len(os.listdir(cache_dir)) == 2
+
+
+def test_prepare_template_survives_cleared_cache(tmpdir):
+    template = save_template(str(tmpdir.join('template.nii.gz')))
+    cache_dir = str(tmpdir.join('cache'))
+    node = pe.Node(PrepareTemplate(in_file=template, cache_dir=cache_dir),
+                   name='prepare_template', base_dir=str(tmpdir.join('work')))
+    out_file = node.run().outputs.out_file
+    assert op.dirname(out_file) == node.output_dir()
+    expected = numpy.asanyarray(nb.load(out_file).dataobj)
+    shutil.rmtree(cache_dir)
+    # The cached result of the node is reused, and its output still exists
+    node = pe.Node(PrepareTemplate(in_file=template, cache_dir=cache_dir),
+                   name='prepare_template', base_dir=str(tmpdir.join('work')))
+    out_file = node.run().outputs.out_file
+    assert numpy.array_equal(numpy.asanyarray(nb.load(out_file).dataobj),
+                             expected)
+    assert not op.exists(cache_dir)
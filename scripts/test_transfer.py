@@ -0,0 +1,98 @@
+import os
+import os.path as op
+import tempfile
+import shutil
+import pytest
+from example.transfer import transfer_file, transfer_tree  # qa pylint: disable=unrecognised-import
+from example.interfaces import LinkingDataSink  # qa pylint: disable=unrecognised-import
+
+
+DATA = b'warped image' * 10000
+
+
+def write_file(path, contents=DATA):
+    os.makedirs(op.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(contents)
+    return path
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def other_file_system(path):
+    # A temporary directory on a different file system from `path`, if there
+    # is one
+    for dir_path in ('/dev/shm', tempfile.gettempdir(), op.expanduser('~')):
+        if (op.isdir(dir_path) and os.access(dir_path, os.W_OK)
+                and os.stat(dir_path).st_dev != os.stat(path).st_dev):
+            return tempfile.mkdtemp(dir=dir_path)
+    return None
+
+
+def test_link(tmpdir):
+    src = write_file(str(tmpdir.join('work', 'out.nii.gz')))
+    dst = str(tmpdir.join('out.nii.gz'))
+    assert transfer_file(src, dst, mode='link') == 'hardlink'
+    assert op.samefile(src, dst)
+    # Linking again is a no-op
+    assert transfer_file(src, dst, mode='link') == 'hardlink'
+
+
+@pytest.mark.parametrize('mode', ['reflink', 'copy'])
+def test_independent_copy(tmpdir, mode):
+    src = write_file(str(tmpdir.join('work', 'out.nii.gz')))
+    dst = write_file(str(tmpdir.join('out.nii.gz')), b'previous contents')
+    assert transfer_file(src, dst, mode=mode) in (mode, 'copy')
+    assert not op.samefile(src, dst)
+    assert read_file(dst) == DATA
+    # No temporary files are left behind
+    assert sorted(os.listdir(str(tmpdir))) == ['out.nii.gz', 'work']
+
+
+def test_move(tmpdir):
+    src = write_file(str(tmpdir.join('work', 'out.nii.gz')))
+    dst = str(tmpdir.join('out.nii.gz'))
+    assert transfer_file(src, dst, mode='move') == 'rename'
+    assert not op.exists(src)
+    assert read_file(dst) == DATA
+
+
+def test_other_file_system(tmpdir):
+    other_dir = other_file_system(str(tmpdir))
+    if other_dir is None:
+        pytest.skip("No other file system to transfer to")
+    try:
+        src = write_file(str(tmpdir.join('work', 'out.nii.gz')))
+        dst = op.join(other_dir, 'out.nii.gz')
+        assert transfer_file(src, dst, mode='link') == 'copy'
+        assert read_file(dst) == DATA
+    finally:
+        shutil.rmtree(other_dir)
+
+
+def test_transfer_tree(tmpdir):
+    src = str(tmpdir.join('work', 'dir'))
+    write_file(op.join(src, 'a.txt'), b'a')
+    write_file(op.join(src, 'sub', 'b.txt'), b'bb')
+    dst = str(tmpdir.join('dir'))
+    transferred = transfer_tree(src, dst)
+    assert sorted((op.relpath(p, dst), m, s) for p, m, s in transferred) == [
+        ('a.txt', 'hardlink', 1), (op.join('sub', 'b.txt'), 'hardlink', 2)]
+
+
+def test_linking_datasink(tmpdir):
+    src = write_file(str(tmpdir.join('work', '_subject_id_01',
+                                      'warped.nii.gz')))
+    sink = LinkingDataSink(base_directory=str(tmpdir.join('output')),
+                           container='antsdir', parameterization=True,
+                           substitutions=[('_subject_id_', 'sub-')])
+    setattr(sink.inputs, 'antsreg.@warped', src)
+    outputs = sink.run(cwd=str(tmpdir)).outputs
+    dst = str(tmpdir.join('output', 'antsdir', 'antsreg', 'sub-01',
+                          'warped.nii.gz'))
+    assert outputs.out_file == [dst]
+    assert op.samefile(src, dst)
+    assert (outputs.bytes_saved, outputs.bytes_copied) == (len(DATA), 0)